@@ -0,0 +1,300 @@
+"""Local stand-ins for the external services used by the operator.
+
+The replay and micro benchmarks load operator/operator.py with Kubernetes,
+Ansible Tower, LDAP and PostgreSQL replaced by the fakes below, so events can
+be processed without a cluster.
+"""
+import copy
+import importlib.util
+import json
+import os
+import re
+import sys
+import time
+
+operator_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'operator')
+
+# Append, do not prepend, operator.py would shadow the standard library operator module
+if operator_dir not in sys.path:
+    sys.path.append(operator_dir)
+
+fake_secrets = {
+    'gpte-ldap-secrets': {
+        'ldap_hosts': 'ldap.example.com',
+        'binddn': 'uid=reporting,ou=users,dc=example,dc=com',
+        'bindpw': 'password',
+        'basedn': 'ou=users,dc=redhat,dc=com',
+        'basedndeleted': 'ou=deleted,dc=redhat,dc=com',
+        'searchattribute': 'uid,mail,cn,givenName,sn,title,rhatCostCenter,rhatGeo,manager',
+    },
+    'gpte-ipa-secrets': {
+        'ldap_hosts': 'ipa.example.com',
+        'binddn': 'uid=reporting,cn=users,cn=accounts,dc=example,dc=com',
+        'bindpw': 'password',
+        'basedn': 'cn=users,cn=accounts,dc=example,dc=com',
+        'searchattribute': 'uid,mail,cn,givenName,sn,title',
+    },
+}
+
+# Managers at the top of the org chart, ldap_user_headcount stops there
+top_level_managers = ['bod', 'pcormier', 'mhicks']
+
+
+def simulated_latency(milliseconds):
+    if milliseconds:
+        time.sleep(milliseconds / 1000.0)
+
+
+class FakeApiException(Exception):
+    def __init__(self, status):
+        super().__init__(f"({status})")
+        self.status = status
+
+
+class FakeCustomObjectsApi(object):
+    """Serve ResourceClaims recorded in the corpus."""
+
+    def __init__(self, latency_ms=0):
+        self.latency_ms = latency_ms
+        self.resource_claims = {}
+        self.calls = 0
+
+    def add_resource_claim(self, resource_claim):
+        metadata = resource_claim.get('metadata', {})
+        self.resource_claims[(metadata.get('namespace'), metadata.get('name'))] = resource_claim
+
+    def get_namespaced_custom_object(self, group, version, namespace, plural, name, **_):
+        self.calls += 1
+        simulated_latency(self.latency_ms)
+        resource_claim = self.resource_claims.get((namespace, name))
+        if resource_claim is None:
+            raise FakeApiException('404')
+        resource_claim = copy.deepcopy(resource_claim)
+        # managedFields is stripped before the ResourceClaim is stored, the API always returns it
+        resource_claim['metadata'].setdefault('managedFields', [])
+        return resource_claim
+
+
+class FakeTowerResponse(object):
+    def __init__(self, data):
+        self.data = data
+        self.status_code = 200
+
+    def json(self):
+        return self.data
+
+
+class FakeTower(object):
+    """Stand-in for the `requests` module used to fetch Tower jobs."""
+
+    def __init__(self, latency_ms=0):
+        self.latency_ms = latency_ms
+        self.jobs = {}
+        self.calls = 0
+
+    def add_job(self, job_id, extra_vars, status='successful'):
+        self.jobs[str(job_id)] = {'id': job_id, 'status': status, 'extra_vars': json.dumps(extra_vars)}
+
+    def get(self, url, **_):
+        self.calls += 1
+        simulated_latency(self.latency_ms)
+        job_id = url.rstrip('/').rsplit('/', 1)[-1]
+        return FakeTowerResponse(self.jobs.get(job_id, {'status': 'running', 'extra_vars': '{}'}))
+
+
+class FakeLdapConnection(object):
+    """Answer corp and IPA LDAP searches with a synthetic org chart.
+
+    Every user reports to `mgr-<uid>`, who reports to a top level manager, so
+    ldap_user_headcount recurses like it does against the real directory.
+    """
+    search_re = re.compile(r'\((?:mail|uid|rhatPreferredAlias)=([^)@]+)')
+
+    def __init__(self, latency_ms=0):
+        self.latency_ms = latency_ms
+        self.pending = {}
+        self.msgid = 0
+        self.calls = 0
+        self.protocol_version = 3
+
+    def simple_bind_s(self, *_):
+        return None
+
+    def set_option(self, *_):
+        return None
+
+    def search(self, basedn, scope, search_filter, attributes=None):
+        import ldap
+
+        self.calls += 1
+        simulated_latency(self.latency_ms)
+        self.msgid += 1
+        if 'cn=groups' in basedn:
+            entries = [(f"cn=rhpds-geo-na,{basedn}", {'cn': [b'rhpds-geo-na']})]
+        else:
+            match = self.search_re.search(search_filter)
+            uid = match.group(1) if match else 'unknown'
+            entries = [(f"uid={uid},{basedn}", self.user_entry(uid))]
+        self.pending[self.msgid] = [(ldap.RES_SEARCH_ENTRY, entries), (ldap.RES_SEARCH_RESULT, [])]
+        return self.msgid
+
+    def search_ext(self, basedn, scope, search_filter, attributes=None, serverctrls=None):
+        """Batch search, one entry per value of the OR filter in a single page."""
+        import ldap
+
+        self.calls += 1
+        simulated_latency(self.latency_ms)
+        self.msgid += 1
+        uids = sorted(set(self.search_re.findall(search_filter)))
+        entries = [(f"uid={uid},{basedn}", self.user_entry(uid)) for uid in uids]
+        self.pending[self.msgid] = [(ldap.RES_SEARCH_RESULT, entries, self.msgid, [])]
+        return self.msgid
+
+    def result3(self, msgid, all=1, timeout=None):
+        return self.pending.pop(msgid)[0]
+
+    def result(self, msgid, all=1, timeout=None):
+        pending = self.pending[msgid]
+        if len(pending) == 1:
+            del self.pending[msgid]
+        return pending.pop(0)
+
+    def user_entry(self, uid):
+        if uid.startswith('mgr-'):
+            manager = top_level_managers[len(uid) % len(top_level_managers)]
+        else:
+            manager = f"mgr-{uid}"
+        return {
+            'uid': [uid.encode()],
+            'mail': [f"{uid}@redhat.com".encode()],
+            'cn': [uid.replace('-', ' ').title().encode()],
+            'givenName': [uid.split('-')[0].encode()],
+            'sn': [uid.split('-')[-1].encode()],
+            'title': [b'Engineer'],
+            'rhatCostCenter': [b'700'],
+            'rhatGeo': [b'NA'],
+            'manager': [f"uid={manager},ou=users,dc=redhat,dc=com".encode()],
+        }
+
+
+class FakeDatabase(object):
+    """In-memory replacement of utils.execute_query.
+
+    Keeps just enough state (lifecycle log) for the handler to take the same
+    branches it takes against PostgreSQL.
+    """
+
+    def __init__(self, latency_ms=0):
+        import metrics
+
+        self.statement_labels = metrics.statement_labels
+        self.latency_ms = latency_ms
+        self.lifecycle = {}
+        self.next_id = 1
+
+    def execute_query(self, query, positional_args=None, autocommit=False, **_):
+        simulated_latency(self.latency_ms)
+        table, kind = self.statement_labels(query)
+        positional_args = positional_args or []
+        query_result = []
+
+        if table == 'lifecycle_log' and kind == 'SELECT':
+            state = self.lifecycle.get(positional_args[0])
+            if state:
+                query_result = [{'max': None, 'state': state}]
+        elif table == 'lifecycle_log' and kind == 'INSERT':
+            # Only inserted when the state changed, see utils.lifecycle_insert_query
+            if self.lifecycle.get(positional_args[0]) != positional_args[1]:
+                self.lifecycle[positional_args[0]] = positional_args[1]
+                query_result = [{'id': self.new_id()}]
+        elif 'RETURNING' in query:
+            returning = query.rsplit('RETURNING', 1)[1].strip(' ;\n')
+            query_result = [{field.strip(): self.new_id() for field in returning.split(',')}]
+
+        return dict(
+            changed=kind != 'SELECT',
+            query=query,
+            query_list=[query],
+            statusmessage=f"{kind} {len(query_result)}",
+            query_result=query_result,
+            query_all_results=[query_result],
+            rowcount=len(query_result),
+            elapsed=0.0,
+        )
+
+    def new_id(self):
+        self.next_id += 1
+        return self.next_id
+
+
+class StatementCounter(object):
+    """Wrap execute_query to count the statements sent to the database."""
+
+    def __init__(self, execute_query):
+        self.execute_query = execute_query
+        self.statements = 0
+
+    def __call__(self, query, *args, **kwargs):
+        self.statements += 1
+        return self.execute_query(query, *args, **kwargs)
+
+
+def load_operator():
+    """Import operator/operator.py, the kube config is only loaded by its startup handler.
+
+    Returns:
+        module: the operator module, imported as `reporting_operator`.
+    """
+    if 'reporting_operator' in sys.modules:
+        return sys.modules['reporting_operator']
+
+    spec = importlib.util.spec_from_file_location('reporting_operator', os.path.join(operator_dir, 'operator.py'))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['reporting_operator'] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def install_fakes(k8s_latency_ms=0, tower_latency_ms=0, ldap_latency_ms=0, db_latency_ms=0, database=True):
+    """Load the operator and replace its external dependencies with fakes.
+
+    Args:
+        database (bool): Replace utils.execute_query with FakeDatabase. When False
+            statements go to the PostgreSQL server given by the PG* environment variables.
+
+    Returns:
+        dict: operator module, the fakes and the statement counter, keyed by name.
+    """
+    import ldap
+    import resilience
+    import utils
+    from ratelimit import TokenBucket
+
+    op = load_operator()
+
+    op.ansible_tower_hostname = 'tower.example.com'
+    op.ansible_tower_user = 'reporting'
+    op.ansible_tower_password = 'password'
+
+    k8s = FakeCustomObjectsApi(k8s_latency_ms)
+    tower = FakeTower(tower_latency_ms)
+    ldap_conn = FakeLdapConnection(ldap_latency_ms)
+
+    op.custom_objects_api = k8s
+    op.requests = tower
+    op.ApiException = FakeApiException
+    ldap.initialize = lambda uri: ldap_conn
+    utils.get_secret_data = lambda secret_name, secret_namespace=None: dict(fake_secrets.get(secret_name, {}))
+    # The fakes answer instantly, the rate limits would only measure the token buckets
+    for dependency in resilience.dependencies.values():
+        dependency.limiter = TokenBucket(0)
+
+    if database:
+        db = StatementCounter(FakeDatabase(db_latency_ms).execute_query)
+    else:
+        # psycopg2 reads PGHOST, PGUSER, PGDATABASE... when no parameter is given
+        utils.get_conn_params = lambda secret_name='gpte-db-secrets': {}
+        db = StatementCounter(utils.execute_query)
+    utils.execute_query = db
+
+    return {'operator': op, 'k8s': k8s, 'tower': tower, 'ldap': ldap_conn, 'db': db}
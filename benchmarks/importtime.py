@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""Check the import time of the operator modules against a budget.
+
+Each module is imported in a fresh interpreter, the best of --repeat runs is
+compared with its budget in benchmarks/baselines/importtime.json:
+
+    python benchmarks/importtime.py               # check every module with a budget
+    python benchmarks/importtime.py -k ldap       # only modules matching a substring
+    python benchmarks/importtime.py --profile     # also show the slowest imports
+
+The command exits with status 1 when a module is over its budget. The slowest
+imports reported by `python -X importtime` are listed for those modules.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+operator_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'operator')
+default_budgets = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines', 'importtime.json')
+
+# Append, do not prepend, operator.py would shadow the standard library operator module
+import_script = """
+import importlib.util, sys, time
+sys.path.append({operator_dir!r})
+started = time.perf_counter()
+if {module!r} == 'operator':
+    spec = importlib.util.spec_from_file_location('reporting_operator', {operator_path!r})
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['reporting_operator'] = module
+    spec.loader.exec_module(module)
+else:
+    importlib.import_module({module!r})
+print(time.perf_counter() - started)
+"""
+
+
+def import_seconds(module, importtime=False):
+    """Import the module in a new interpreter.
+
+    Returns:
+        (seconds, stderr): Import time, and the `-X importtime` report when requested.
+    """
+    script = import_script.format(operator_dir=operator_dir, module=module,
+                                  operator_path=os.path.join(operator_dir, 'operator.py'))
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', script]
+    # Run outside of the operator directory, it must not be first in sys.path
+    result = subprocess.run(command, capture_output=True, text=True, cwd=os.path.dirname(operator_dir))
+    if result.returncode != 0:
+        raise RuntimeError(f"Unable to import {module}: {result.stderr.strip().splitlines()[-1]}")
+    return float(result.stdout.strip().splitlines()[-1]), result.stderr
+
+
+def slowest_imports(report, limit=10):
+    """Parse a `-X importtime` report.
+
+    Returns:
+        list: (cumulative microseconds, package) of the slowest top level imports.
+    """
+    imports = []
+    for line in report.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if cumulative.strip().isdigit() and not name.startswith('   '):
+            imports.append((int(cumulative), name.strip()))
+    return sorted(imports, reverse=True)[:limit]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-k', dest='pattern', help='Only check modules whose name contains this substring')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of imports per module, the best is kept')
+    parser.add_argument('--budgets', default=default_budgets, help='Budgets file, module -> milliseconds')
+    parser.add_argument('--profile', action='store_true', help='Show the slowest imports of every module')
+    args = parser.parse_args()
+
+    with open(args.budgets) as fh:
+        budgets = json.load(fh)['budgets_ms']
+
+    over_budget = []
+    for module, budget in sorted(budgets.items()):
+        if args.pattern and args.pattern not in module:
+            continue
+        milliseconds = min(import_seconds(module)[0] for _ in range(args.repeat)) * 1000
+        line = f"{module:>20}: {milliseconds:8.1f} ms  (budget {budget} ms)"
+        if milliseconds > budget:
+            over_budget.append(module)
+            line += '  OVER BUDGET'
+        print(line)
+
+        if args.profile or milliseconds > budget:
+            for cumulative, name in slowest_imports(import_seconds(module, importtime=True)[1]):
+                print(f"{'':>22}{cumulative / 1000:8.1f} ms  {name}")
+
+    if over_budget:
+        print(f"Over budget: {', '.join(over_budget)}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""Microbenchmarks of the pure functions run on every AnarchySubject event.
+
+    python benchmarks/micro.py                 # run and compare with the stored baseline
+    python benchmarks/micro.py --save          # store the results as the new baseline
+    python benchmarks/micro.py -k timestamp    # run benchmarks matching a substring
+
+The command exits with status 1 when a benchmark is slower than the baseline
+by more than --tolerance. Baselines are machine dependent, regenerate them
+with --save on the machine used for comparisons.
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import sys
+import timeit
+
+import harness
+
+fixtures_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+default_baseline = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines', 'micro.json')
+
+
+def load_fixture(name):
+    with open(os.path.join(fixtures_dir, f"{name}.json")) as fh:
+        return json.load(fh)
+
+
+def build_benchmarks():
+    """Return a dict of benchmark name -> zero argument callable."""
+    import snapshots
+    import utils
+
+    op = harness.load_operator()
+
+    anarchy_subject = load_fixture('anarchy_subject')
+    resource_claim = load_fixture('resource_claim')
+    tower_extra_vars = load_fixture('tower_extra_vars')
+
+    resource_vars = op.get_resource_vars(anarchy_subject)
+    provision = op.map_provision(resource_vars, resource_claim, tower_extra_vars, 'successful')
+    provision_fields = {k: v for (k, v) in provision.items() if not isinstance(v, dict)}
+    pg_array_args = [provision['uuid'], ['ocp4_workload_authentication', 'ocp4_workload_le_certificates'],
+                     provision['class_name'], [1, 2, 3], provision['cloud_region']] * 4
+    ldap_result = [(
+        'uid=jdoe,ou=users,dc=redhat,dc=com',
+        harness.FakeLdapConnection().user_entry('jdoe'),
+    )]
+    start_timestamp = resource_vars['provision_job']['startTimestamp']
+
+    return {
+        'get_resource_vars': lambda: op.get_resource_vars(anarchy_subject),
+        'map_provision': lambda: op.map_provision(resource_vars, resource_claim, tower_extra_vars, 'successful'),
+        'parse_catalog_item': lambda: op.parse_catalog_item(resource_vars['resource_label_governor']),
+        'create_sql_statement': lambda: utils.create_sql_statement(
+            provision_fields, provision_fields, 'provisions', 'provisions_pk', 'uuid'),
+        'normalize_timestamp': lambda: utils.normalize_timestamp(start_timestamp),
+        # convert_elements_to_pg_arrays converts in place, work on a copy
+        'convert_elements_to_pg_arrays': lambda: utils.convert_elements_to_pg_arrays(list(pg_array_args)),
+        'parse_ldap_result': lambda: utils.parse_ldap_result(ldap_result),
+        'serialize_anarchy_subject': lambda: snapshots.dump_snapshot(anarchy_subject, 'anarchy_subject'),
+        'serialize_resource_claim': lambda: snapshots.dump_snapshot(resource_claim, 'resource_claim'),
+        'serialize_tower_extra_vars': lambda: snapshots.dump_snapshot(tower_extra_vars, 'tower_extra_vars'),
+        'serialize_provision_vars': lambda: snapshots.dump_snapshot(provision, 'provision_vars'),
+    }
+
+
+def measure(func, repeat):
+    """Best time per call in nanoseconds."""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-k', dest='pattern', help='Only run benchmarks whose name contains this substring')
+    parser.add_argument('--repeat', type=int, default=7, help='Number of timing rounds, the best is kept')
+    parser.add_argument('--baseline', default=default_baseline, help='Baseline file')
+    parser.add_argument('--save', action='store_true', help='Store the results in the baseline file')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='Allowed slowdown compared to the baseline (0.5 = 50%%)')
+    args = parser.parse_args()
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as fh:
+            baseline = json.load(fh).get('results', {})
+
+    results = {}
+    regressions = []
+    # Some of the benchmarked functions print to stdout
+    with open(os.devnull, 'w') as devnull:
+        with contextlib.redirect_stdout(devnull):
+            benchmarks = build_benchmarks()
+
+        for name, func in benchmarks.items():
+            if args.pattern and args.pattern not in name:
+                continue
+            with contextlib.redirect_stdout(devnull):
+                results[name] = measure(func, args.repeat)
+
+            line = f"{name:>32}: {results[name]:12.1f} ns"
+            if name in baseline:
+                change = (results[name] - baseline[name]) / baseline[name]
+                line += f"  ({change * 100:+.1f}% vs baseline)"
+                if change > args.tolerance:
+                    regressions.append(name)
+                    line += '  REGRESSION'
+            print(line)
+
+    if args.save:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        baseline.update(results)
+        with open(args.baseline, 'w') as fh:
+            json.dump({
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'results': {k: round(v, 1) for (k, v) in sorted(baseline.items())},
+            }, fh, indent=2)
+            fh.write('\n')
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+
+    if regressions:
+        print(f"Regressions: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
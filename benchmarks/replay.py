@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""Replay recorded AnarchySubject events through anarchysubject_event.
+
+Export a corpus from resource_claim_log (requires access to the cluster and
+the reporting database):
+
+    python benchmarks/replay.py export --output corpus.jsonl --limit 1000
+
+Replay it against local stand-ins of Kubernetes, Tower, LDAP and PostgreSQL:
+
+    python benchmarks/replay.py run corpus.jsonl --repeat 5 --output result.json
+    python benchmarks/replay.py run corpus.jsonl --baseline result.json
+
+Use --postgres to send statements to a local PostgreSQL server configured
+with the standard PG* environment variables instead of the in-memory shim.
+"""
+import argparse
+import contextlib
+import json
+import logging
+import os
+import sys
+import time
+
+import harness
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a sorted list."""
+    if not values:
+        return 0.0
+    index = max(0, min(len(values) - 1, int(round(pct / 100.0 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def export_corpus(args):
+    import kube_client
+    import snapshots
+    import utils
+
+    kube_client.load_config()
+
+    query = "SELECT provision_uuid, anarchy_subject_json, resource_claim_json, tower_extra_vars_json \n" \
+            "FROM resource_claim_log \n" \
+            "WHERE anarchy_subject_json IS NOT NULL \n" \
+            "ORDER BY created_at DESC \n" \
+            "LIMIT %s;"
+    exported = 0
+    with open(args.output, 'w') as fh:
+        for row in utils.stream_query(query, positional_args=[args.limit]):
+            exported += 1
+            fh.write(json.dumps({
+                'provision_uuid': row['provision_uuid'],
+                'anarchy_subject_json': snapshots.load_snapshot(row['anarchy_subject_json']),
+                'resource_claim_json': snapshots.load_snapshot(row['resource_claim_json']),
+                'tower_extra_vars_json': snapshots.load_snapshot(row['tower_extra_vars_json']),
+            }) + '\n')
+
+    print(f"Exported {exported} events to {args.output}")
+
+
+def load_corpus(path, fakes):
+    """Read the corpus and register its ResourceClaims and Tower jobs in the fakes.
+
+    Returns:
+        list: AnarchySubject events
+    """
+    events = []
+    with open(path) as fh:
+        for line in fh:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            anarchy_subject = record['anarchy_subject_json']
+            resource_claim = record.get('resource_claim_json')
+            tower_extra_vars = record.get('tower_extra_vars_json')
+
+            if resource_claim:
+                metadata = resource_claim.setdefault('metadata', {})
+                annotations = anarchy_subject['metadata'].get('annotations', {})
+                metadata.setdefault('namespace', annotations.get(
+                    f"{fakes['operator'].poolboy_domain}/resource-claim-namespace"))
+                metadata.setdefault('name', annotations.get(
+                    f"{fakes['operator'].poolboy_domain}/resource-claim-name"))
+                fakes['k8s'].add_resource_claim(resource_claim)
+
+            tower_jobs = anarchy_subject.get('status', {}).get('towerJobs', {})
+            job_id = tower_jobs.get('provision', {}).get('deployerJob')
+            if job_id:
+                fakes['tower'].add_job(job_id, tower_extra_vars or {})
+
+            events.append(anarchy_subject)
+    return events
+
+
+def run_replay(args):
+    fakes = harness.install_fakes(k8s_latency_ms=args.k8s_latency, tower_latency_ms=args.tower_latency,
+                                  ldap_latency_ms=args.ldap_latency, db_latency_ms=args.db_latency,
+                                  database=not args.postgres)
+    op = fakes['operator']
+    db = fakes['db']
+    events = load_corpus(args.corpus, fakes)
+    if not events:
+        print(f"No events in {args.corpus}")
+        return 1
+
+    logger = logging.getLogger('replay')
+    logger.setLevel(logging.CRITICAL)
+
+    latencies = []
+    statements = []
+    errors = 0
+    filtered = 0
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for _ in range(args.warmup):
+            op.anarchysubject_event(event={'type': 'MODIFIED', 'object': json.loads(json.dumps(events[0]))},
+                                    logger=logger)
+
+        started = time.perf_counter()
+        for _ in range(args.repeat):
+            for anarchy_subject in events:
+                event = {'type': 'MODIFIED', 'object': json.loads(json.dumps(anarchy_subject))}
+                statements_before = db.statements
+                event_start = time.perf_counter()
+                try:
+                    # kopf only calls the handler when the watch filter accepts the object
+                    if op.anarchy_subject_filter(body=event['object']):
+                        op.anarchysubject_event(event=event, logger=logger)
+                    else:
+                        filtered += 1
+                except Exception:
+                    errors += 1
+                latencies.append(time.perf_counter() - event_start)
+                statements.append(db.statements - statements_before)
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    result = {
+        'events': len(latencies),
+        'errors': errors,
+        'filtered': filtered,
+        'seconds': elapsed,
+        'events_per_second': len(latencies) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'statements_per_event': sum(statements) / len(statements),
+        'k8s_calls': fakes['k8s'].calls,
+        'tower_calls': fakes['tower'].calls,
+        'ldap_searches': fakes['ldap'].calls,
+    }
+
+    report(result, load_baseline(args.baseline))
+
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(result, fh, indent=2)
+    return 0
+
+
+def load_baseline(path):
+    if not path:
+        return None
+    with open(path) as fh:
+        return json.load(fh)
+
+
+def report(result, baseline=None):
+    for key, value in result.items():
+        line = f"{key:>22}: {value:12.3f}" if isinstance(value, float) else f"{key:>22}: {value:12d}"
+        if baseline and baseline.get(key):
+            line += f"  ({(value - baseline[key]) / baseline[key] * 100:+.1f}% vs baseline)"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = subparsers.add_parser('export', help='Export a corpus from resource_claim_log')
+    export_parser.add_argument('--output', required=True, help='Corpus file (JSON lines)')
+    export_parser.add_argument('--limit', type=int, default=1000, help='Number of provisions to export')
+
+    run_parser = subparsers.add_parser('run', help='Replay a corpus against local stand-ins')
+    run_parser.add_argument('corpus', help='Corpus file (JSON lines)')
+    run_parser.add_argument('--repeat', type=int, default=1, help='Number of passes over the corpus')
+    run_parser.add_argument('--warmup', type=int, default=5, help='Events handled before measuring')
+    run_parser.add_argument('--k8s-latency', type=float, default=0, help='Simulated Kubernetes latency (ms)')
+    run_parser.add_argument('--tower-latency', type=float, default=0, help='Simulated Tower latency (ms)')
+    run_parser.add_argument('--ldap-latency', type=float, default=0, help='Simulated LDAP latency per search (ms)')
+    run_parser.add_argument('--db-latency', type=float, default=0,
+                            help='Simulated latency per statement of the in-memory database (ms)')
+    run_parser.add_argument('--postgres', action='store_true',
+                            help='Use the PostgreSQL server from the PG* environment variables')
+    run_parser.add_argument('--output', help='Write the results as JSON')
+    run_parser.add_argument('--baseline', help='Compare with results previously written with --output')
+
+    args = parser.parse_args()
+    if args.command == 'export':
+        export_corpus(args)
+        return 0
+    return run_replay(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""Self-checks of the pure functions the benchmarks rely on being correct.
+
+    python benchmarks/selfcheck.py
+
+Faster code is only useful if it computes the same results: this checks the
+invariants of the snapshot history JSON patches and of the shard hash ring.
+The command exits with status 1 when a check fails.
+"""
+import copy
+import sys
+import uuid
+
+import harness  # noqa: F401 adds the operator directory to sys.path
+
+# (name, old, new) pairs, json_diff() then apply_patch() must turn old into new
+patch_cases = [
+    ('unchanged', {'a': 1}, {'a': 1}),
+    ('add remove replace', {'a': 1, 'b': 2}, {'a': 3, 'c': 4}),
+    ('nested', {'metadata': {'labels': {'x': '1'}}}, {'metadata': {'labels': {'x': '2', 'y': '3'}}}),
+    ('key with /', {'metadata': {'annotations': {'babylon/uid': 'a'}}},
+     {'metadata': {'annotations': {'babylon/uid': 'b', 'anarchy/x': 'c'}}}),
+    ('key with ~', {'a~b': 1, '~1': 2}, {'a~b': 3, '~01': 4}),
+    ('key with ~ and /', {'a~/b': {'c': 1}}, {'a~/b': {'c': 2}, '/~': None}),
+    ('empty key', {'': 1}, {'': 2}),
+    ('root replaced by a list', {'a': 1}, [1, 2]),
+    ('root replaced by a scalar', {'a': 1}, 'a'),
+    ('root replaced by a dict', None, {'a': 1}),
+    ('list replaced', {'runs': [1, 2, 3]}, {'runs': [1, 3]}),
+    ('list of dicts replaced', {'jobs': [{'id': 1}, {'id': 2}]}, {'jobs': [{'id': 1, 'status': 'ok'}]}),
+    ('dict replaced by a list', {'a': {'b': 1}}, {'a': [1]}),
+]
+
+
+def check_patches():
+    from snapshot_history import apply_patch, json_diff
+
+    failures = []
+    for name, old, new in patch_cases:
+        operations = json_diff(old, new)
+        try:
+            # apply_patch() modifies its argument, keep the case intact for the report
+            patched = apply_patch(copy.deepcopy(old), operations)
+        except Exception as e:
+            failures.append(f"apply_patch {name}: {operations!r} raised {e!r}")
+            continue
+        if patched != new:
+            failures.append(f"json_diff/apply_patch {name}: {old!r} -> {new!r} gave {patched!r} with {operations!r}")
+        if old == new and operations:
+            failures.append(f"json_diff {name}: operations for an unchanged object {operations!r}")
+    return failures
+
+
+def check_ring_movement():
+    """Adding or removing a member only moves keys to or from that member, about 1/n of them."""
+    from sharding import HashRing
+
+    keys = [str(uuid.UUID(int=i * 7919 + 1)) for i in range(20000)]
+    members = [f"babylon-reporting-{i}" for i in range(4)]
+    failures = []
+
+    ring = HashRing(members)
+    owners = {key: ring.owner(key) for key in keys}
+    for member in members:
+        share = sum(1 for owner in owners.values() if owner == member) / len(keys)
+        if not 0.5 / len(members) < share < 1.5 / len(members):
+            failures.append(f"HashRing balance: {member} owns {share:.1%} of the keys")
+
+    grown = HashRing(members + ['babylon-reporting-new'])
+    moved = [key for key in keys if grown.owner(key) != owners[key]]
+    if any(grown.owner(key) != 'babylon-reporting-new' for key in moved):
+        failures.append("HashRing add: keys moved between the existing members")
+    if not 0.5 / len(grown.members) < len(moved) / len(keys) < 1.5 / len(grown.members):
+        failures.append(f"HashRing add: {len(moved) / len(keys):.1%} of the keys moved")
+
+    shrunk = HashRing(members[1:])
+    moved = [key for key in keys if shrunk.owner(key) != owners[key]]
+    if any(owners[key] != members[0] for key in moved):
+        failures.append("HashRing remove: keys of the remaining members moved")
+    if len(moved) != sum(1 for owner in owners.values() if owner == members[0]):
+        failures.append("HashRing remove: keys of the removed member kept")
+
+    if HashRing(reversed(members)).owners != ring.owners:
+        failures.append("HashRing: owners depend on the order of the members")
+    return failures
+
+
+checks = {
+    'snapshot patches': check_patches,
+    'shard ring movement': check_ring_movement,
+}
+
+
+def main():
+    failed = False
+    for name, check in checks.items():
+        failures = check()
+        print(f"{name:>32}: {'FAILED' if failures else 'ok'}")
+        for failure in failures:
+            print(f"    {failure}")
+        failed = failed or bool(failures)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
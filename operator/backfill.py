@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""Reconcile the reporting database with every AnarchySubject in the cluster.
+
+AnarchySubjects are listed in pages and handled by the same pipeline as the
+operator events (process_anarchysubject_event) on a pool of worker threads.
+Those failing because a dependency is unavailable are not checkpointed, a
+resumed run handles them again. The
+resource_claim_log snapshot writes are batched, and progress is checkpointed
+after each page so an interrupted run resumes where it stopped:
+
+    python backfill.py --workers 16 --checkpoint /tmp/backfill.json
+    python backfill.py --checkpoint /tmp/backfill.json            # resume
+    python backfill.py --checkpoint /tmp/backfill.json --restart  # start over
+"""
+import os
+import sys
+
+if __name__ == '__main__':
+    # operator.py would shadow the standard library operator module, move this directory last
+    sys.path.append(sys.path.pop(0))
+
+import argparse
+import importlib.util
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import logs
+import snapshot_history
+import utils
+from corp_ldap import prefetch_users
+from resilience import DependencyUnavailable
+
+backfill_workers = int(os.environ.get('BACKFILL_WORKERS', 8))
+backfill_page_size = int(os.environ.get('BACKFILL_PAGE_SIZE', 500))
+# Number of queued snapshot statements written in a single transaction
+backfill_batch_size = int(os.environ.get('BACKFILL_BATCH_SIZE', 200))
+
+logger = logs.get_logger('backfill')
+
+
+def load_operator():
+    """Load operator.py, it cannot be imported as `operator`."""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'operator.py')
+    spec = importlib.util.spec_from_file_location('reporting_operator', path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['reporting_operator'] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+class Checkpoint(object):
+    """Continue token of the next page and UIDs of the AnarchySubjects already handled."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.continue_token = None
+        self.processed = 0
+        self.errors = 0
+        self.done = set()
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return False
+        with open(self.path) as fh:
+            data = json.load(fh)
+        self.continue_token = data.get('continue')
+        self.processed = data.get('processed', 0)
+        self.errors = data.get('errors', 0)
+        self.done = set(data.get('done', []))
+        return True
+
+    def save(self):
+        if not self.path:
+            return
+        # Write to a temporary file first so an interrupted write does not lose the checkpoint
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as fh:
+            json.dump({
+                'continue': self.continue_token,
+                'processed': self.processed,
+                'errors': self.errors,
+                'done': sorted(self.done),
+            }, fh)
+        os.replace(tmp_path, self.path)
+
+
+class Backfill(object):
+    def __init__(self, op, checkpoint, workers=None, page_size=None, batch_size=None, label_selector=None,
+                 select=None, batch_writes=True):
+        self.op = op
+        self.checkpoint = checkpoint
+        self.workers = workers or backfill_workers
+        self.page_size = page_size or backfill_page_size
+        self.batch_size = batch_size or backfill_batch_size
+        self.label_selector = label_selector
+        # Optional predicate on the AnarchySubjects to handle
+        self.select = select
+        # Do not batch the snapshot writes when running inside the operator, next to the event handlers
+        self.batch_writes = batch_writes
+        self.started = None
+
+    def list_page(self, continue_token):
+        kwargs = {'limit': self.page_size}
+        if continue_token:
+            kwargs['_continue'] = continue_token
+        if self.label_selector:
+            kwargs['label_selector'] = self.label_selector
+        return self.op.custom_objects_api.list_cluster_custom_object(
+            self.op.anarchy_domain, self.op.anarchy_api_version, 'anarchysubjects', **kwargs
+        )
+
+    def handle(self, anarchy_subject):
+        """Run one AnarchySubject through the operator pipeline.
+
+        Returns:
+            result (str): ok, error if the pipeline raised an exception, or unavailable
+                if a dependency was unavailable and the AnarchySubject must be handled again.
+        """
+        try:
+            self.op.process_anarchysubject_event(event={'type': 'MODIFIED', 'object': anarchy_subject},
+                                                 logger=logger)
+            return 'ok'
+        except DependencyUnavailable as e:
+            logger.error(f"Unable to reconcile {anarchy_subject['metadata'].get('namespace')}/"
+                         f"{anarchy_subject['metadata'].get('name')}, left for the next run: {e}")
+            return 'unavailable'
+        except Exception as e:
+            logger.error(f"Unable to reconcile {anarchy_subject['metadata'].get('namespace')}/"
+                         f"{anarchy_subject['metadata'].get('name')}: {e}")
+            return 'error'
+
+    def requester(self, anarchy_subject):
+        try:
+            return self.op.get_resource_vars(anarchy_subject).get('resource_claim_requester')
+        except Exception:
+            # Reported when the AnarchySubject is handled
+            return None
+
+    def process_page(self, executor, items):
+        items = [item for item in items if item['metadata']['uid'] not in self.checkpoint.done
+                 and (self.select is None or self.select(item))]
+        # A few batch LDAP searches instead of one per requester and manager
+        prefetch_users([self.requester(item) for item in items], logger)
+        for item, result in zip(items, executor.map(self.handle, items)):
+            self.checkpoint.processed += 1
+            if result != 'ok':
+                self.checkpoint.errors += 1
+            # A resumed run handles again the AnarchySubjects which could not be reconciled for now
+            if result != 'unavailable':
+                self.checkpoint.done.add(item['metadata']['uid'])
+            if self.batch_writes and utils.pending_deferred_writes() >= self.batch_size:
+                utils.flush_deferred_writes()
+        if self.batch_writes:
+            utils.flush_deferred_writes()
+
+    def report(self):
+        elapsed = time.monotonic() - self.started
+        rate = self.checkpoint.processed / elapsed if elapsed else 0.0
+        logger.info(f"Reconciled {self.checkpoint.processed} provisions, {self.checkpoint.errors} errors, "
+                    f"{elapsed:.0f}s, {rate:.1f} provisions/s")
+
+    def run(self):
+        self.started = time.monotonic()
+        if self.batch_writes:
+            utils.defer_writes()
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                while True:
+                    try:
+                        page = self.list_page(self.checkpoint.continue_token)
+                    except self.op.ApiException as e:
+                        if e.status != 410 or not self.checkpoint.continue_token:
+                            raise
+                        # The continue token expired, list again and skip the AnarchySubjects already done
+                        logger.warning("Continue token expired, restarting the listing")
+                        self.checkpoint.continue_token = None
+                        continue
+
+                    self.process_page(executor, page.get('items', []))
+                    self.checkpoint.continue_token = page.get('metadata', {}).get('continue')
+                    self.checkpoint.save()
+                    self.report()
+
+                    if not self.checkpoint.continue_token:
+                        break
+        finally:
+            if self.batch_writes:
+                utils.flush_deferred_writes(stop=True)
+
+        return self.checkpoint
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=backfill_workers, help='Number of worker threads')
+    parser.add_argument('--page-size', type=int, default=backfill_page_size,
+                        help='AnarchySubjects listed per request')
+    parser.add_argument('--batch-size', type=int, default=backfill_batch_size,
+                        help='Snapshot statements written per transaction')
+    parser.add_argument('--label-selector', help='Only reconcile AnarchySubjects matching this label selector')
+    parser.add_argument('--checkpoint', help='Checkpoint file used to resume an interrupted run')
+    parser.add_argument('--restart', action='store_true', help='Ignore the existing checkpoint')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    op = load_operator()
+    op.load_kube_config()
+    op.load_tower_credentials()
+    if snapshot_history.snapshot_history_enabled:
+        snapshot_history.create_history_table()
+    # Imported here, enrichment imports recompute which imports this module
+    import enrichment
+    if enrichment.enrichment_enabled:
+        enrichment.create_queue_table()
+
+    checkpoint = Checkpoint(args.checkpoint)
+    if not args.restart and checkpoint.load():
+        logger.info(f"Resuming from {args.checkpoint}, {checkpoint.processed} provisions already reconciled")
+
+    backfill = Backfill(op, checkpoint, workers=args.workers, page_size=args.page_size,
+                        batch_size=args.batch_size, label_selector=args.label_selector)
+    backfill.run()
+    backfill.report()
+    return 1 if checkpoint.errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,6 +1,27 @@
+import threading
+import metrics
 import utils
 from datetime import datetime, timezone
 
+# (catalog_item, catalog_name, class_name, infra_type) -> catalog_items id
+_catalog_items_cache = {}
+_catalog_items_cache_lock = threading.Lock()
+
+
+def load_catalog_items_cache():
+    """Read the catalog_items table into the cache.
+
+    Returns:
+        count (int): Number of catalog items cached.
+    """
+    query = "SELECT id, catalog_item, catalog_name, class_name, infra_type FROM catalog_items"
+    result = utils.execute_query(query, autocommit=True)
+    with _catalog_items_cache_lock:
+        for row in result['query_result']:
+            key = (row['catalog_item'], row['catalog_name'], row['class_name'], row['infra_type'])
+            _catalog_items_cache[key] = row['id']
+    return len(_catalog_items_cache)
+
 
 class CatalogItems(object):
 
@@ -20,6 +41,14 @@ class CatalogItems(object):
         catalog_name = self.prov_data.get('catalog_name', '')
         class_name = self.prov_data.get('class_name', None)
 
+        # Nothing to update when the catalog item is already stored with the same values
+        cache_key = (catalog_item, catalog_name, class_name, catalog_type)
+        catalog_id = _catalog_items_cache.get(cache_key)
+        if catalog_id is not None:
+            metrics.cache_hit('catalog_items')
+            return catalog_id
+        metrics.cache_miss('catalog_items')
+
         insert_fields = {
             'catalog_item': catalog_item,
             'catalog_name': catalog_name,
@@ -44,10 +73,13 @@ class CatalogItems(object):
         if self.debug:
             print(f"Query Insert: \n{query}")
 
-        cur = utils.execute_query(query, positional_args=positional_args, autocommit=True)
+        cur = utils.execute_query(query, positional_args=positional_args, autocommit=True, prepare=True)
 
         if cur['rowcount'] >= 1:
             query_result = cur['query_result'][0]
-            return query_result.get('id')
+            catalog_id = query_result.get('id')
+            with _catalog_items_cache_lock:
+                _catalog_items_cache[cache_key] = catalog_id
+            return catalog_id
         else:
             return None
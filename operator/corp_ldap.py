@@ -1,31 +1,117 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
 import ldap
+from ldap.controls import SimplePagedResultsControl
+from ldap.filter import escape_filter_chars
+
+import metrics
+import tracing
 import utils
-from retrying import retry
+from ldap_pool import LdapPool, guarded, unavailable_errors
+
+# Identifiers OR-ed in the filter of one batch search
+ldap_batch_size = int(os.environ.get('LDAP_BATCH_SIZE', 50))
+# Entries per page of the batch searches
+ldap_page_size = int(os.environ.get('LDAP_PAGE_SIZE', 500))
+# Seconds a directory entry is reused without searching it again
+ldap_user_cache_ttl = float(os.environ.get('LDAP_USER_CACHE_TTL', 3600))
+ldap_user_cache_size = int(os.environ.get('LDAP_USER_CACHE_SIZE', 20000))
+# Levels of managers searched above the users by ldap_search_users()
+ldap_manager_depth = 16
+
+# Managers above whom usage is charged back to GPTE
+top_level_managers = ('bod@redhat.com', 'pcormier@redhat.com', 'mhicks@redhat.com')
+
+corp_ldap_pool = LdapPool('gpte-ldap-secrets')
+
+# (attribute, lowercase value) -> (parsed entry, cached_at), entries are found by mail, alias and uid
+_user_cache = OrderedDict()
+_user_cache_lock = threading.Lock()
+
+
+def manager_dn_email(manager_dn):
+    manager_uid = manager_dn.split(',')[0].replace('uid=', '')
+    return manager_uid + '@redhat.com'
+
+
+def cache_user_entry(entry, parsed, identifier=None):
+    """Cache a directory entry under its mails, aliases and uid, and the identifier it was searched with.
+
+    Args:
+        entry (dict): Raw entry, attribute -> list of bytes.
+        parsed (dict): Entry returned by parse_ldap_result().
+        identifier (tuple): (attribute, value) searched.
+    """
+    keys = {('mail', v.decode('utf-8').lower()) for v in entry.get('mail', []) + entry.get('rhatPreferredAlias', [])}
+    keys.update(('uid', v.decode('utf-8').lower()) for v in entry.get('uid', []))
+    if identifier:
+        keys.add((identifier[0], identifier[1].lower()))
+    now = time.monotonic()
+    with _user_cache_lock:
+        for key in keys:
+            _user_cache.pop(key, None)
+            _user_cache[key] = (dict(parsed), now)
+        while len(_user_cache) > ldap_user_cache_size:
+            _user_cache.popitem(last=False)
+
+
+def cached_user_entry(value, attribute='mail'):
+    """Get a copy of the cached entry, None if it is not cached or expired."""
+    cached = _user_cache.get((attribute, value.lower()))
+    if cached is None or time.monotonic() - cached[1] >= ldap_user_cache_ttl:
+        metrics.cache_miss('ldap_user')
+        return None
+    metrics.cache_hit('ldap_user')
+    return dict(cached[0])
+
+
+def clear_user_cache():
+    with _user_cache_lock:
+        _user_cache.clear()
+
+
+def prefetch_users(requesters, logger):
+    """Fill the user cache for the Red Hat requesters of a bulk job with batch searches.
+
+    Errors are only logged, the users are then searched one by one.
+    """
+    emails = set()
+    for requester in requesters:
+        if requester and '@redhat' in requester:
+            emails.update((requester, utils.generic_email(requester)))
+    if not emails:
+        return 0
+    try:
+        return len(GPTELdap(logger).ldap_search_users(sorted(emails)))
+    except Exception as e:
+        logger.warning(f"Unable to prefetch {len(emails)} users from LDAP: {e}")
+        return 0
 
 
 class GPTELdap(object):
 
     def __init__(self, logger):
-        self.ldap_info = utils.get_secret_data('gpte-ldap-secrets')
+        self.ldap_info = corp_ldap_pool.info
         self.ldap_hosts = self.ldap_info['ldap_hosts']
         self.ldap_binddn = self.ldap_info['binddn']
         self.ldap_bindpw = self.ldap_info['bindpw']
         self.debug = False
         self.logger = logger
+        self.ldap_pool = corp_ldap_pool
         self.ldap_conn = None
 
-    # Wait 2^x * 500 milliseconds between each retry, up to 5 seconds, then 5 seconds afterwards and 3 attempts
-    @retry(stop_max_attempt_number=3, wait_exponential_multiplier=500, wait_exponential_max=5000)
     def ldap_connect(self):
         try:
-            self.ldap_conn = ldap.initialize("ldaps://{ldap_hosts}".format(ldap_hosts=self.ldap_hosts))
-            ldap.set_option(ldap.OPT_X_TLS_REQUIRE_CERT, ldap.OPT_X_TLS_NEVER)
-            self.ldap_conn.protocol_version = ldap.VERSION3
-            self.ldap_conn.simple_bind_s(self.ldap_binddn, self.ldap_bindpw)
+            self.ldap_conn = corp_ldap_pool.connection()
         except ldap.INVALID_CREDENTIALS:
             self.logger.error("Your username or password is incorrect.")
+            raise
         except ldap.LDAPError as e:
             self.logger.error(f"Error connectint to LDAP {e}")
+            raise
 
     def parse_ldap_result(self, result_data):
         user_data = {}
@@ -35,7 +121,15 @@ class GPTELdap(object):
 
         return user_data
 
+    @tracing.traced('ldap.search_manager')
+    @guarded
     def ldap_search_manager(self, manager_email):
+        user_data = cached_user_entry(manager_email)
+        if user_data is not None:
+            return user_data
+
+        if self.ldap_conn is None:
+            self.ldap_connect()
         searchAttribute = self.ldap_info['searchattribute'].split(',')
         searchScope = ldap.SCOPE_SUBTREE
         bases_dn = [self.ldap_info['basedn'], self.ldap_info['basedndeleted']]
@@ -51,16 +145,27 @@ class GPTELdap(object):
                     else:
                         if result_type == ldap.RES_SEARCH_ENTRY:
                             user_data = self.parse_ldap_result(result_data)
+                            cache_user_entry(result_data[0][1], user_data, ('mail', manager_email))
                         return user_data
+        except unavailable_errors:
+            raise
         except ldap.LDAPError as e:
             print(e)
 
         return user_data
 
+    @tracing.traced('ldap.search_user')
+    @guarded
     def ldap_search_user(self, email):
+        searchAttribute = self.ldap_info['searchattribute'].split(',')
+        user_data = cached_user_entry(email)
+        if user_data is not None:
+            if 'manager' in searchAttribute and user_data.get('manager'):
+                user_data['manager'] = self.ldap_search_manager(manager_dn_email(user_data['manager']))
+            return user_data
+
         if self.ldap_conn is None:
             self.ldap_connect()
-        searchAttribute = self.ldap_info['searchattribute'].split(',')
         searchScope = ldap.SCOPE_SUBTREE
         bases_dn = [self.ldap_info['basedn'], self.ldap_info['basedndeleted']]
         searchFilter = f"(&(|(mail={email})(rhatPreferredAlias={email}))(objectClass=posixAccount))"
@@ -77,12 +182,13 @@ class GPTELdap(object):
                         if result_type == ldap.RES_SEARCH_ENTRY:
                             for dn, entry in result_data:
                                 user_data = self.parse_ldap_result(result_data)
+                                cache_user_entry(entry, user_data, ('mail', email))
                                 if 'manager' in searchAttribute:
-                                    manager_dn = entry['manager'][0].decode('utf-8')
-                                    manager_uid = manager_dn.split(',')[0].replace('uid=', '')
-                                    manager_email = manager_uid + '@redhat.com'
+                                    manager_email = manager_dn_email(entry['manager'][0].decode('utf-8'))
                                     user_data['manager'] = self.ldap_search_manager(manager_email)
                         return user_data
+        except unavailable_errors:
+            raise
         except ldap.LDAPError as e:
             print(e)
 
@@ -92,11 +198,10 @@ class GPTELdap(object):
         return user_data
 
     def convert_dn_email(self, entry):
-        manager_dn = entry['manager'][0].decode('utf-8')
-        manager_uid = manager_dn.split(',')[0].replace('uid=', '')
-        manager_email = manager_uid + '@redhat.com'
-        return manager_email
+        return manager_dn_email(entry['manager'][0].decode('utf-8'))
 
+    @tracing.traced('ldap.user_headcount')
+    @guarded
     def ldap_user_headcount(self, email, managers, manager_email=None, count=1):
         # ldap_conn = ldap_connect()
         searchAttribute = ["manager"]
@@ -107,6 +212,17 @@ class GPTELdap(object):
         else:
             searchFilter = f"(&(|(mail={email})(rhatPreferredAlias={email}))(objectClass=posixAccount))"
         user_data = {}
+
+        # Walk up the managers cached by ldap_search_users() without searching them
+        cached = cached_user_entry(manager_email or email)
+        if cached is not None and cached.get('manager'):
+            next_manager_email = manager_dn_email(cached['manager'])
+            if next_manager_email in top_level_managers:
+                return 'gpte@redhat.com'
+            if next_manager_email in managers:
+                return next_manager_email
+            return self.ldap_user_headcount(email, managers, next_manager_email, count)
+
         if self.ldap_conn is None:
             self.ldap_connect()
         try:
@@ -141,7 +257,116 @@ class GPTELdap(object):
                                             return manager_email
                                         manager_email = self.ldap_user_headcount(email, managers, manager_email, count)
                                         return manager_email
+        except unavailable_errors:
+            raise
         except ldap.LDAPError as e:
             print(e)
 
         return user_data
+
+    def batch_filter(self, values, attribute):
+        values = [escape_filter_chars(v) for v in values]
+        if attribute == 'mail':
+            terms = ''.join(f"(mail={v})(rhatPreferredAlias={v})" for v in values)
+        else:
+            terms = ''.join(f"({attribute}={v})" for v in values)
+        return f"(&(|{terms})(objectClass=posixAccount))"
+
+    def paged_search(self, basedn, search_filter, attributes):
+        """Search with the simple paged results control.
+
+        Yields:
+            (dn, entry): Entries found.
+        """
+        page_control = SimplePagedResultsControl(True, size=ldap_page_size, cookie='')
+        while True:
+            ldap_result_id = self.ldap_conn.search_ext(basedn, ldap.SCOPE_SUBTREE, search_filter, attributes,
+                                                       serverctrls=[page_control])
+            result_type, result_data, _, server_controls = self.ldap_conn.result3(ldap_result_id)
+            for dn, entry in result_data:
+                # Search references have no DN
+                if dn is not None:
+                    yield dn, entry
+            cookies = [c.cookie for c in server_controls
+                       if c.controlType == SimplePagedResultsControl.controlType]
+            if not cookies or not cookies[0]:
+                return
+            page_control.cookie = cookies[0]
+
+    def search_entries(self, values, attribute='mail'):
+        """Search many users, `ldap_batch_size` values per filter, the deleted users base
+        only for the values not found in the active one. The entries are cached.
+
+        Returns:
+            dict: Lowercase value -> parsed entry.
+        """
+        searchAttribute = self.ldap_info['searchattribute'].split(',')
+        # The attributes matched against the values searched
+        attributes = sorted(set(searchAttribute) | {'mail', 'rhatPreferredAlias', 'uid', 'manager'})
+        bases_dn = [self.ldap_info['basedn'], self.ldap_info['basedndeleted']]
+
+        found = {}
+        for basedn in bases_dn:
+            pending = sorted({v.lower() for v in values} - set(found))
+            for i in range(0, len(pending), ldap_batch_size):
+                batch = set(pending[i:i + ldap_batch_size])
+                for dn, entry in self.paged_search(basedn, self.batch_filter(sorted(batch), attribute), attributes):
+                    parsed = self.parse_ldap_result([(dn, entry)])
+                    cache_user_entry(entry, parsed)
+                    keys = entry.get(attribute, [])
+                    if attribute == 'mail':
+                        keys = keys + entry.get('rhatPreferredAlias', [])
+                    for value in batch.intersection(k.decode('utf-8').lower() for k in keys):
+                        found[value] = parsed
+        return found
+
+    @tracing.traced('ldap.search_users')
+    @guarded
+    def ldap_search_users(self, values, attribute='mail'):
+        """Search many users with a few requests, see search_entries(), and fill the user cache.
+
+        The managers of the users are searched level by level up to the top of the
+        organization, so ldap_search_user() and ldap_user_headcount() answer from the
+        cache for these users.
+
+        Args:
+            values (list): Mails, or uids with `attribute='uid'`.
+
+        Returns:
+            dict: Value -> user, as returned by ldap_search_user(). Users not found are missing.
+        """
+        if self.ldap_conn is None:
+            self.ldap_connect()
+        tracing.set_attributes(users=len(values))
+
+        users = {}
+        for value in values:
+            user_data = cached_user_entry(value, attribute)
+            if user_data is not None:
+                users[value.lower()] = user_data
+        users.update(self.search_entries([v for v in values if v.lower() not in users], attribute))
+
+        # Managers not cached yet, one batch search per level
+        managers = {}
+        manager_emails = {manager_dn_email(u['manager']) for u in users.values() if u.get('manager')}
+        for _ in range(ldap_manager_depth):
+            manager_emails = [m for m in manager_emails if m not in managers and cached_user_entry(m) is None]
+            if not manager_emails:
+                break
+            found = self.search_entries(manager_emails)
+            managers.update(found)
+            manager_emails = {manager_dn_email(m['manager']) for m in found.values()
+                              if m.get('manager') and manager_dn_email(m['manager']) not in top_level_managers}
+
+        searchAttribute = self.ldap_info['searchattribute'].split(',')
+        results = {}
+        for value in values:
+            user_data = users.get(value.lower())
+            if user_data is None:
+                continue
+            user_data = dict(user_data)
+            if 'manager' in searchAttribute and user_data.get('manager'):
+                manager_email = manager_dn_email(user_data['manager'])
+                user_data['manager'] = dict(managers.get(manager_email) or cached_user_entry(manager_email) or {})
+            results[value] = user_data
+        return results
@@ -0,0 +1,283 @@
+"""Deferred enrichment of the provisions written without their user.
+
+When the requester of a provision is missing or LDAP is unavailable, the
+provision is written without its user, manager and cost center columns and
+queued in the provision_enrichment_pending table. The worker started by the
+operator claims the due entries in batches, looks each requester up once
+and updates the provisions of the batch with a single statement. Entries
+failing again are retried with an exponential backoff, which is set when
+they are claimed, so the entries of a replica which stopped are retried too.
+
+With ENRICHMENT_INLINE=false users are never looked up while handling an
+event, all provisions are enriched by the worker.
+"""
+import asyncio
+import os
+import time
+
+from psycopg2.extras import execute_values
+
+import logs
+import metrics
+import peering
+import snapshot_history
+import snapshots
+import utils
+from corp_ldap import prefetch_users
+from recompute import get_column_types, update_provisions
+
+enrichment_enabled = os.environ.get('ENRICHMENT_ENABLED', 'true').lower() == 'true'
+# Look users up while handling the events, the worker only repairs the failures
+enrichment_inline = os.environ.get('ENRICHMENT_INLINE', 'true').lower() == 'true'
+enrichment_batch_size = int(os.environ.get('ENRICHMENT_BATCH_SIZE', 100))
+enrichment_interval = float(os.environ.get('ENRICHMENT_INTERVAL', 30))
+# Seconds before the second attempt, doubled on each attempt
+enrichment_retry_delay = float(os.environ.get('ENRICHMENT_RETRY_DELAY', 60))
+enrichment_max_retry_delay = float(os.environ.get('ENRICHMENT_MAX_RETRY_DELAY', 6 * 3600))
+enrichment_max_attempts = int(os.environ.get('ENRICHMENT_MAX_ATTEMPTS', 20))
+# Also refresh the opportunities table from Salesforce for the enriched provisions
+enrichment_opportunities = os.environ.get('ENRICHMENT_OPPORTUNITIES', 'false').lower() == 'true'
+
+logger = logs.get_logger('enrichment')
+
+create_table_query = """
+CREATE TABLE IF NOT EXISTS provision_enrichment_pending (
+    provision_uuid VARCHAR PRIMARY KEY,
+    username VARCHAR,
+    using_cloud_forms BOOLEAN NOT NULL DEFAULT FALSE,
+    opportunity VARCHAR,
+    reason VARCHAR(32) NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+    next_attempt_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS provision_enrichment_pending_due
+    ON provision_enrichment_pending (next_attempt_at);
+"""
+
+enqueue_query = "INSERT INTO provision_enrichment_pending (provision_uuid, username, using_cloud_forms, \n" \
+                "  opportunity, reason) \n" \
+                "VALUES (%s, %s, %s, %s, %s) \n" \
+                "ON CONFLICT (provision_uuid) DO UPDATE SET \n" \
+                "  username = COALESCE(EXCLUDED.username, provision_enrichment_pending.username), \n" \
+                "  using_cloud_forms = EXCLUDED.using_cloud_forms, \n" \
+                "  opportunity = EXCLUDED.opportunity, \n" \
+                "  reason = EXCLUDED.reason \n" \
+                "RETURNING provision_uuid;"
+
+# Provisions enriched since they were queued, by an event or another replica
+cleanup_query = "DELETE FROM provision_enrichment_pending e USING provisions p \n" \
+                "WHERE p.uuid = e.provision_uuid AND p.student_id IS NOT NULL;"
+
+# The next attempt is scheduled when an entry is claimed, it is deleted when it succeeds
+claim_query = "UPDATE provision_enrichment_pending SET attempts = attempts + 1, \n" \
+              "  next_attempt_at = NOW() + LEAST(%s * POWER(2, attempts), %s) * INTERVAL '1 second' \n" \
+              "WHERE provision_uuid IN ( \n" \
+              "  SELECT provision_uuid FROM provision_enrichment_pending \n" \
+              "  WHERE next_attempt_at <= NOW() \n" \
+              "  ORDER BY next_attempt_at LIMIT %s \n" \
+              "  FOR UPDATE SKIP LOCKED) \n" \
+              "RETURNING provision_uuid, username, using_cloud_forms, opportunity, attempts;"
+
+requester_query = "SELECT provision_uuid, anarchy_subject_json::text FROM resource_claim_log \n" \
+                  "WHERE provision_uuid IN %s AND anarchy_subject_json IS NOT NULL;"
+
+
+def create_queue_table():
+    utils.execute_query(create_table_query, autocommit=True)
+
+
+def enqueue(provision, reason):
+    """Queue a provision written without its user.
+
+    Args:
+        provision (dict): Provision returned by prepare().
+        reason (str): requester_missing, ldap_unavailable or deferred.
+    """
+    utils.execute_query(enqueue_query,
+                        positional_args=[provision.get('uuid'), provision.get('username'),
+                                         bool(provision.get('using_cloud_forms', False)),
+                                         provision.get('opportunity'), reason],
+                        autocommit=True, prepare=True)
+    metrics.ENRICHMENT_QUEUED.labels(reason=reason).inc()
+
+
+class Enrichment(object):
+    """Enrich a batch of claimed entries.
+
+    Args:
+        op (module): operator.py module, for the user lookups.
+    """
+
+    def __init__(self, op, entries):
+        self.op = op
+        self.entries = entries
+        # provision_uuid -> provisions columns
+        self.enriched = {}
+        # provision_uuid -> error
+        self.failed = {}
+
+    def load_requesters(self):
+        """Read the requester of the entries queued without one from the stored AnarchySubjects."""
+        missing = tuple(e['provision_uuid'] for e in self.entries if not e['username'])
+        if not missing:
+            return
+        if snapshots.snapshot_latest_enabled:
+            result = utils.execute_query(requester_query, positional_args=[missing])
+            anarchy_subjects = {row['provision_uuid']: snapshots.load_snapshot(row['anarchy_subject_json'])
+                                for row in result['query_result']}
+        else:
+            anarchy_subjects = snapshot_history.get_snapshots(missing, 'anarchy_subject')
+        requesters = {}
+        for provision_uuid, anarchy_subject in anarchy_subjects.items():
+            resource_vars = self.op.get_resource_vars(anarchy_subject)
+            requesters[provision_uuid] = resource_vars.get('resource_claim_requester')
+        for entry in self.entries:
+            if not entry['username']:
+                entry['username'] = requesters.get(entry['provision_uuid'])
+
+    def lookup(self, username, using_cloud_forms):
+        """Search the user in LDAP and upsert it with its manager.
+
+        Returns:
+            dict: provisions columns, None if the user was not found.
+        """
+        user = self.op.search_ipa_user(username, logger, using_cloud_forms)
+        user_db = self.op.populate_user({'user': user}, logger)
+        if user_db.get('user_id') is None:
+            return None
+        return {
+            'student_id': user_db['user_id'],
+            'manager_id': user_db.get('manager_id'),
+            'manager_chargeback_id': user_db.get('manager_chargeback_id'),
+            'cost_center': user_db.get('cost_center'),
+            # Set by populate_user() for the users of the CORP directory
+            'student_geo': user.get('region', 'NA'),
+        }
+
+    def run(self):
+        self.load_requesters()
+
+        prefetch_users([e['username'] for e in self.entries], logger)
+
+        # Provisions of the same requester are usually queued together, look each one up once
+        users = {}
+        for entry in self.entries:
+            provision_uuid = entry['provision_uuid']
+            if not entry['username']:
+                self.failed[provision_uuid] = 'Requester unknown'
+                continue
+
+            user_key = (entry['username'], entry['using_cloud_forms'])
+            if user_key not in users:
+                try:
+                    users[user_key] = self.lookup(*user_key)
+                except Exception as e:
+                    users[user_key] = e
+            user = users[user_key]
+
+            if isinstance(user, Exception):
+                self.failed[provision_uuid] = str(user)
+            elif user is None:
+                self.failed[provision_uuid] = f"User {entry['username']} not found"
+            else:
+                self.enriched[provision_uuid] = dict(user, uuid=provision_uuid)
+
+        if enrichment_opportunities:
+            self.populate_opportunities()
+
+    def populate_opportunities(self):
+        from opportunities import Opportunities
+
+        for opportunity in {e['opportunity'] for e in self.entries
+                            if e['opportunity'] and e['provision_uuid'] in self.enriched}:
+            try:
+                Opportunities(logger, {'opportunity': opportunity}).populate_opportunities()
+            except Exception as e:
+                logger.warning(f"Unable to populate opportunity {opportunity}: {e}")
+
+    def save(self):
+        """Update the enriched provisions and remove their entries in a single transaction.
+
+        Entries failing for the last time are removed, the others keep their error.
+        """
+        abandoned = [e['provision_uuid'] for e in self.entries
+                     if e['provision_uuid'] in self.failed and e['attempts'] >= enrichment_max_attempts]
+        done = tuple(list(self.enriched) + abandoned)
+        errors = [(uuid, error) for (uuid, error) in self.failed.items() if uuid not in abandoned]
+
+        db_pool_conn = utils.get_db_connection()
+        try:
+            cursor = db_pool_conn.cursor()
+            if self.enriched:
+                update_provisions(cursor, list(self.enriched.values()), get_column_types(cursor, 'provisions'))
+            if done:
+                cursor.execute("DELETE FROM provision_enrichment_pending WHERE provision_uuid IN %s;", [done])
+            if errors:
+                execute_values(cursor,
+                               "UPDATE provision_enrichment_pending SET last_error = v.last_error \n"
+                               "FROM (VALUES %s) AS v (provision_uuid, last_error) \n"
+                               "WHERE provision_enrichment_pending.provision_uuid = v.provision_uuid",
+                               errors, page_size=len(errors))
+            db_pool_conn.commit()
+            cursor.close()
+        except Exception:
+            db_pool_conn.rollback()
+            utils.put_db_connection(db_pool_conn, close=True)
+            raise
+        utils.put_db_connection(db_pool_conn)
+
+        for provision_uuid in abandoned:
+            logger.error(f"Giving up enrichment of provision {provision_uuid} after "
+                         f"{enrichment_max_attempts} attempts: {self.failed[provision_uuid]}")
+        metrics.ENRICHMENT_PROCESSED.labels(result='enriched').inc(len(self.enriched))
+        metrics.ENRICHMENT_PROCESSED.labels(result='failed').inc(len(errors))
+        metrics.ENRICHMENT_PROCESSED.labels(result='abandoned').inc(len(abandoned))
+
+
+def process_batch(op, batch_size=None):
+    """Enrich the due entries, at most `batch_size` of them.
+
+    Returns:
+        int: Number of entries claimed.
+    """
+    started = time.monotonic()
+    claimed = utils.execute_query(claim_query,
+                                  positional_args=[enrichment_retry_delay, enrichment_max_retry_delay,
+                                                   batch_size or enrichment_batch_size],
+                                  autocommit=True)
+    entries = claimed['query_result']
+    if not entries:
+        return 0
+
+    enrichment = Enrichment(op, entries)
+    enrichment.run()
+    enrichment.save()
+    logger.info(f"Enriched {len(enrichment.enriched)} of {len(entries)} provisions "
+                f"in {time.monotonic() - started:.1f}s")
+    return len(entries)
+
+
+def update_pending_count():
+    result = utils.execute_query("SELECT COUNT(*) AS pending FROM provision_enrichment_pending;")
+    metrics.ENRICHMENT_PENDING.set(result['query_result'][0]['pending'])
+
+
+async def process(op, interval=None):
+    """Enrich the queued provisions until the operator exits."""
+    loop = asyncio.get_running_loop()
+    batch_size = enrichment_batch_size
+    while True:
+        await asyncio.sleep(interval or enrichment_interval)
+        # A standby replica does not write to the database
+        if peering.is_leader is False:
+            continue
+        try:
+            await loop.run_in_executor(None, utils.execute_query, cleanup_query, None, True)
+            # Keep going while full batches are claimed
+            while await loop.run_in_executor(None, process_batch, op, batch_size) == batch_size:
+                pass
+            await loop.run_in_executor(None, update_pending_count)
+        except Exception as e:
+            logger.error(f"Unable to enrich provisions: {e}")
@@ -1,34 +1,37 @@
 import ldap
 import utils
+import tracing
 import json
-from retrying import retry
+from ldap_pool import LdapPool, guarded
+
+ipa_ldap_pool = LdapPool('gpte-ipa-secrets')
 
 
 class GPTEIpaLdap(object):
 
     def __init__(self, logger):
-        self.ldap_info = utils.get_secret_data('gpte-ipa-secrets')
+        self.ldap_info = ipa_ldap_pool.info
         self.ldap_hosts = self.ldap_info['ldap_hosts']
         self.ldap_binddn = self.ldap_info['binddn']
         self.ldap_bindpw = self.ldap_info['bindpw']
         self.ldap_basedn = self.ldap_info['basedn']
         self.debug = False
         self.log = logger
+        self.ldap_pool = ipa_ldap_pool
         self.ldap_conn = None
 
-    # Wait 2^x * 500 milliseconds between each retry, up to 5 seconds, then 5 seconds afterwards and 3 attempts
-    @retry(stop_max_attempt_number=3, wait_exponential_multiplier=500, wait_exponential_max=5000)
     def ldap_connect(self):
         try:
-            self.ldap_conn = ldap.initialize("ldaps://{ldap_hosts}".format(ldap_hosts=self.ldap_hosts))
-            ldap.set_option(ldap.OPT_X_TLS_REQUIRE_CERT, ldap.OPT_X_TLS_NEVER)
-            self.ldap_conn.protocol_version = ldap.VERSION3
-            self.ldap_conn.simple_bind_s(self.ldap_binddn, self.ldap_bindpw)
+            self.ldap_conn = ipa_ldap_pool.connection()
         except ldap.INVALID_CREDENTIALS:
             self.log.error("Your username or password is incorrect.")
+            raise
         except ldap.LDAPError as e:
             self.log.error(f"Error connectint to LDAP {e}")
+            raise
 
+    @tracing.traced('ldap.search_ipa_user')
+    @guarded
     def search_ipa_user(self, user_name, attribute='uid'):
         """
         This method search for a *user_name* into GPTE IPA LDAP
@@ -61,6 +64,8 @@ class GPTEIpaLdap(object):
 
         return user_data
 
+    @tracing.traced('ldap.search_user_region')
+    @guarded
     def search_user_region(self, user_name):
         """
         By default RHDPS uses a group name to know which user's region, we have to find the group name `rhpds-geo-{geo}`
@@ -90,6 +95,8 @@ class GPTEIpaLdap(object):
 
         return region_name
 
+    @tracing.traced('ldap.search_user_partner')
+    @guarded
     def search_user_partner(self, user_name):
         """
         By default RHDPS uses a group name to know which user's region, we have to find the group name `rhpds-geo-{geo}`
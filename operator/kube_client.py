@@ -0,0 +1,124 @@
+"""Shared Kubernetes API client.
+
+All the Kubernetes calls of the operator go through a single ApiClient, so
+they reuse the connections of one urllib3 pool instead of each API object
+opening its own. The pool keeps up to KUBERNETES_POOL_SIZE connections,
+with TCP keep-alive so idle connections dropped by a load balancer are
+detected. Calls without an explicit `_request_timeout` get the
+KUBERNETES_TIMEOUT of the resilience settings, and the duration of every
+call is observed in babylon_reporting_kubernetes_api_seconds.
+"""
+import functools
+import os
+import socket
+import threading
+import time
+from urllib.parse import urlparse
+
+import kubernetes
+import urllib3
+
+import metrics
+import resilience
+
+# Connections kept open to the API server, the handlers run in a thread pool
+kubernetes_pool_size = int(os.environ.get('KUBERNETES_POOL_SIZE', 16))
+kubernetes_tcp_keepalive = os.environ.get('KUBERNETES_TCP_KEEPALIVE', 'true').lower() == 'true'
+# Seconds before an idle connection is probed, then between probes
+kubernetes_keepalive_idle = int(os.environ.get('KUBERNETES_KEEPALIVE_IDLE', 60))
+kubernetes_keepalive_interval = int(os.environ.get('KUBERNETES_KEEPALIVE_INTERVAL', 15))
+
+_lock = threading.Lock()
+_api_client = None
+
+
+def resource_label(url):
+    """Resource of an API URL, `secrets` or `anarchysubjects.anarchy.gpte.redhat.com`, for the metric labels."""
+    segments = urlparse(url).path.strip('/').split('/')
+    if segments[0] == 'api':
+        group, segments = None, segments[2:]
+    elif segments[0] == 'apis' and len(segments) > 2:
+        group, segments = segments[1], segments[3:]
+    else:
+        return 'other'
+    if segments[:1] == ['namespaces'] and len(segments) > 2:
+        segments = segments[2:]
+    if not segments:
+        return 'other'
+    return f"{segments[0]}.{group}" if group else segments[0]
+
+
+def timed_request(request):
+    """Wrap RESTClientObject.request() to apply the default timeout and observe the latency of each call."""
+
+    @functools.wraps(request)
+    def wrapper(method, url, *args, **kwargs):
+        if kwargs.get('_request_timeout') is None:
+            kwargs['_request_timeout'] = resilience.get('kubernetes').timeout
+        result = 'ok'
+        started = time.monotonic()
+        try:
+            return request(method, url, *args, **kwargs)
+        except Exception:
+            result = 'error'
+            raise
+        finally:
+            metrics.KUBERNETES_API_SECONDS.labels(method=method, resource=resource_label(url), result=result) \
+                .observe(time.monotonic() - started)
+
+    return wrapper
+
+
+def keepalive_socket_options():
+    """urllib3 socket options with TCP keep-alive enabled."""
+    options = list(urllib3.connection.HTTPConnection.default_socket_options)
+    options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+    # Not available on every platform
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        options.append((socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, kubernetes_keepalive_idle))
+    if hasattr(socket, 'TCP_KEEPINTVL'):
+        options.append((socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, kubernetes_keepalive_interval))
+    if hasattr(socket, 'TCP_KEEPCNT'):
+        options.append((socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 4))
+    return options
+
+
+def load_config():
+    """Load the in-cluster or kubeconfig configuration, the shared client is created again on next use."""
+    global _api_client
+
+    if os.path.exists('/run/secrets/kubernetes.io/serviceaccount'):
+        kubernetes.config.load_incluster_config()
+    else:
+        kubernetes.config.load_kube_config()
+
+    with _lock:
+        _api_client = None
+
+
+def api_client():
+    """Get the shared ApiClient, created from the loaded configuration on first use."""
+    global _api_client
+
+    with _lock:
+        if _api_client is None:
+            configuration = kubernetes.client.Configuration.get_default_copy()
+            configuration.connection_pool_maxsize = kubernetes_pool_size
+            # Older clients do not pass socket options to urllib3, they only reuse the pooled connections
+            if kubernetes_tcp_keepalive and hasattr(configuration, 'socket_options'):
+                configuration.socket_options = keepalive_socket_options()
+            _api_client = kubernetes.client.ApiClient(configuration)
+            _api_client.rest_client.request = timed_request(_api_client.rest_client.request)
+        return _api_client
+
+
+def core_v1_api():
+    return kubernetes.client.CoreV1Api(api_client())
+
+
+def custom_objects_api():
+    return kubernetes.client.CustomObjectsApi(api_client())
+
+
+def coordination_v1_api():
+    return kubernetes.client.CoordinationV1Api(api_client())
@@ -0,0 +1,154 @@
+import functools
+import os
+import threading
+import time
+
+import ldap
+
+import logs
+import resilience
+import scheduler
+import utils
+
+# Bound connections kept open per directory
+ldap_pool_size = int(os.environ.get('LDAP_POOL_SIZE', 2))
+# Connections are replaced after this many seconds so one dropped by the server is not reused forever
+ldap_pool_max_age = float(os.environ.get('LDAP_POOL_MAX_AGE', 300))
+
+# Errors meaning the directory is not reachable, other LDAP errors are answers of the server
+unavailable_errors = (ldap.SERVER_DOWN, ldap.TIMEOUT)
+
+logger = logs.get_logger('ldap')
+
+
+class ThrottledConnection(object):
+    """LDAP connection taking a token from the LDAP rate limiter for each search sent to the directory.
+
+    The searches answered from the user cache do not reach the connection, so
+    they are not rate limited.
+    """
+
+    def __init__(self, ldap_conn):
+        self.ldap_conn = ldap_conn
+
+    def __getattr__(self, name):
+        return getattr(self.ldap_conn, name)
+
+    def search(self, *args, **kwargs):
+        scheduler.throttle(resilience.get('ldap'))
+        return self.ldap_conn.search(*args, **kwargs)
+
+    def search_ext(self, *args, **kwargs):
+        scheduler.throttle(resilience.get('ldap'))
+        return self.ldap_conn.search_ext(*args, **kwargs)
+
+
+class LdapPool(object):
+    """Bound connections to one directory, shared by the handler threads.
+
+    python-ldap serializes the calls made on a connection and search results
+    are read by message id, so connections are handed out round robin instead
+    of being checked out. The secret is read once, not for every search.
+    """
+
+    def __init__(self, secret_name, size=None, max_age=None):
+        self.secret_name = secret_name
+        self.size = size or ldap_pool_size
+        self.max_age = ldap_pool_max_age if max_age is None else max_age
+        self.lock = threading.Lock()
+        self.secret_data = None
+        # List of (connection, created_at)
+        self.connections = []
+        self.next_index = 0
+
+    @property
+    def info(self):
+        if self.secret_data is None:
+            self.secret_data = utils.get_secret_data(self.secret_name)
+        return self.secret_data
+
+    def _connect(self):
+        info = self.info
+        timeout = resilience.get('ldap').timeout
+        ldap_conn = ldap.initialize(f"ldaps://{info['ldap_hosts']}")
+        ldap.set_option(ldap.OPT_X_TLS_REQUIRE_CERT, ldap.OPT_X_TLS_NEVER)
+        ldap_conn.set_option(ldap.OPT_NETWORK_TIMEOUT, timeout)
+        # Default timeout of the synchronous calls and of result()
+        ldap_conn.timeout = timeout
+        ldap_conn.protocol_version = ldap.VERSION3
+        ldap_conn.simple_bind_s(info['binddn'], info['bindpw'])
+        return ldap_conn
+
+    def connect(self):
+        return ThrottledConnection(resilience.call('ldap', self._connect, retry_on=unavailable_errors))
+
+    def connection(self):
+        """Get a bound connection, opening one while the pool is not full.
+
+        Raises:
+            DependencyUnavailable: The LDAP circuit breaker is open or the directory cannot be reached.
+        """
+        now = time.monotonic()
+        if resilience.get('ldap').breaker.is_open:
+            # Do not reuse the connections opened before the failures, connect() lets
+            # a trial connection through once the breaker reset time elapsed
+            ldap_conn = self.connect()
+            with self.lock:
+                for (stale_conn, _) in self.connections:
+                    self._unbind(stale_conn)
+                self.connections = [(ldap_conn, now)]
+            return ldap_conn
+
+        with self.lock:
+            self.next_index = (self.next_index + 1) % self.size
+            if self.next_index < len(self.connections):
+                ldap_conn, created_at = self.connections[self.next_index]
+                if not self.max_age or now - created_at < self.max_age:
+                    return ldap_conn
+                self.connections.pop(self.next_index)
+                self._unbind(ldap_conn)
+
+            ldap_conn = self.connect()
+            self.connections.append((ldap_conn, now))
+            return ldap_conn
+
+    def fill(self):
+        """Open all the connections of the pool."""
+        with self.lock:
+            while len(self.connections) < self.size:
+                self.connections.append((self.connect(), time.monotonic()))
+        return len(self.connections)
+
+    def discard(self, ldap_conn):
+        """Close a connection which failed, the next call of connection() opens a new one."""
+        with self.lock:
+            self.connections = [(c, created_at) for (c, created_at) in self.connections if c is not ldap_conn]
+        self._unbind(ldap_conn)
+
+    def _unbind(self, ldap_conn):
+        try:
+            ldap_conn.unbind_s()
+        except Exception as e:
+            logger.debug("Unable to unbind LDAP connection: %s", e)
+
+
+def guarded(method):
+    """Decorate a search method of the LDAP classes, which keep their pool in `ldap_pool`
+    and their connection in `ldap_conn`.
+
+    When the directory is unreachable the connection is discarded, the
+    failure is recorded by the LDAP circuit breaker and DependencyUnavailable
+    is raised instead. The rate limit is applied by the connections, see
+    ThrottledConnection.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        except unavailable_errors as e:
+            if self.ldap_conn is not None:
+                self.ldap_pool.discard(self.ldap_conn)
+                self.ldap_conn = None
+            resilience.get('ldap').breaker.record_failure()
+            raise resilience.DependencyUnavailable('ldap', e) from e
+    return wrapper
@@ -0,0 +1,64 @@
+import json
+import logging
+import os
+import random
+
+# Per category verbosity, e.g. LOG_LEVELS="payload.resource_claim=DEBUG,sql=WARNING".
+# Categories are children of the `babylon-reporting` logger.
+log_levels = os.environ.get('LOG_LEVELS', '')
+# Payloads are truncated to this number of characters, 0 disables truncation
+payload_max_length = int(os.environ.get('LOG_PAYLOAD_MAX_LENGTH', 2000))
+# Fraction of the enabled payload messages actually logged
+payload_sample_rate = float(os.environ.get('LOG_PAYLOAD_SAMPLE_RATE', 1.0))
+
+root_logger_name = 'babylon-reporting'
+
+
+class Payload(object):
+    """Serialize an object to JSON only when the log record is formatted."""
+    __slots__ = ('obj', 'max_length')
+
+    def __init__(self, obj, max_length=None):
+        self.obj = obj
+        self.max_length = payload_max_length if max_length is None else max_length
+
+    def __str__(self):
+        text = json.dumps(self.obj, default=str)
+        if self.max_length and len(text) > self.max_length:
+            return f"{text[:self.max_length]}... ({len(text) - self.max_length} more characters)"
+        return text
+
+
+def get_logger(category):
+    return logging.getLogger(f"{root_logger_name}.{category}")
+
+
+def configure_log_levels(levels=None):
+    """Set the level of each category listed in `levels` (defaults to LOG_LEVELS)."""
+    for item in (log_levels if levels is None else levels).split(','):
+        if '=' not in item:
+            continue
+        category, level = item.split('=', 1)
+        try:
+            get_logger(category.strip()).setLevel(level.strip().upper())
+        except ValueError:
+            # A typo in LOG_LEVELS must not prevent the operator from starting
+            logging.getLogger(root_logger_name).warning(f"Ignoring unknown log level in LOG_LEVELS: {item.strip()}")
+
+
+def log_payload(category, message, obj, level=logging.DEBUG):
+    """Log a bulky object in the `payload.<category>` category.
+
+    These messages go to a standard logger, never to the kopf object logger,
+    so they are not posted as Kubernetes events. Serialization only happens when
+    the category is enabled for `level` and the message is sampled.
+    """
+    logger = get_logger(f"payload.{category}")
+    if not logger.isEnabledFor(level):
+        return
+    if payload_sample_rate < 1.0 and random.random() >= payload_sample_rate:
+        return
+    logger.log(level, "%s: %s", message, Payload(obj))
+
+
+configure_log_levels()
@@ -1,5 +1,37 @@
+import os
+import threading
+import time
+
+import metrics
 import utils
 
+# Seconds the manager_chargeback table is cached, it is only changed by hand
+manager_chargeback_cache_ttl = float(os.environ.get('MANAGER_CHARGEBACK_CACHE_TTL', 300))
+
+_manager_cache = None
+_manager_cache_loaded_at = 0.0
+_manager_cache_lock = threading.Lock()
+
+
+def load_manager_cache():
+    """Read the manager_chargeback table into the cache.
+
+    Returns:
+        manager_list (dict): Manager email -> manager_chargeback id.
+    """
+    global _manager_cache, _manager_cache_loaded_at
+
+    manager_list = {}
+    query = "SELECT email, id from manager_chargeback"
+    result = utils.execute_query(query, autocommit=True)
+    for m in result['query_result']:
+        manager_list.update({m['email']: m['id']})
+
+    with _manager_cache_lock:
+        _manager_cache = manager_list
+        _manager_cache_loaded_at = time.monotonic()
+    return manager_list
+
 
 class ManagerChargeback(object):
 
@@ -8,11 +40,10 @@ class ManagerChargeback(object):
         self.logger = logger
 
     def list_manager(self):
-        manager_list = {}
-        query = "SELECT email, id from manager_chargeback"
-        result = utils.execute_query(query, autocommit=True)
-        for m in result['query_result']:
-            manager_list.update({m['email']: m['id']})
-
-        return manager_list
+        manager_list = _manager_cache
+        if manager_list is not None and time.monotonic() - _manager_cache_loaded_at < manager_chargeback_cache_ttl:
+            metrics.cache_hit('manager_chargeback')
+            return manager_list
 
+        metrics.cache_miss('manager_chargeback')
+        return load_manager_cache()
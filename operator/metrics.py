@@ -0,0 +1,209 @@
+import os
+import re
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+metrics_port = int(os.environ.get('METRICS_PORT', 8000))
+
+# Handler latencies range from a few milliseconds (ignored states) to
+# tens of seconds when LDAP or Tower are slow.
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+EVENT_HANDLER_SECONDS = Histogram(
+    'babylon_reporting_event_handler_seconds',
+    'Time spent handling a single AnarchySubject event',
+    buckets=LATENCY_BUCKETS,
+)
+
+STAGE_SECONDS = Histogram(
+    'babylon_reporting_stage_seconds',
+    'Time spent in each stage of the AnarchySubject event handler',
+    ['stage'],
+    buckets=LATENCY_BUCKETS,
+)
+
+QUERY_SECONDS = Histogram(
+    'babylon_reporting_db_query_seconds',
+    'Time spent executing a SQL statement',
+    ['table', 'kind'],
+    buckets=LATENCY_BUCKETS,
+)
+
+EVENTS_TOTAL = Counter(
+    'babylon_reporting_events_total',
+    'AnarchySubject events received by event type and current state',
+    ['type', 'state'],
+)
+
+EVENTS_FILTERED = Counter(
+    'babylon_reporting_events_filtered_total',
+    'AnarchySubject events dropped by the watch filter before reaching the handler',
+    ['reason'],
+)
+
+DB_POOL_CONNECTIONS = Gauge(
+    'babylon_reporting_db_pool_connections_in_use',
+    'Database connections currently checked out of the pool',
+)
+
+CACHE_REQUESTS = Counter(
+    'babylon_reporting_cache_requests_total',
+    'Cache lookups by cache name and result (hit or miss)',
+    ['cache', 'result'],
+)
+
+LEADER = Gauge(
+    'babylon_reporting_leader',
+    '1 when this replica is the active peer handling events, 0 when it is a paused standby',
+)
+
+LEADERSHIP_CHANGES = Counter(
+    'babylon_reporting_leadership_changes_total',
+    'Number of times this replica became active or standby',
+)
+
+SHARD_MEMBERS = Gauge(
+    'babylon_reporting_shard_members',
+    'Number of replicas sharing the AnarchySubjects when sharding is enabled',
+)
+
+SHARD_REBALANCES = Counter(
+    'babylon_reporting_shard_rebalances_total',
+    'Number of times the shard ring changed because replicas joined or left',
+)
+
+STARTUP_SECONDS = Gauge(
+    'babylon_reporting_startup_seconds',
+    'Duration of each warm-up step, and seconds from start until ready (phase="ready") '
+    'and until the last event of the initial listing was handled (phase="initial_list")',
+    ['phase'],
+)
+
+INITIAL_LIST_EVENTS = Counter(
+    'babylon_reporting_initial_list_events_total',
+    'AnarchySubject events of the initial listing passed through the startup rate limiter',
+)
+
+CIRCUIT_BREAKER_OPEN = Gauge(
+    'babylon_reporting_circuit_breaker_open',
+    '1 while the circuit breaker of a dependency is open and its calls fail fast',
+    ['dependency'],
+)
+
+DEPENDENCY_FAILURES = Counter(
+    'babylon_reporting_dependency_failures_total',
+    'Failed calls to a dependency (timeouts, connection errors, server errors), retries included',
+    ['dependency'],
+)
+
+EVENTS_DEFERRED = Counter(
+    'babylon_reporting_events_deferred_total',
+    'AnarchySubject events queued for a later retry because a dependency was unavailable',
+    ['dependency'],
+)
+
+EVENTS_ABANDONED = Counter(
+    'babylon_reporting_events_abandoned_total',
+    'Deferred AnarchySubject events dropped after RETRY_QUEUE_MAX_ATTEMPTS attempts or because the queue was full',
+)
+
+RETRY_QUEUE_LENGTH = Gauge(
+    'babylon_reporting_retry_queue_length',
+    'AnarchySubject events waiting in the deferred retry queue',
+)
+
+ENRICHMENT_QUEUED = Counter(
+    'babylon_reporting_enrichment_queued_total',
+    'Provisions written without their user and queued for enrichment',
+    ['reason'],
+)
+
+ENRICHMENT_PROCESSED = Counter(
+    'babylon_reporting_enrichment_processed_total',
+    'Queued provisions enriched, failed again, or abandoned after ENRICHMENT_MAX_ATTEMPTS attempts',
+    ['result'],
+)
+
+ENRICHMENT_PENDING = Gauge(
+    'babylon_reporting_enrichment_pending',
+    'Provisions waiting in provision_enrichment_pending',
+)
+
+KUBERNETES_API_SECONDS = Histogram(
+    'babylon_reporting_kubernetes_api_seconds',
+    'Time spent in a Kubernetes API call, labeled by HTTP method, resource and result (ok or error)',
+    ['method', 'resource', 'result'],
+    buckets=LATENCY_BUCKETS,
+)
+
+SCHEDULER_WAIT_SECONDS = Histogram(
+    'babylon_reporting_scheduler_wait_seconds',
+    'Time an AnarchySubject event waited for a scheduler worker, by priority class',
+    ['priority'],
+    buckets=LATENCY_BUCKETS,
+)
+
+SCHEDULER_WAITING = Gauge(
+    'babylon_reporting_scheduler_waiting',
+    'AnarchySubject events waiting for a scheduler worker, by priority class',
+    ['priority'],
+)
+
+RATE_LIMIT_WAIT_SECONDS = Histogram(
+    'babylon_reporting_rate_limit_wait_seconds',
+    'Time a call to a dependency waited for its rate limiter, by priority class of the event',
+    ['dependency', 'priority'],
+    buckets=LATENCY_BUCKETS,
+)
+
+ORG_CHART_USERS = Gauge(
+    'babylon_reporting_org_chart_users',
+    'Users in the last snapshot of the org chart dumped from the corporate directory',
+)
+
+# Matches the leading SET statement we prepend to most queries
+_set_prefix_re = re.compile(r'^\s*SET\s+[^;]*;\s*', re.IGNORECASE)
+_table_re = re.compile(r'\b(?:INTO|UPDATE|FROM)\s+([A-Za-z_][A-Za-z0-9_.]*)', re.IGNORECASE)
+
+
+def start_metrics_server(port=None):
+    """Expose the /metrics endpoint on the given port."""
+    start_http_server(port or metrics_port)
+
+
+def stage(name):
+    """Return a context manager/decorator that times a handler stage."""
+    return STAGE_SECONDS.labels(stage=name).time()
+
+
+def observe_query(query, seconds):
+    """Observe the duration of a SQL statement, labeled by table and statement kind."""
+    table, kind = statement_labels(query)
+    QUERY_SECONDS.labels(table=table, kind=kind).observe(seconds)
+
+
+def statement_labels(query):
+    """Get the (table, kind) labels for a SQL statement.
+
+    Args:
+        query (str): SQL statement, optionally prefixed by `SET ...;`
+
+    Returns:
+        tuple: table name (or 'unknown') and upper case statement kind (SELECT, INSERT, ...)
+    """
+    statement = _set_prefix_re.sub('', query, count=1).lstrip()
+    kind = statement.split(None, 1)[0].upper() if statement else 'UNKNOWN'
+    match = _table_re.search(statement)
+    table = match.group(1).lower() if match else 'unknown'
+    return table, kind
+
+
+def count_event(event_type, state):
+    EVENTS_TOTAL.labels(type=event_type or 'unknown', state=state or 'None').inc()
+
+
+def cache_hit(cache_name):
+    CACHE_REQUESTS.labels(cache=cache_name, result='hit').inc()
+
+
+def cache_miss(cache_name):
+    CACHE_REQUESTS.labels(cache=cache_name, result='miss').inc()
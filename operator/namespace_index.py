@@ -0,0 +1,68 @@
+import sys
+import threading
+
+# Namespace annotation holding the user who requested the namespace
+requester_annotation = 'openshift.io/requester'
+
+
+class NamespaceRecord(object):
+    """The fields of a Namespace used for attribution."""
+    __slots__ = ('name', 'requester', 'labels')
+
+    def __init__(self, name, requester=None, labels=()):
+        self.name = name
+        self.requester = requester
+        # Tuple of (key, value), much smaller than a dict for a handful of labels
+        self.labels = labels
+
+    def label(self, key, default=None):
+        for (k, v) in self.labels:
+            if k == key:
+                return v
+        return default
+
+    def __repr__(self):
+        return f"NamespaceRecord(name={self.name!r}, requester={self.requester!r}, labels={self.labels!r})"
+
+
+class NamespaceIndex(object):
+    """Compact index of the cluster Namespaces, fed by the namespace events.
+
+    Only the requester annotation and the labels with one of `label_prefixes`
+    are kept, deleted Namespaces are evicted.
+    """
+
+    def __init__(self, label_prefixes=()):
+        self.label_prefixes = tuple(f"{prefix}/" for prefix in label_prefixes)
+        self.records = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, name):
+        return name in self.records
+
+    def update(self, namespace):
+        metadata = namespace['metadata']
+        annotations = metadata.get('annotations') or {}
+        labels = tuple(sorted(
+            (sys.intern(k), v) for (k, v) in (metadata.get('labels') or {}).items()
+            if k.startswith(self.label_prefixes)
+        ))
+        record = NamespaceRecord(metadata['name'], annotations.get(requester_annotation), labels)
+        with self.lock:
+            self.records[record.name] = record
+        return record
+
+    def remove(self, name):
+        with self.lock:
+            return self.records.pop(name, None)
+
+    def get(self, name):
+        return self.records.get(name)
+
+    def requester(self, name):
+        """Requester of the namespace, None if unknown."""
+        record = self.records.get(name) if name else None
+        return record.requester if record else None
@@ -5,20 +5,38 @@ import os
 os.environ['TZ'] = 'UTC'
 os.environ['PGTZ'] = 'UTC'
 
+import asyncio
 import json
 import kopf
-import kubernetes
+import logging
 import requests
+import signal
+import sys
+import time
 import urllib3
 from kubernetes.client.rest import ApiException
 from base64 import b64decode
 from datetime import datetime, timezone
+import warmup
 import utils
-from ipa_ldap import GPTEIpaLdap
+import backfill
+import enrichment
+import kube_client
+import logs
+import metrics
+import org_chart
+import peering
+import resilience
+import retry_queue
+import scheduler
+import sharding
+import snapshot_history
+import tracing
 from corp_ldap import GPTELdap
 from users import Users
 from catalog_items import CatalogItems
 from provisions import Provisions
+from namespace_index import NamespaceIndex
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
@@ -29,15 +47,18 @@ babylon_api_version = os.environ.get('BABYLON_API_VERSION', 'v1')
 poolboy_domain = os.environ.get('POOLBOY_DOMAIN', 'poolboy.gpte.redhat.com')
 poolboy_api_version = os.environ.get('POOLBOY_API_VERSION', 'v1')
 pfe_domain = os.environ.get('PFE_DOMAIN', 'pfe.redhat.com')
+kopf_posting_level = os.environ.get('KOPF_POSTING_LEVEL', 'INFO').upper()
+# Only handle the AnarchySubjects matching this equality-based label selector, e.g. "key=value,!other".
+# Kopf has no server-side selector for watches, the objects are still received and dropped by the watch filter.
+anarchy_subject_label_selector = os.environ.get('ANARCHY_SUBJECT_LABEL_SELECTOR', '')
 
-if os.path.exists('/run/secrets/kubernetes.io/serviceaccount'):
-    kubernetes.config.load_incluster_config()
-else:
-    kubernetes.config.load_kube_config()
+# AnarchySubjects in these states are not reported, they are dropped before reaching the handler
+ignored_states = (None, 'new', 'provision-pending')
 
-core_v1_api = kubernetes.client.CoreV1Api()
-custom_objects_api = kubernetes.client.CustomObjectsApi()
-namespaces = {}
+# Created by load_kube_config(), the configuration is not read at import time
+core_v1_api = None
+custom_objects_api = None
+namespaces = NamespaceIndex(label_prefixes=(babylon_domain,))
 
 
 def handle_anarchy_events(logger, anarchy_subject, resource_vars):
@@ -69,13 +90,11 @@ def handle_anarchy_events(logger, anarchy_subject, resource_vars):
 
     if resource_current_state not in possible_states or resource_current_state in ('new', None):
         logger.warning(f"Current state '{resource_current_state}' not found. Provision UUID: {resource_claim_uuid}")
-        logger.info(f"Ignore action for {resource_claim_uuid} - {resource_vars}")
+        logger.info(f"Ignore action for {resource_claim_uuid}")
+        logs.log_payload('resource_vars', f"Ignored resource vars {resource_claim_uuid}", resource_vars)
         return
 
-    last_action = utils.last_lifecycle(resource_claim_uuid)
-
-    log_info = {'last_action': last_action,
-                'provision_uuid': resource_claim_uuid,
+    log_info = {'provision_uuid': resource_claim_uuid,
                 'current_state': resource_current_state,
                 'desired_state': resource_desired_state}
 
@@ -83,7 +102,9 @@ def handle_anarchy_events(logger, anarchy_subject, resource_vars):
 
     populate_provision(logger, anarchy_subject, resource_vars)
 
+    # Read from lifecycle_log, the backfill and the other replicas log states too
     last_action = utils.last_lifecycle(resource_claim_uuid)
+    log_info['last_action'] = last_action
 
     # Update provision_results if the last action was provision
     logger.info(f"handle_anarchy_events: {log_info}:")
@@ -96,13 +117,54 @@ def handle_anarchy_events(logger, anarchy_subject, resource_vars):
         utils.provision_lifecycle(resource_claim_uuid, resource_current_state, resource_claim_requester)
 
 
+def load_kube_config():
+    """Load the Kubernetes configuration and create the API clients."""
+    global core_v1_api, custom_objects_api
+
+    kube_client.load_config()
+
+    core_v1_api = kube_client.core_v1_api()
+    custom_objects_api = kube_client.custom_objects_api()
+
+
 @kopf.on.startup()
 def configure(settings: kopf.OperatorSettings, **_):
-    global ansible_tower_hostname, ansible_tower_password, ansible_tower_user
+    load_kube_config()
 
     # Disable scanning for CustomResourceDefinitions
     settings.scanning.disabled = True
 
+    # Only messages at this level or above are posted as Kubernetes events
+    settings.posting.level = logging.getLevelName(kopf_posting_level)
+
+    if sharding.sharding_enabled:
+        # All replicas are active, each one handles its own shard
+        settings.peering.standalone = True
+    else:
+        # Active/standby replicas
+        peering.configure_peering(settings)
+
+    # Billing-critical events are handled before the repeated state ticks, by the scheduler workers
+    scheduler.configure_scheduler()
+
+    metrics.start_metrics_server()
+    tracing.configure_tracing()
+
+    if snapshot_history.snapshot_history_enabled:
+        snapshot_history.create_history_table()
+
+    if enrichment.enrichment_enabled:
+        enrichment.create_queue_table()
+
+    load_tower_credentials()
+
+    # Open the pools and load the caches before the initial listing arrives
+    warmup.warm_up()
+
+
+def load_tower_credentials():
+    global ansible_tower_hostname, ansible_tower_password, ansible_tower_user
+
     # Get the tower secret. This may change in the future if there are
     # multiple ansible tower deployments
     ansible_tower_secret = core_v1_api.read_namespaced_secret('babylon-tower', 'anarchy-operator')
@@ -111,6 +173,104 @@ def configure(settings: kopf.OperatorSettings, **_):
     ansible_tower_user = b64decode(ansible_tower_secret.data['user']).decode('utf8')
 
 
+@kopf.on.startup()
+async def register_signal_handlers(**_):
+    # Dump the most expensive SQL statements on demand with `kill -USR1 <pid>`
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGUSR1, utils.dump_query_stats)
+
+
+@kopf.on.startup()
+async def start_leadership_monitor(settings: kopf.OperatorSettings, **_):
+    # The active replica appended to the snapshot history since the standby cached its last snapshots
+    asyncio.get_running_loop().create_task(peering.monitor_leadership(settings, on_takeover=snapshot_history.clear_cache))
+
+
+@kopf.on.startup()
+async def start_retry_queue(**_):
+    # Handle again the events deferred while a dependency was unavailable
+    asyncio.get_running_loop().create_task(retry_queue.process(anarchysubject_event))
+
+
+@kopf.on.startup()
+async def start_enrichment_worker(**_):
+    if not enrichment.enrichment_enabled:
+        return
+
+    # Fill in the users of the provisions written while LDAP was unavailable
+    asyncio.get_running_loop().create_task(enrichment.process(sys.modules[__name__]))
+
+
+@kopf.on.startup()
+async def start_org_chart_refresh(**_):
+    if not org_chart.org_chart_enabled:
+        return
+
+    # Every replica keeps its own snapshot, dumped in the background so startup does not wait for it
+    asyncio.get_running_loop().create_task(org_chart.maintain())
+
+
+@kopf.on.startup()
+async def join_shard(**_):
+    if not sharding.sharding_enabled:
+        return
+
+    # Join before the watches start so the initial listing is already filtered by the ring
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, sharding.update_membership)
+    loop.create_task(sharding.maintain_membership(on_change=catch_up_shard))
+
+
+@kopf.on.cleanup()
+async def leave_shard(logger, **_):
+    if not sharding.sharding_enabled:
+        return
+
+    # Let the other replicas take over the shard without waiting for the Lease to expire
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, sharding.release_lease)
+    except Exception as e:
+        logger.warning(f"Unable to release the shard Lease: {e}")
+
+
+def catch_up_shard(previous_rings, ring):
+    """Handle the AnarchySubjects moved to this replica by shard changes.
+
+    Kopf only delivers new events to the new owner, this makes sure the
+    provisions gained are reconciled without waiting for their next event.
+    A key is gained when this replica did not own it in one of the rings
+    since the last catch-up, its events were dropped while that ring was in
+    use. Ownership is checked against the current ring for each
+    AnarchySubject, the members may change again during the listing, and
+    those kopf already delivered an event for are skipped since the listed
+    copy is older. The DELETED and billing events skipped for the keys gained
+    are replayed, the deleted AnarchySubjects are not listed.
+    """
+    started = time.monotonic()
+
+    def gained(anarchy_subject):
+        key = sharding.shard_key(anarchy_subject)
+        return sharding.owns(key) \
+            and any(previous_ring.owner(key) != sharding.shard_identity for previous_ring in previous_rings) \
+            and not sharding.event_since(anarchy_subject['metadata']['uid'], started)
+
+    # The previous owner of the provisions gained appended to their snapshot history
+    snapshot_history.clear_cache()
+    catch_up = backfill.Backfill(sys.modules[__name__], backfill.Checkpoint(), select=gained, batch_writes=False)
+    catch_up.run()
+    catch_up.report()
+
+    logger = logging.getLogger('babylon-reporting')
+    for skipped_at, event in sharding.take_skipped_events():
+        # A newer event was delivered here since
+        if sharding.event_since(event['object']['metadata']['uid'], skipped_at):
+            continue
+        try:
+            anarchysubject_event(event=event, logger=logger)
+        except Exception as e:
+            logger.error(f"Unable to replay a skipped shard event: {e}")
+
+
 @kopf.on.event(
     'namespaces',
 )
@@ -123,14 +283,98 @@ def namespace_event(event, logger, **_):
         logger.warning(event)
         return
 
-    name = namespace['metadata']['name']
-    namespaces[name] = namespace
+    if event.get('type') == 'DELETED':
+        namespaces.remove(namespace['metadata']['name'])
+    else:
+        namespaces.update(namespace)
+
+
+def parse_label_selector(selector):
+    """Parse an equality-based label selector into (key, operator, value) requirements.
+
+    Set-based requirements (`in`, `notin`) are not supported, they are logged and ignored.
+    """
+    requirements = []
+    for term in (t.strip() for t in selector.split(',')):
+        if not term:
+            continue
+        if ' in ' in term or ' notin ' in term or '(' in term:
+            logging.getLogger('babylon-reporting').warning(f"Ignoring unsupported label selector requirement: {term}")
+        elif '!=' in term:
+            key, value = term.split('!=', 1)
+            requirements.append((key.strip(), '!=', value.strip()))
+        elif '=' in term:
+            key, value = term.replace('==', '=').split('=', 1)
+            requirements.append((key.strip(), '=', value.strip()))
+        elif term.startswith('!'):
+            requirements.append((term[1:].strip(), '!', None))
+        else:
+            requirements.append((term, 'exists', None))
+    return requirements
+
+
+def match_labels(labels, requirements):
+    for key, op, value in requirements:
+        if op == '=' and labels.get(key) != value:
+            return False
+        if op == '!=' and labels.get(key) == value:
+            return False
+        if op == '!' and key in labels:
+            return False
+        if op == 'exists' and key not in labels:
+            return False
+    return True
+
+
+anarchy_subject_label_requirements = parse_label_selector(anarchy_subject_label_selector)
+
+
+def anarchy_subject_filter(body, event=None, **_):
+    """kopf `when=` filter dropping the AnarchySubjects anarchysubject_event would ignore,
+    those not matching ANARCHY_SUBJECT_LABEL_SELECTOR and, when sharding is enabled, those of other replicas."""
+    metadata = body.get('metadata', {})
+    if anarchy_subject_label_requirements and \
+            not match_labels(metadata.get('labels') or {}, anarchy_subject_label_requirements):
+        metrics.EVENTS_FILTERED.labels(reason='label').inc()
+        return False
+    spec_vars = body.get('spec', {}).get('vars')
+    if not spec_vars or 'annotations' not in metadata:
+        metrics.EVENTS_FILTERED.labels(reason='invalid').inc()
+        return False
+    if spec_vars.get('current_state') in ignored_states:
+        metrics.EVENTS_FILTERED.labels(reason='state').inc()
+        return False
+    if not sharding.owns_anarchy_subject(body, event=event):
+        metrics.EVENTS_FILTERED.labels(reason='shard').inc()
+        return False
+    return True
 
 
 @kopf.on.event(
     anarchy_domain, anarchy_api_version, 'anarchysubjects',
+    when=anarchy_subject_filter,
 )
+@warmup.throttle_initial_listing
+async def queue_anarchysubject_event(event, logger, **_):
+    """Queue the event by priority class, no thread is used until a scheduler worker handles it."""
+    return await scheduler.submit(anarchysubject_event, event=event, logger=logger)
+
+
+@retry_queue.deferring
 def anarchysubject_event(event, logger, **_):
+    sharding.record_event(event)
+    return process_anarchysubject_event(event=event, logger=logger)
+
+
+@scheduler.prioritized
+@metrics.EVENT_HANDLER_SECONDS.time()
+@tracing.traced('anarchysubject_event')
+def process_anarchysubject_event(event, logger, **_):
+    """Pipeline of anarchysubject_event, without the retry queue.
+
+    The backfill calls it directly and handles DependencyUnavailable itself,
+    its process does not run the retry queue.
+    """
     anarchy_subject = event.get('object')
 
     # Only respond to events that include AnarchySubject data.
@@ -141,8 +385,13 @@ def anarchysubject_event(event, logger, **_):
 
     invalid_states = ['new', 'provision-pending']
 
-    resource_vars = get_resource_vars(anarchy_subject)
+    with metrics.stage('get_resource_vars'):
+        resource_vars = get_resource_vars(anarchy_subject)
     resource_current_state = resource_vars.get('current_state')
+    metrics.count_event(event.get('type'), resource_current_state)
+    tracing.set_attributes(provision_uuid=resource_vars.get('resource_claim_uuid'),
+                           event_type=event.get('type'),
+                           current_state=resource_current_state)
     resource_desired_state = resource_vars.get('desired_state')
     resource_claim_uuid = resource_vars.get('resource_claim_uuid')
     resource_claim_requester = resource_vars.get('resource_claim_requester')
@@ -166,7 +415,7 @@ def anarchysubject_event(event, logger, **_):
         query = f"UPDATE provisions SET retired_at = %s, lifetime_interval = %s - provisioned_at \n" \
                 f"WHERE uuid = %s and retired_at ISNULL RETURNING uuid;"
 
-        utils.execute_query(query, positional_args=positional_args, autocommit=True)
+        utils.execute_query(query, positional_args=positional_args, autocommit=True, prepare=True)
 
         utils.provision_lifecycle(resource_claim_uuid, 'destroy-completed', resource_claim_requester)
 
@@ -192,7 +441,7 @@ def populate_provision(logger, anarchy_subject, resource_vars):
 
     provision = prepare(anarchy_subject, logger, resource_vars)
 
-    logger.info(f"Populate Provision {resource_claim_uuid}: {provision}")
+    logger.info(f"Populate Provision {resource_claim_uuid}")
 
     user_name = provision.get('username', None)
     if user_name is None:
@@ -201,16 +450,34 @@ def populate_provision(logger, anarchy_subject, resource_vars):
                        f"anarchy_subject_name: {provision.get('anarchy_subject_name')} -"
                        f"anarchy_governor: {provision.get('anarchy_governor')}")
         provision['user'] = {}
+        if enrichment.enrichment_enabled:
+            provision['user_pending'] = 'requester_missing'
+    elif enrichment.enrichment_enabled and not enrichment.enrichment_inline:
+        provision['user'] = {}
+        provision['user_pending'] = 'deferred'
     else:
         using_cloud_forms = provision.get('using_cloud_forms', False)
-        provision['user'] = search_ipa_user(user_name, logger, using_cloud_forms)
-
-    provision['user_db'] = populate_user(provision, logger)
+        try:
+            with metrics.stage('ldap_user_lookup'):
+                provision['user'] = search_ipa_user(user_name, logger, using_cloud_forms)
+            provision['user_db'] = populate_user(provision, logger)
+        except resilience.DependencyUnavailable as e:
+            if not enrichment.enrichment_enabled or e.dependency != 'ldap':
+                raise
+            logger.warning(f"{e}, the user of provision {resource_claim_uuid} will be enriched later")
+            provision['user'] = {}
+            provision['user_pending'] = 'ldap_unavailable'
+
+    if 'user_db' not in provision:
+        provision['user_db'] = populate_user(provision, logger)
     provision['catalog_id'] = populate_catalog(provision, logger)
 
     prov = Provisions(logger, provision)
     prov.populate_provisions()
 
+    if provision.get('user_pending') and prov.student_id is None:
+        enrichment.enqueue(provision, provision['user_pending'])
+
     provision_result = provision.get('provision_result', 'running')
     if provision_result == 'successful':
         provision_result = 'success'
@@ -249,6 +516,8 @@ def search_ipa_user(user_name, logger, notifier=False):
         results = corp_ldap.ldap_search_user(user_name)
     else:
         logger.info(f"Searching IPA username '{user_name}'")
+        # Only needed for users outside of Red Hat, imported on first use
+        from ipa_ldap import GPTEIpaLdap
         int_ldap = GPTEIpaLdap(logger)
         if notifier and '@' in user_name:
             logger.info(f"Searching IPA username using mail '{user_name}'")
@@ -257,7 +526,7 @@ def search_ipa_user(user_name, logger, notifier=False):
             logger.info(f"Searching IPA username using uid '{user_name}'")
             results = int_ldap.search_ipa_user(user_name)
 
-    logger.debug(f"DEBUG USER: {results}")
+    logs.log_payload('user', f"User {user_name}", results)
     return results
 
 
@@ -350,35 +619,16 @@ def prepare(anarchy_subject, logger, resource_vars):
     resource_current_state = resource_vars.get('current_state')
     resource_desired_state = resource_vars.get('desired_state')
     resource_claim_uuid = resource_vars.get('resource_claim_uuid')
-    resource_claim_requester = resource_vars.get('resource_claim_requester')
     resource_claim_name = resource_vars.get('resource_claim_name')
     resource_claim_namespace = resource_vars.get('resource_claim_namespace')
     resource_label_governor = resource_vars.get('resource_label_governor')
 
-    catalog_display_name = parse_catalog_item(resource_label_governor)
-    catalog_item_display_name = parse_catalog_item(resource_label_governor)
-
-    provision_data = resource_vars.get('provision_data')
     provision_job = resource_vars.get('provision_job')
     provision_job_id = provision_job.get('deployerJob')
-    provision_job_url = provision_job.get('towerJobURL')
-
-    provision_job_start_timestamp = utils.timestamp_to_utc(provision_job.get('startTimestamp'))
-    provision_job_complete_timestamp = utils.timestamp_to_utc(provision_job.get('completeTimestamp'))
 
-    class_list = resource_label_governor.split('.')
-    class_name = f"{class_list[2]}_{class_list[1].replace('-', '_')}".upper()
-
-    chargeback_method = 'regional'
-    sales_force_id = None
-    purpose = None
-    notifier = False
-    resource_guid = None
-    provision_time = 0
-    deploy_interval = None
+    resource_claim = None
     provision_job_vars = {}
-    platform_url = None
-    using_cloud_forms = False
+    provision_job_status = 'running'
 
     logger.info(f"Resource claim UUID: {resource_claim_uuid} - resource_label_governor: {resource_label_governor}")
     logger.info(f"Resource UUID: {resource_claim_uuid} - "
@@ -389,49 +639,21 @@ def prepare(anarchy_subject, logger, resource_vars):
     if resource_claim_name and resource_claim_namespace and \
             resource_current_state not in ('destroying', 'destroy-failed', 'starting'):
         try:
-            resource_claim = custom_objects_api.get_namespaced_custom_object(
-                poolboy_domain, poolboy_api_version,
-                resource_claim_namespace, 'resourceclaims', resource_claim_name
-            )
-
-            # TODO: Remove debug messages
-            logger.debug("RESOURCE CLAIM LOG:")
-            logger.info(json.dumps(resource_claim, default=str))
-
-            resource_claim_metadata = resource_claim['metadata']
-            resource_claim_annotations = resource_claim_metadata['annotations']
-            resource_claim_labels = resource_claim_metadata['labels']
+            with metrics.stage('resource_claim_fetch'), \
+                    tracing.span('kubernetes.get_resourceclaim', resource_claim_namespace=resource_claim_namespace,
+                                 resource_claim_name=resource_claim_name):
+                resource_claim = custom_objects_api.get_namespaced_custom_object(
+                    poolboy_domain, poolboy_api_version,
+                    resource_claim_namespace, 'resourceclaims', resource_claim_name,
+                    _request_timeout=resilience.get('kubernetes').timeout
+                )
+
+            logs.log_payload('resource_claim', f"ResourceClaim {resource_claim_namespace}/{resource_claim_name}",
+                             resource_claim)
 
             utils.save_resource_claim_data(resource_claim_uuid, resource_claim_name,
                                            resource_claim_namespace, resource_claim)
 
-            # Used by CloudForms
-            notifier = resource_claim_annotations.get(f'{babylon_domain}/externalPlatformUrl', False)
-            if notifier:
-                resource_name = resource_claim_metadata.get('name')
-                if resource_name:
-                    resource_guid = resource_name[-4:]
-
-            # if babylon/catalogDisplayName get it from labels/{babylon_domain}/catalogItemName
-            # else, try to get it from resource_claim lables or finally using resource_label_governor
-            catalog_display_name = resource_claim_annotations.get(
-                f"{babylon_domain}/catalogDisplayName",
-                resource_claim_labels.get(f"{babylon_domain}/catalogItemName",
-                                          parse_catalog_item(resource_label_governor))
-            )
-
-            catalog_item_display_name = resource_claim_annotations.get(
-                f"{babylon_domain}/catalogItemDisplayName",
-                resource_claim_labels.get(f"{babylon_domain}/catalogItemName",
-                                          parse_catalog_item(resource_label_governor))
-            )
-
-            # Purpose and SalesForce Opportunity
-            sales_force_id = resource_claim_annotations.get(f"{pfe_domain}/salesforce-id")
-
-            # Purpose
-            purpose = resource_claim_annotations.get(f"{pfe_domain}/purpose")
-
         except ApiException as e:
             if e.status == '404':
                 logger.info(f"Resource Claim not found {resource_claim_name} "
@@ -443,38 +665,139 @@ def prepare(anarchy_subject, logger, resource_vars):
                            f"UUID {resource_claim_uuid} - current_state: {resource_current_state} - {e}")
             pass
 
+    if provision_job_id:
+        with metrics.stage('tower_fetch'), tracing.span('tower.get_job', tower_job_id=provision_job_id):
+            provision_tower_job = get_tower_job(provision_job_id)
+        provision_job_vars = json.loads(provision_tower_job.get('extra_vars', '{}'))
+        provision_job_status = provision_tower_job.get('status', 'running')
+        utils.save_tower_extra_vars(resource_claim_uuid, resource_claim_name, resource_claim_namespace,
+                                    provision_job_vars)
+
+    provision = map_provision(resource_vars, resource_claim, provision_job_vars, provision_job_status,
+                              namespace_requester=namespaces.requester(resource_claim_namespace))
+
     logger.info(f"Provision UUID: {resource_claim_uuid} "
-                f"catalog_display_name: {catalog_display_name} "
-                f"catalog_item_display_name: {catalog_item_display_name}")
+                f"catalog_display_name: {provision['catalog_name']} "
+                f"catalog_item_display_name: {provision['catalog_item']}")
+    logger.debug(f"Provision Time in Minutes: {provision['provision_time']} - "
+                 f"Provision Time Interval: {provision['deploy_interval']}")
+
+    utils.save_provision_vars(resource_claim_uuid, resource_claim_name, resource_claim_namespace, provision)
+    logs.log_payload('provision', f"Provision Details {resource_claim_uuid}", provision)
+
+    return provision
+
+
+@resilience.retrying('tower', retry_on=(requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                                         requests.exceptions.HTTPError))
+def get_tower_job(job_id):
+    resp = requests.get(
+        f"https://{ansible_tower_hostname}/api/v2/jobs/{job_id}",
+        auth=(ansible_tower_user, ansible_tower_password),
+        verify=False,
+        timeout=resilience.get('tower').timeout,
+    )
+    # Retry server errors, a missing job is answered with a JSON error document
+    if resp.status_code >= 500:
+        resp.raise_for_status()
+    return resp.json()
+
+
+def map_provision(resource_vars, resource_claim=None, provision_job_vars=None, provision_job_status='running',
+                  now=None, namespace_requester=None):
+    """Build the provision dictionary from the AnarchySubject vars, the ResourceClaim and
+    the Tower job extra vars. This is the pure part of prepare(), it does not call any
+    external service.
+
+    :param resource_vars: dictionary returned by get_resource_vars()
+    :param resource_claim: ResourceClaim object, None if it was not fetched
+    :param provision_job_vars: extra vars of the provision Tower job
+    :param provision_job_status: status of the provision Tower job
+    :param now: current datetime, used as completion time of running provisions
+    :param namespace_requester: requester of the ResourceClaim namespace, used when no other requester is known
+    :return: provision dictionary
+    """
+    if provision_job_vars is None:
+        provision_job_vars = {}
+
+    resource_current_state = resource_vars.get('current_state')
+    resource_desired_state = resource_vars.get('desired_state')
+    resource_claim_uuid = resource_vars.get('resource_claim_uuid')
+    resource_claim_requester = resource_vars.get('resource_claim_requester')
+    resource_label_governor = resource_vars.get('resource_label_governor')
+
+    catalog_display_name = parse_catalog_item(resource_label_governor)
+    catalog_item_display_name = parse_catalog_item(resource_label_governor)
+
+    provision_data = resource_vars.get('provision_data')
+    provision_job = resource_vars.get('provision_job')
+    provision_job_id = provision_job.get('deployerJob')
+    provision_job_url = provision_job.get('towerJobURL')
+
+    provision_job_start_timestamp = utils.normalize_timestamp(provision_job.get('startTimestamp'))
+    provision_job_complete_timestamp = utils.normalize_timestamp(provision_job.get('completeTimestamp'))
+
+    class_list = resource_label_governor.split('.')
+    class_name = f"{class_list[2]}_{class_list[1].replace('-', '_')}".upper()
+
+    chargeback_method = 'regional'
+    sales_force_id = None
+    purpose = None
+    notifier = False
+    resource_guid = None
+    provision_time = 0
+    deploy_interval = None
+    platform_url = None
+    using_cloud_forms = False
+
+    if resource_claim:
+        resource_claim_metadata = resource_claim['metadata']
+        resource_claim_annotations = resource_claim_metadata['annotations']
+        resource_claim_labels = resource_claim_metadata['labels']
+
+        # Used by CloudForms
+        notifier = resource_claim_annotations.get(f'{babylon_domain}/externalPlatformUrl', False)
+        if notifier:
+            resource_name = resource_claim_metadata.get('name')
+            if resource_name:
+                resource_guid = resource_name[-4:]
+
+        # if babylon/catalogDisplayName get it from labels/{babylon_domain}/catalogItemName
+        # else, try to get it from resource_claim lables or finally using resource_label_governor
+        catalog_display_name = resource_claim_annotations.get(
+            f"{babylon_domain}/catalogDisplayName",
+            resource_claim_labels.get(f"{babylon_domain}/catalogItemName",
+                                      parse_catalog_item(resource_label_governor))
+        )
+
+        catalog_item_display_name = resource_claim_annotations.get(
+            f"{babylon_domain}/catalogItemDisplayName",
+            resource_claim_labels.get(f"{babylon_domain}/catalogItemName",
+                                      parse_catalog_item(resource_label_governor))
+        )
+
+        # Purpose and SalesForce Opportunity
+        sales_force_id = resource_claim_annotations.get(f"{pfe_domain}/salesforce-id")
+
+        # Purpose
+        purpose = resource_claim_annotations.get(f"{pfe_domain}/purpose")
 
     if provision_job_start_timestamp:
         # if provision has no completed, using current datetime as completed time
         if not provision_job_complete_timestamp:
-            provision_time = (datetime.now(timezone.utc) - provision_job_start_timestamp).total_seconds() / 60.0
-            deploy_interval = datetime.now(timezone.utc) - provision_job_start_timestamp
+            now = now or datetime.now(timezone.utc)
+            provision_time = (now - provision_job_start_timestamp).total_seconds() / 60.0
+            deploy_interval = now - provision_job_start_timestamp
         else:
             provision_time = (provision_job_complete_timestamp - provision_job_start_timestamp).total_seconds() / 60.0
             deploy_interval = provision_job_complete_timestamp - provision_job_start_timestamp
 
-        logger.debug(f"Provision Time in Minutes: {provision_time} - Provision Time Interval: {deploy_interval}")
+    # If resource_claim_requester is null try to get it from provision_job_vars
+    if provision_job_id and not resource_claim_requester:
+        resource_claim_requester = provision_job_vars.get('requester_username')
 
-    provision_job_status = 'running'
-
-    if provision_job_id:
-        resp = requests.get(
-            f"https://{ansible_tower_hostname}/api/v2/jobs/{provision_job_id}",
-            auth=(ansible_tower_user, ansible_tower_password),
-            verify=False,
-        )
-        provision_tower_job = resp.json()
-        provision_job_vars = json.loads(provision_tower_job.get('extra_vars', '{}'))
-        provision_job_status = provision_tower_job.get('status', 'running')
-        utils.save_tower_extra_vars(resource_claim_uuid, resource_claim_name, resource_claim_namespace,
-                                    provision_job_vars)
-
-        # If resource_claim_requester is null try to get it from provision_job_vars
-        if not resource_claim_requester:
-            resource_claim_requester = provision_job_vars.get('requester_username')
+    if not resource_claim_requester:
+        resource_claim_requester = namespace_requester
 
     babylon_guid = provision_job_vars.get('guid', resource_vars.get('babylon_guid'))
     workshop_users = provision_job_vars.get('user_count', provision_job_vars.get('num_users', 1))
@@ -566,7 +889,4 @@ def prepare(anarchy_subject, logger, resource_vars):
         'provision_result': provision_job_status
     }
 
-    utils.save_provision_vars(resource_claim_uuid, resource_claim_name, resource_claim_namespace, provision)
-    logger.info(f"Provision Details: {provision}")
-
     return provision
@@ -1,8 +1,20 @@
-from simple_salesforce import Salesforce
 import requests
 import os
+import resilience
 import utils
-from retrying import retry
+import tracing
+
+
+class TimeoutSession(requests.Session):
+    """Session applying a default timeout, simple_salesforce does not take one."""
+
+    def __init__(self, timeout):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, *args, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super().request(*args, **kwargs)
 
 
 class SalesForce(object):
@@ -18,11 +30,13 @@ class SalesForce(object):
             with open(os.open(self.sf_cert_key_file, os.O_CREAT | os.O_WRONLY, 0o777), 'w') as fh:
                 fh.write(self.sf_info['sf_cert_key'])
 
-    # Wait 2^x * 500 milliseconds between each retry, up to 5 seconds, then 5 seconds afterwards and 3 attempts
-    @retry(stop_max_attempt_number=3, wait_exponential_multiplier=500, wait_exponential_max=5000)
+    @resilience.retrying('salesforce')
     def sf_connect(self):
+        # simple_salesforce is slow to import and only used here
+        from simple_salesforce import Salesforce
+
         try:
-            session = requests.Session()
+            session = TimeoutSession(resilience.get('salesforce').timeout)
             sf = Salesforce(instance=self.sf_info['sf_host'],
                             consumer_key=self.sf_info['sf_consumer_key'],
                             privatekey_file=self.sf_cert_key_file,
@@ -33,7 +47,9 @@ class SalesForce(object):
             self.logger.error("Error connecting to SalesForce", stack_info=True)
             raise Exception(f"Failed to connect {e}")
 
+    @tracing.traced('salesforce.query')
     def execute_sf_query(self, query):
+        tracing.set_attributes(soql=query)
         if self.sf_conn is None:
             self.sf_conn = self.sf_connect()
         try:
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""Local snapshot of the corporate org chart for the headcount resolution.
+
+The users of the corporate directory (uid, mails, manager, cost center and
+geo) are dumped with paged searches into a SQLite file, indexed by uid and
+by mail. The chargeback manager of a user is then found by walking up the
+managers in the file instead of one LDAP search per level. The operator
+dumps the directory again every ORG_CHART_REFRESH_INTERVAL seconds. Users
+missing from the snapshot, or a snapshot older than ORG_CHART_MAX_AGE, are
+searched in LDAP as before.
+
+    python org_chart.py dump                       # dump the directory now
+    python org_chart.py lookup jdoe@redhat.com     # print a user and its managers
+"""
+import os
+import sys
+
+if __name__ == '__main__':
+    # operator.py would shadow the standard library operator module, move this directory last
+    sys.path.append(sys.path.pop(0))
+
+import asyncio
+import sqlite3
+import threading
+import time
+
+import logs
+import metrics
+from corp_ldap import GPTELdap, top_level_managers
+
+org_chart_enabled = os.environ.get('ORG_CHART_ENABLED', 'false').lower() == 'true'
+org_chart_path = os.environ.get('ORG_CHART_PATH', '/tmp/org_chart.sqlite')
+org_chart_refresh_interval = float(os.environ.get('ORG_CHART_REFRESH_INTERVAL', 24 * 3600))
+# Older snapshots are not used, users are searched in LDAP
+org_chart_max_age = float(os.environ.get('ORG_CHART_MAX_AGE', 3 * 24 * 3600))
+# Levels walked up before giving up, the org chart may contain cycles
+org_chart_max_depth = 32
+
+logger = logs.get_logger('org_chart')
+
+schema = """
+CREATE TABLE users (
+    uid TEXT PRIMARY KEY,
+    mail TEXT,
+    cn TEXT,
+    title TEXT,
+    manager_uid TEXT,
+    cost_center TEXT,
+    geo TEXT
+) WITHOUT ROWID;
+CREATE TABLE mails (
+    mail TEXT PRIMARY KEY,
+    uid TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+dump_attributes = ['uid', 'mail', 'rhatPreferredAlias', 'cn', 'title', 'manager', 'rhatCostCenter', 'rhatGeo']
+
+
+def _first(entry, attribute):
+    values = entry.get(attribute)
+    return values[0].decode('utf-8') if values else None
+
+
+def dump(path=None):
+    """Dump the users of the active and deleted bases into a new SQLite file.
+
+    The file is written next to `path` and renamed, readers keep the previous
+    snapshot until they reopen it.
+
+    Returns:
+        int: Number of users dumped.
+    """
+    path = path or org_chart_path
+    started = time.monotonic()
+    directory = GPTELdap(logger)
+    directory.ldap_connect()
+
+    tmp_path = f"{path}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    db = sqlite3.connect(tmp_path)
+    try:
+        db.executescript(schema)
+        count = 0
+        # Active users first, a deleted entry does not replace an active one
+        for basedn in (directory.ldap_info['basedn'], directory.ldap_info['basedndeleted']):
+            for dn, entry in directory.paged_search(basedn, '(objectClass=posixAccount)', dump_attributes):
+                uid = _first(entry, 'uid')
+                if uid is None:
+                    continue
+                manager_dn = _first(entry, 'manager')
+                manager_uid = manager_dn.split(',')[0].replace('uid=', '') if manager_dn else None
+                cursor = db.execute("INSERT OR IGNORE INTO users VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                    (uid, _first(entry, 'mail'), _first(entry, 'cn'), _first(entry, 'title'),
+                                     manager_uid, _first(entry, 'rhatCostCenter'), _first(entry, 'rhatGeo')))
+                if cursor.rowcount == 0:
+                    continue
+                count += 1
+                mails = {v.decode('utf-8').lower() for v in entry.get('mail', []) + entry.get('rhatPreferredAlias', [])}
+                # Managers are found by <uid>@redhat.com, see corp_ldap.manager_dn_email()
+                mails.add(f"{uid.lower()}@redhat.com")
+                db.executemany("INSERT OR IGNORE INTO mails VALUES (?, ?)", [(mail, uid) for mail in mails])
+        db.execute("INSERT INTO meta VALUES ('dumped_at', ?)", (str(time.time()),))
+        db.commit()
+    finally:
+        db.close()
+    os.replace(tmp_path, path)
+
+    metrics.ORG_CHART_USERS.set(count)
+    logger.info(f"Dumped {count} users of the org chart in {time.monotonic() - started:.1f}s")
+    return count
+
+
+class OrgChart(object):
+    """Read only access to a snapshot written by dump(), one connection per thread."""
+
+    def __init__(self, path=None):
+        self.path = path or org_chart_path
+        self.local = threading.local()
+        # Incremented when a new snapshot is dumped, the threads then reopen the file
+        self.generation = 0
+
+    def connection(self):
+        if getattr(self.local, 'generation', None) != self.generation:
+            if getattr(self.local, 'db', None) is not None:
+                self.local.db.close()
+            self.local.db = None
+            self.local.dumped_at = None
+            self.local.generation = self.generation
+            if os.path.exists(self.path):
+                self.local.db = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+                self.local.db.row_factory = sqlite3.Row
+                row = self.local.db.execute("SELECT value FROM meta WHERE key = 'dumped_at'").fetchone()
+                self.local.dumped_at = float(row['value']) if row else None
+        return self.local.db
+
+    def reload(self):
+        self.generation += 1
+
+    def available(self):
+        """Check if there is a snapshot recent enough to be used."""
+        db = self.connection()
+        return db is not None and self.local.dumped_at is not None \
+            and time.time() - self.local.dumped_at < org_chart_max_age
+
+    def user_by_uid(self, uid):
+        row = self.connection().execute("SELECT * FROM users WHERE uid = ?", (uid,)).fetchone()
+        return dict(row) if row else None
+
+    def user(self, mail):
+        """Find a user by mail or alias, None if it is not in the snapshot."""
+        row = self.connection().execute(
+            "SELECT users.* FROM mails JOIN users ON users.uid = mails.uid WHERE mails.mail = ?",
+            (mail.lower(),)).fetchone()
+        return dict(row) if row else None
+
+    def search_user(self, mail):
+        """Find a user and its manager, in the shape of GPTELdap.ldap_search_user().
+
+        Returns:
+            dict: None if the user or its manager are not in the snapshot.
+        """
+        user = self.user(mail)
+        if user is None:
+            metrics.cache_miss('org_chart')
+            return None
+        manager = self.user_by_uid(user['manager_uid']) if user['manager_uid'] else {}
+        if manager is None:
+            metrics.cache_miss('org_chart')
+            return None
+        metrics.cache_hit('org_chart')
+        return {
+            'uid': user['uid'],
+            'mail': user['mail'],
+            'cn': user['cn'],
+            'title': user['title'],
+            'rhatCostCenter': user['cost_center'],
+            'rhatGeo': user['geo'],
+            'manager': {
+                'uid': manager.get('uid'),
+                'mail': manager.get('mail'),
+                'cn': manager.get('cn'),
+            },
+        }
+
+    def chargeback_manager(self, mail, managers):
+        """Walk up the managers of a user like GPTELdap.ldap_user_headcount().
+
+        Returns:
+            str: Mail of the first manager in `managers`, 'gpte@redhat.com' at the
+                top of the organization, None if a user of the chain is not in the snapshot.
+        """
+        user = self.user(mail)
+        for _ in range(org_chart_max_depth):
+            if user is None or not user['manager_uid']:
+                metrics.cache_miss('org_chart')
+                return None
+            manager_email = f"{user['manager_uid']}@redhat.com"
+            if manager_email in top_level_managers:
+                metrics.cache_hit('org_chart')
+                return 'gpte@redhat.com'
+            if manager_email in managers:
+                metrics.cache_hit('org_chart')
+                return manager_email
+            user = self.user_by_uid(user['manager_uid'])
+        logger.warning(f"No chargeback manager found for {mail} in {org_chart_max_depth} levels")
+        return None
+
+
+org_chart = OrgChart()
+
+
+def refresh():
+    dump()
+    org_chart.reload()
+
+
+async def maintain(interval=None):
+    """Dump the org chart when it is missing or old, then every `interval` seconds, until the operator exits."""
+    loop = asyncio.get_running_loop()
+    interval = interval or org_chart_refresh_interval
+    while True:
+        age = time.time() - org_chart.local.dumped_at if org_chart.available() else None
+        if age is not None and age < interval:
+            await asyncio.sleep(interval - age)
+            continue
+        try:
+            await loop.run_in_executor(None, refresh)
+        except Exception as e:
+            logger.error(f"Unable to dump the org chart: {e}")
+            # Users are searched in LDAP meanwhile
+            await asyncio.sleep(min(interval, 3600))
+
+
+def main():
+    import argparse
+    import json
+    import logging
+    import kube_client
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['dump', 'lookup'])
+    parser.add_argument('mail', nargs='?')
+    parser.add_argument('--path', default=org_chart_path)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    if args.command == 'dump':
+        kube_client.load_config()
+        dump(args.path)
+        return 0
+
+    chart = OrgChart(args.path)
+    user = chart.user(args.mail)
+    chain = []
+    while user is not None and len(chain) < org_chart_max_depth:
+        chain.append(user)
+        user = chart.user_by_uid(user['manager_uid']) if user['manager_uid'] else None
+    print(json.dumps(chain, indent=2))
+    return 0 if chain else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,119 @@
+import asyncio
+import os
+import random
+import time
+from datetime import datetime, timedelta, timezone
+
+import kube_client
+import logs
+import metrics
+
+# Seconds after which a peer that stopped sending keep-alives is considered dead,
+# this bounds the failover time when the active replica is killed
+peering_lifetime = int(os.environ.get('KOPF_PEERING_LIFETIME', 15))
+# Seconds between two checks of the peering status for the leadership metrics
+peering_check_interval = float(os.environ.get('KOPF_PEERING_CHECK_INTERVAL', 5))
+# Fixed priority of this replica, by default replicas started earlier have a higher priority
+peering_priority = os.environ.get('KOPF_PEERING_PRIORITY')
+
+logger = logs.get_logger('peering')
+
+is_leader = None
+
+
+def startup_priority(started=None):
+    """Priority decreasing with the start time, so a restarted or new replica
+    starts as standby and does not take over from the running one. The random
+    part breaks ties between replicas started in the same second.
+    """
+    started = int(started or time.time())
+    return (2 ** 31 - started) * 1000 + random.randint(0, 999)
+
+
+def configure_peering(settings):
+    """Set the kopf peering options, the peering name comes from the kopf command line.
+
+    Kopf pauses the replicas seeing a live peer with a higher priority and
+    resumes them when it exits or stops sending keep-alives, so only one
+    replica handles events while the others keep their caches warm.
+    """
+    settings.peering.priority = int(peering_priority) if peering_priority else startup_priority()
+    settings.peering.lifetime = peering_lifetime
+
+
+def check_leadership(peering_status, priority, now=None):
+    """Decide if this replica is the active one from the peering object status.
+
+    Args:
+        peering_status (dict): status of the ClusterKopfPeering, peer identity -> peer info.
+        priority (int): Priority of this replica.
+
+    Returns:
+        bool: True if no live peer has a higher priority.
+    """
+    now = now or datetime.now(timezone.utc)
+    for peer in (peering_status or {}).values():
+        if not isinstance(peer, dict) or int(peer.get('priority', 0)) <= priority:
+            continue
+        lastseen = peer.get('lastseen')
+        if lastseen is None:
+            return False
+        deadline = datetime.fromisoformat(lastseen) + timedelta(seconds=int(peer.get('lifetime', 60)))
+        if deadline.tzinfo is None:
+            deadline = deadline.replace(tzinfo=timezone.utc)
+        if deadline > now:
+            return False
+    return True
+
+
+def set_leader(leader):
+    """Record the leadership state.
+
+    Returns:
+        bool: True if this replica was standby and became active.
+    """
+    global is_leader
+
+    if leader == is_leader:
+        return False
+    took_over = is_leader is not None and leader
+    if is_leader is not None:
+        metrics.LEADERSHIP_CHANGES.inc()
+    logger.info("This replica is now %s", 'active' if leader else 'standby')
+    is_leader = leader
+    metrics.LEADER.set(1 if leader else 0)
+    return took_over
+
+
+def get_peering_status(name, clusterwide=True, namespace=None):
+    custom_objects_api = kube_client.custom_objects_api()
+    if clusterwide:
+        peering = custom_objects_api.get_cluster_custom_object('kopf.dev', 'v1', 'clusterkopfpeerings', name)
+    else:
+        peering = custom_objects_api.get_namespaced_custom_object('kopf.dev', 'v1', namespace, 'kopfpeerings', name)
+    return peering.get('status', {})
+
+
+async def monitor_leadership(settings, on_takeover=None):
+    """Update the leadership metrics until the operator exits.
+
+    Kopf does not expose its pause state, the same rule is applied to the
+    peering object it maintains.
+
+    Args:
+        on_takeover (callable): Called in a thread when this standby replica becomes active.
+    """
+    if settings.peering.standalone or not settings.peering.name:
+        set_leader(True)
+        return
+
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            status = await loop.run_in_executor(None, get_peering_status, settings.peering.name,
+                                                settings.peering.clusterwide)
+            if set_leader(check_leadership(status, settings.peering.priority)) and on_takeover:
+                loop.run_in_executor(None, on_takeover)
+        except Exception as e:
+            logger.warning("Unable to check the peering status: %s", e)
+        await asyncio.sleep(peering_check_interval)
@@ -1,3 +1,4 @@
+import logs
 import utils
 from datetime import datetime, timezone
 import json
@@ -12,6 +13,8 @@ class Provisions(object):
         self.user_data = self.prov_data.get('user', {})
         self.provision_uuid = self.prov_data.get('uuid')
         self.provision_guid = self.prov_data.get('guid', self.prov_data.get('babylon_guid'))
+        # Student stored in provisions after populate_provisions()
+        self.student_id = None
 
     def populate_purpose(self, purpose_name):
 
@@ -45,7 +48,7 @@ class Provisions(object):
         if self.debug:
             print(f"Query Insert: \n{query}")
 
-        cur = utils.execute_query(query, positional_args=positional_args, autocommit=True)
+        cur = utils.execute_query(query, positional_args=positional_args, autocommit=True, prepare=True)
 
         if cur['rowcount'] >= 1:
             query_result = cur['query_result'][0]
@@ -53,8 +56,39 @@ class Provisions(object):
         else:
             return {'id': None}
 
+    def mapped_fields(self):
+        """Columns of provisions updated from the provision data alone, without LDAP or database lookups."""
+        return {
+            'provisioned_at': self.prov_data.get('provisioned_at', datetime.now(timezone.utc)),
+            'datasource': self.prov_data.get('datasource', 'BABYLON'),
+            'environment': self.prov_data.get('environment', 'DEV').upper(),
+            # 'guid': self.prov_data.get('guid'),
+            'uuid': self.provision_uuid,
+            'babylon_guid': self.prov_data.get('babylon_guid'),
+            'account': self.prov_data.get('account', 'tests'),
+            'cloud_region': self.prov_data.get('cloud_region'),
+            'purpose': self.prov_data.get('purpose', 'Development'),
+            'cloud': self.prov_data.get('cloud', 'unknown'),
+            'sandbox_name': self.prov_data.get('sandbox_name'),
+            'workshop_users': self.prov_data.get('workshop_users', 1),
+            'workload': self.prov_data.get('workload'),
+            'provision_time': self.prov_data.get('provision_time', 0),
+            'deploy_interval': self.prov_data.get('deploy_interval'),
+            'service_type': self.prov_data.get('servicetype', 'babylon'),
+            'stack_retries': self.prov_data.get('stack_retries', 1),
+            'opportunity': self.prov_data.get('opportunity'),
+            'tshirt_size': self.prov_data.get('tshirt_size'),
+            'class_name': self.prov_data.get('class_name'),
+            'chargeback_method': self.prov_data.get('chargeback_method', 'regular'),
+            'tower_job_id': self.prov_data.get('tower_job_id'),
+            'tower_job_url': self.prov_data.get('tower_job_url'),
+            'anarchy_governor': self.prov_data.get('anarchy_governor'),
+            'anarchy_subject_name': self.prov_data.get('anarchy_subject_name'),
+        }
+
     def populate_provisions(self):
-        self.logger.info(f"Inserting Provision {self.provision_uuid} - {self.prov_data}")
+        self.logger.info(f"Inserting Provision {self.provision_uuid}")
+        logs.log_payload('provision', f"Inserting Provision {self.provision_uuid}", self.prov_data)
         # if self.debug:
         #     print(json.dumps(self.prov_data, indent=2, default=str))
         catalog_id = self.prov_data.get('catalog_id', -1)
@@ -127,53 +161,35 @@ class Provisions(object):
         update_fields = {
             'student_id': student_id,
             'catalog_id': catalog_id,
-            'provisioned_at': self.prov_data.get('provisioned_at', datetime.now(timezone.utc)),
-            'datasource': self.prov_data.get('datasource', 'BABYLON'),
-            'environment': self.prov_data.get('environment', 'DEV').upper(),
-            # 'guid': self.prov_data.get('guid'),
-            'uuid': self.provision_uuid,
-            'babylon_guid': self.prov_data.get('babylon_guid'),
-            'account': self.prov_data.get('account', 'tests'),
-            'cloud_region': self.prov_data.get('cloud_region'),
-            'purpose': purpose,
-            'cloud': cloud,
-            'sandbox_name': self.prov_data.get('sandbox_name'),
-            'workshop_users': self.prov_data.get('workshop_users', 1),
-            'workload': self.prov_data.get('workload'),
-            'provision_time': self.prov_data.get('provision_time', 0),
-            'deploy_interval': self.prov_data.get('deploy_interval'),
-            'service_type': self.prov_data.get('servicetype', 'babylon'),
-            'stack_retries': self.prov_data.get('stack_retries', 1),
-            'opportunity': self.prov_data.get('opportunity'),
+            **self.mapped_fields(),
             'purpose_id': purpose_id,
-            'tshirt_size': self.prov_data.get('tshirt_size'),
             'cost_center': user_cost_center,
             'student_geo': self.user_data.get('region', 'NA'),
             'manager_id': user_manager_id,
-            'class_name': self.prov_data.get('class_name'),
-            'chargeback_method': self.prov_data.get('chargeback_method', 'regular'),
             'manager_chargeback_id': user_manager_chargeback_id,
-            'tower_job_id': self.prov_data.get('tower_job_id'),
-            'tower_job_url': self.prov_data.get('tower_job_url'),
-            'anarchy_governor': self.prov_data.get('anarchy_governor'),
-            'anarchy_subject_name': self.prov_data.get('anarchy_subject_name'),
             'modified_at': datetime.now(timezone.utc),
             'last_state': current_state
         }
 
+        if self.prov_data.get('user_pending'):
+            # The user was not looked up, keep the columns of a previous event or of the enrichment
+            for field in ('student_id', 'cost_center', 'student_geo', 'manager_id', 'manager_chargeback_id'):
+                del update_fields[field]
+
         query, positional_args = utils.create_sql_statement(insert_fields=insert_fields,
                                                             update_fields=update_fields,
                                                             table_name='provisions',
                                                             constraint='provisions_pk',
-                                                            return_field='uuid')
+                                                            return_field='uuid,student_id')
 
         if self.debug:
             print(f"Executing Query insert provisions {self.provision_uuid}: {query} - {positional_args}")
 
-        cur = utils.execute_query(query, positional_args=positional_args, autocommit=True)
+        cur = utils.execute_query(query, positional_args=positional_args, autocommit=True, prepare=True)
 
         if cur['rowcount'] >= 1:
             query_result = cur['query_result'][0]
             self.logger.info(f"Provision Database UUID: {query_result.get('uuid', None)}")
+            self.student_id = query_result.get('student_id')
 
         return self.provision_uuid
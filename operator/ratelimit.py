@@ -0,0 +1,56 @@
+import threading
+import time
+
+
+class TokenBucket(object):
+    """Thread safe token bucket, `rate` tokens per second up to `burst` tokens.
+
+    A rate of 0 disables the limit.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or max(1.0, self.rate))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, tokens=1, reserve=0):
+        """Take tokens if available.
+
+        Args:
+            reserve (float): Tokens which must be left in the bucket, kept for the callers passing a lower reserve.
+
+        Returns:
+            wait (float): 0 when the tokens were taken, otherwise seconds until they are available.
+        """
+        if self.rate <= 0:
+            return 0.0
+        with self.lock:
+            self._refill(time.monotonic())
+            if self.tokens - tokens >= reserve:
+                self.tokens -= tokens
+                return 0.0
+            return (tokens + reserve - self.tokens) / self.rate
+
+    def acquire(self, tokens=1, timeout=None, reserve=0):
+        """Block until the tokens are available.
+
+        Returns:
+            waited (float): Seconds spent waiting, None if the timeout expired first.
+        """
+        started = time.monotonic()
+        while True:
+            wait = self.try_acquire(tokens, reserve)
+            if wait == 0.0:
+                return time.monotonic() - started
+            if timeout is not None:
+                remaining = timeout - (time.monotonic() - started)
+                if remaining <= 0:
+                    return None
+                wait = min(wait, remaining)
+            time.sleep(wait)
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""Recompute the provisions table from the snapshots stored in resource_claim_log.
+
+No Kubernetes, Ansible Tower or LDAP call is made: rows are streamed with
+utils.stream_query(), mapped again with get_resource_vars() and map_provision()
+in a process pool and written back with one UPDATE per batch. Use it after a
+fix of the mapping logic:
+
+    python recompute.py --workers 8
+    python recompute.py --since 2022-01-01 --dry-run
+
+With SNAPSHOT_LATEST_ENABLED=false the snapshots are rebuilt from
+resource_claim_log_history instead, a batch of provisions at a time.
+
+Only the columns computed from the snapshots (see Provisions.mapped_fields)
+are updated. User, manager and catalog columns are kept, and provisions
+missing from the table are skipped, run backfill.py to create them.
+"""
+import os
+import sys
+
+if __name__ == '__main__':
+    # operator.py would shadow the standard library operator module, move this directory last
+    sys.path.append(sys.path.pop(0))
+
+import argparse
+import itertools
+import logging
+import multiprocessing
+import time
+from datetime import datetime, timezone
+
+from psycopg2.extras import execute_values
+
+import logs
+import snapshot_history
+import snapshots
+import utils
+from backfill import load_operator
+from provisions import Provisions
+
+recompute_workers = int(os.environ.get('RECOMPUTE_WORKERS', os.cpu_count() or 1))
+recompute_batch_size = int(os.environ.get('RECOMPUTE_BATCH_SIZE', 1000))
+
+logger = logs.get_logger('recompute')
+
+# operator.py module, loaded before the worker processes are forked
+op = None
+
+select_query = "SELECT provision_uuid, anarchy_subject_json::text, resource_claim_json::text, \n" \
+               "  tower_extra_vars_json::text, provision_vars_json::text \n" \
+               "FROM resource_claim_log \n" \
+               "WHERE anarchy_subject_json IS NOT NULL \n" \
+               "  AND (%s::timestamptz IS NULL OR created_at >= %s::timestamptz);"
+
+# Provisions of the history, logged first after `since` like created_at above
+select_history_query = "SELECT provision_uuid FROM resource_claim_log_history \n" \
+                       "WHERE snapshot_kind = 'anarchy_subject' \n" \
+                       "GROUP BY provision_uuid \n" \
+                       "HAVING %s::timestamptz IS NULL OR MIN(logged_at) >= %s::timestamptz;"
+
+row_kinds = ('anarchy_subject', 'resource_claim', 'tower_extra_vars', 'provision_vars')
+
+
+def stream_history_rows(since, batch_size):
+    """Yield rows like select_query's, with the snapshots rebuilt from resource_claim_log_history."""
+    uuids_iter = utils.stream_query(select_history_query, positional_args=[since, since], itersize=batch_size,
+                                    raw=True, name='recompute_history')
+    try:
+        while True:
+            provision_uuids = [row[0] for row in itertools.islice(uuids_iter, batch_size)]
+            if not provision_uuids:
+                break
+            rebuilt = {kind: snapshot_history.get_snapshots(provision_uuids, kind) for kind in row_kinds}
+            for provision_uuid in provision_uuids:
+                if provision_uuid in rebuilt['anarchy_subject']:
+                    yield (provision_uuid,) + tuple(rebuilt[kind].get(provision_uuid) for kind in row_kinds)
+    finally:
+        uuids_iter.close()
+
+
+def recompute_row(row, now=None):
+    """Map a resource_claim_log row to the provisions columns.
+
+    Runs in the worker processes, the JSON columns are decoded here rather
+    than in the process reading the cursor.
+
+    Returns:
+        (provision_uuid, fields, error): fields is None when the mapping failed.
+    """
+    provision_uuid, anarchy_subject_json, resource_claim_json, tower_extra_vars_json, provision_vars_json = row
+    try:
+        anarchy_subject = snapshots.load_snapshot(anarchy_subject_json)
+        resource_vars = op.get_resource_vars(anarchy_subject)
+        # The status of the provision Tower job is only stored in the saved provision
+        provision_vars = snapshots.load_snapshot(provision_vars_json) or {}
+        provision = op.map_provision(resource_vars,
+                                     snapshots.load_snapshot(resource_claim_json),
+                                     snapshots.load_snapshot(tower_extra_vars_json) or {},
+                                     provision_vars.get('provision_result', 'running'),
+                                     now=now)
+        fields = Provisions(logger, provision).mapped_fields()
+        fields['uuid'] = provision_uuid
+        return provision_uuid, fields, None
+    except Exception as e:
+        return provision_uuid, None, str(e)
+
+
+def _recompute_row(args):
+    return recompute_row(*args)
+
+
+def get_column_types(cursor, table_name):
+    cursor.execute("SELECT attname, format_type(atttypid, atttypmod) FROM pg_attribute \n"
+                   "WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped;", [table_name])
+    return dict(cursor.fetchall())
+
+
+def update_provisions(cursor, rows, column_types):
+    """Update the provisions columns of all rows with a single statement.
+
+    Args:
+        rows (list): Dicts returned by Provisions.mapped_fields(), all with the same keys.
+
+    Returns:
+        rowcount (int): Number of provisions updated.
+    """
+    columns = list(rows[0])
+    # VALUES items are untyped, cast them to the column types
+    template = '(' + ', '.join(f"%s::{column_types[c]}" for c in columns) + ')'
+    assignments = ', '.join(f"{c} = v.{c}" for c in columns if c != 'uuid')
+    query = f"UPDATE provisions SET {assignments}, modified_at = NOW() \n" \
+            f"FROM (VALUES %s) AS v ({', '.join(columns)}) \n" \
+            f"WHERE provisions.uuid = v.uuid"
+
+    values = [utils.convert_elements_to_pg_arrays([row[c] for c in columns]) for row in rows]
+    query_start = time.monotonic()
+    execute_values(cursor, query, values, template=template, page_size=len(values))
+    utils.record_query_stats(query, time.monotonic() - query_start, cursor.rowcount)
+    return cursor.rowcount
+
+
+def recompute(workers=None, batch_size=None, since=None, dry_run=False):
+    workers = workers or recompute_workers
+    batch_size = batch_size or recompute_batch_size
+    now = datetime.now(timezone.utc)
+    processed = updated = errors = 0
+    started = time.monotonic()
+
+    write_conn = utils.get_db_connection()
+    if snapshots.snapshot_latest_enabled:
+        rows_iter = utils.stream_query(select_query, positional_args=[since, since], itersize=batch_size, raw=True,
+                                       name='recompute_provisions')
+    else:
+        rows_iter = stream_history_rows(since, batch_size)
+    # Fork, the workers inherit the loaded operator module
+    pool = multiprocessing.get_context('fork').Pool(workers)
+    try:
+        write_cursor = write_conn.cursor()
+        column_types = get_column_types(write_cursor, 'provisions')
+
+        while True:
+            rows = list(itertools.islice(rows_iter, batch_size))
+            if not rows:
+                break
+
+            results = pool.map(_recompute_row, [(row, now) for row in rows],
+                               chunksize=max(1, len(rows) // (workers * 4)))
+            mapped = []
+            for provision_uuid, fields, error in results:
+                if fields is None:
+                    errors += 1
+                    logger.error(f"Unable to recompute provision {provision_uuid}: {error}")
+                else:
+                    mapped.append(fields)
+
+            if mapped and not dry_run:
+                updated += update_provisions(write_cursor, mapped, column_types)
+                write_conn.commit()
+
+            processed += len(rows)
+            elapsed = time.monotonic() - started
+            logger.info(f"Recomputed {processed} provisions, {updated} updated, {errors} errors, "
+                        f"{processed / elapsed:.1f} provisions/s")
+
+        write_cursor.close()
+    finally:
+        rows_iter.close()
+        pool.close()
+        pool.join()
+        write_conn.rollback()
+        utils.put_db_connection(write_conn)
+
+    return {'processed': processed, 'updated': updated, 'errors': errors}
+
+
+def main():
+    global op
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=recompute_workers, help='Number of worker processes')
+    parser.add_argument('--batch-size', type=int, default=recompute_batch_size,
+                        help='Rows fetched, mapped and updated at a time')
+    parser.add_argument('--since', help='Only recompute provisions logged after this ISO 8601 timestamp')
+    parser.add_argument('--dry-run', action='store_true', help='Map the provisions without updating them')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    op = load_operator()
+    op.load_kube_config()
+    since = utils.normalize_timestamp(args.since) if args.since else None
+    result = recompute(workers=args.workers, batch_size=args.batch_size, since=since, dry_run=args.dry_run)
+    logger.info(f"Done: {result}")
+    return 1 if result['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
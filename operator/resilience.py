@@ -0,0 +1,162 @@
+"""Timeouts, retries and circuit breakers for the external dependencies.
+
+Every dependency (Tower, LDAP, Salesforce, Kubernetes, the database) has
+its own settings, read from <NAME>_TIMEOUT, <NAME>_RETRIES... environment
+variables. Calls are rate limited by <NAME>_RATE_LIMIT (see scheduler.py)
+and retried a few times with a jittered exponential backoff. After
+CIRCUIT_BREAKER_FAILURES consecutive failures the breaker
+opens and calls fail immediately with DependencyUnavailable for
+CIRCUIT_BREAKER_RESET_SECONDS, then a single trial call is let through.
+"""
+import functools
+import os
+import random
+import threading
+import time
+
+import logs
+import metrics
+import scheduler
+from ratelimit import TokenBucket
+
+logger = logs.get_logger('resilience')
+
+circuit_breaker_failures = int(os.environ.get('CIRCUIT_BREAKER_FAILURES', 5))
+circuit_breaker_reset_seconds = float(os.environ.get('CIRCUIT_BREAKER_RESET_SECONDS', 30))
+
+
+class DependencyUnavailable(Exception):
+    """A dependency failed after its retries, or its circuit breaker is open."""
+
+    def __init__(self, dependency, reason):
+        super().__init__(f"{dependency} is unavailable: {reason}")
+        self.dependency = dependency
+        self.reason = reason
+
+
+class Dependency(object):
+    def __init__(self, name, timeout, retries, backoff, max_backoff, rate_limit=0, rate_burst=None):
+        prefix = name.upper()
+        self.name = name
+        # Seconds, passed by the callers to their client library
+        self.timeout = float(os.environ.get(f"{prefix}_TIMEOUT", timeout))
+        # Attempts after the first one
+        self.retries = int(os.environ.get(f"{prefix}_RETRIES", retries))
+        self.backoff = float(os.environ.get(f"{prefix}_RETRY_BACKOFF", backoff))
+        self.max_backoff = float(os.environ.get(f"{prefix}_RETRY_MAX_BACKOFF", max_backoff))
+        self.breaker = CircuitBreaker(name)
+        # Calls per second, 0 disables the limit, see scheduler.throttle()
+        self.limiter = TokenBucket(float(os.environ.get(f"{prefix}_RATE_LIMIT", rate_limit)),
+                                   int(os.environ.get(f"{prefix}_RATE_BURST", rate_burst or 0)) or None)
+
+    def backoff_delay(self, attempt):
+        """Full jitter, a random delay up to the exponential backoff of the attempt."""
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+
+class CircuitBreaker(object):
+    """Closed, open after `failures` consecutive failures, half open after `reset_seconds`."""
+
+    def __init__(self, name, failures=None, reset_seconds=None):
+        self.name = name
+        self.failures = failures or circuit_breaker_failures
+        self.reset_seconds = circuit_breaker_reset_seconds if reset_seconds is None else reset_seconds
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        """Check if a call may be made, only one trial call is allowed once the reset time elapsed."""
+        if self.opened_at is None:
+            return True
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.trial_running or time.monotonic() - self.opened_at < self.reset_seconds:
+                return False
+            self.trial_running = True
+            return True
+
+    def record_success(self):
+        if self.consecutive_failures == 0 and self.opened_at is None:
+            return
+        with self.lock:
+            if self.opened_at is not None:
+                logger.info("Circuit breaker of %s closed", self.name)
+            self.consecutive_failures = 0
+            self.opened_at = None
+            self.trial_running = False
+        metrics.CIRCUIT_BREAKER_OPEN.labels(dependency=self.name).set(0)
+
+    def record_failure(self):
+        metrics.DEPENDENCY_FAILURES.labels(dependency=self.name).inc()
+        with self.lock:
+            self.consecutive_failures += 1
+            if self.trial_running or (self.opened_at is None and self.consecutive_failures >= self.failures):
+                if self.opened_at is None:
+                    logger.warning("Circuit breaker of %s opened after %d failures",
+                                   self.name, self.consecutive_failures)
+                self.opened_at = time.monotonic()
+                self.trial_running = False
+                metrics.CIRCUIT_BREAKER_OPEN.labels(dependency=self.name).set(1)
+
+
+dependencies = {
+    'tower': Dependency('tower', timeout=30, retries=2, backoff=0.5, max_backoff=5, rate_limit=10, rate_burst=20),
+    'ldap': Dependency('ldap', timeout=10, retries=2, backoff=0.5, max_backoff=5, rate_limit=50, rate_burst=100),
+    'salesforce': Dependency('salesforce', timeout=30, retries=2, backoff=0.5, max_backoff=5,
+                             rate_limit=5, rate_burst=10),
+    'kubernetes': Dependency('kubernetes', timeout=30, retries=2, backoff=0.5, max_backoff=5),
+    'database': Dependency('database', timeout=10, retries=2, backoff=0.5, max_backoff=5),
+}
+
+
+def get(name):
+    return dependencies[name]
+
+
+def call(name, func, *args, retry_on=(Exception,), **kwargs):
+    """Call func through the circuit breaker of the dependency, retrying on `retry_on` exceptions.
+
+    Other exceptions are raised as they are and do not count as failures.
+
+    Raises:
+        DependencyUnavailable: The breaker is open or every attempt failed.
+    """
+    dependency = dependencies[name]
+    breaker = dependency.breaker
+    for attempt in range(dependency.retries + 1):
+        if not breaker.allow():
+            raise DependencyUnavailable(name, 'circuit breaker open')
+        scheduler.throttle(dependency)
+        try:
+            result = func(*args, **kwargs)
+        except retry_on as e:
+            breaker.record_failure()
+            if attempt >= dependency.retries or breaker.is_open:
+                raise DependencyUnavailable(name, e) from e
+            delay = dependency.backoff_delay(attempt)
+            logger.warning("Call to %s failed, retrying in %.1fs: %s", name, delay, e)
+            time.sleep(delay)
+        except Exception:
+            # The dependency answered, the error is not about its availability
+            breaker.record_success()
+            raise
+        else:
+            breaker.record_success()
+            return result
+
+
+def retrying(name, retry_on=(Exception,)):
+    """Decorator making every call of the function go through call()."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return call(name, func, *args, retry_on=retry_on, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,131 @@
+import asyncio
+import functools
+import heapq
+import os
+import random
+import threading
+import time
+
+import logs
+import metrics
+from resilience import DependencyUnavailable
+
+# Seconds before the first retry of a deferred event, doubled on each attempt
+retry_queue_delay = float(os.environ.get('RETRY_QUEUE_DELAY', 30))
+retry_queue_max_delay = float(os.environ.get('RETRY_QUEUE_MAX_DELAY', 600))
+retry_queue_max_attempts = int(os.environ.get('RETRY_QUEUE_MAX_ATTEMPTS', 10))
+retry_queue_size = int(os.environ.get('RETRY_QUEUE_SIZE', 10000))
+retry_queue_interval = float(os.environ.get('RETRY_QUEUE_INTERVAL', 5))
+
+logger = logs.get_logger('retry_queue')
+
+
+class RetryQueue(object):
+    """Events deferred because a dependency was unavailable, keyed by object UID.
+
+    Only the latest event of an object is kept, and a newer event handled
+    successfully removes it.
+    """
+
+    def __init__(self, size=None):
+        self.size = size or retry_queue_size
+        # uid -> (due, attempts, event)
+        self.entries = {}
+        # (due, uid) heap, entries replaced or removed are skipped when popped
+        self.schedule = []
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def delay(self, attempts):
+        delay = min(retry_queue_max_delay, retry_queue_delay * 2 ** (attempts - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def defer(self, uid, event, attempts):
+        """Queue the event for its attempt number `attempts`.
+
+        Returns:
+            bool: False if the event was dropped.
+        """
+        if attempts > retry_queue_max_attempts:
+            self.discard(uid)
+            metrics.EVENTS_ABANDONED.inc()
+            return False
+        due = time.monotonic() + self.delay(attempts)
+        with self.lock:
+            if uid not in self.entries and len(self.entries) >= self.size:
+                metrics.EVENTS_ABANDONED.inc()
+                return False
+            self.entries[uid] = (due, attempts, event)
+            heapq.heappush(self.schedule, (due, uid))
+            metrics.RETRY_QUEUE_LENGTH.set(len(self.entries))
+        return True
+
+    def discard(self, uid):
+        if uid not in self.entries:
+            return
+        with self.lock:
+            self.entries.pop(uid, None)
+            metrics.RETRY_QUEUE_LENGTH.set(len(self.entries))
+
+    def pop_due(self, now=None):
+        """Remove and return the (attempts, event) of the entries due."""
+        now = now or time.monotonic()
+        due_entries = []
+        with self.lock:
+            while self.schedule and self.schedule[0][0] <= now:
+                due, uid = heapq.heappop(self.schedule)
+                entry = self.entries.get(uid)
+                if entry is None or entry[0] != due:
+                    continue
+                del self.entries[uid]
+                due_entries.append(entry[1:])
+            metrics.RETRY_QUEUE_LENGTH.set(len(self.entries))
+        return due_entries
+
+
+queue = RetryQueue()
+
+
+def _uid(event):
+    return ((event.get('object') or {}).get('metadata') or {}).get('uid')
+
+
+def deferring(handler):
+    """Decorate an event handler to queue its event when a dependency is unavailable.
+
+    The handler is called again by process() with `retry_attempt` set.
+    """
+    @functools.wraps(handler)
+    def wrapper(*args, event, retry_attempt=0, **kwargs):
+        uid = _uid(event)
+        try:
+            result = handler(*args, event=event, **kwargs)
+        except DependencyUnavailable as e:
+            if uid is None:
+                raise
+            metrics.EVENTS_DEFERRED.labels(dependency=e.dependency).inc()
+            if queue.defer(uid, event, retry_attempt + 1):
+                kwargs['logger'].warning(f"{e}, event deferred (attempt {retry_attempt + 1})")
+            else:
+                kwargs['logger'].error(f"{e}, event dropped after {retry_attempt + 1} attempts")
+            return None
+        # A newer event was handled, the deferred one is outdated
+        if uid is not None:
+            queue.discard(uid)
+        return result
+    return wrapper
+
+
+async def process(handler, interval=None):
+    """Call the handler again for the deferred events until the operator exits."""
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(interval or retry_queue_interval)
+        for attempts, event in queue.pop_due():
+            try:
+                await loop.run_in_executor(None, functools.partial(
+                    handler, event=event, logger=logger, retry_attempt=attempts))
+            except Exception as e:
+                logger.error("Unable to handle deferred event: %s", e)
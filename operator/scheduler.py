@@ -0,0 +1,170 @@
+"""Priority scheduling of the AnarchySubject events.
+
+Events are classified when they reach the handler:
+
+- billing: destroy and terminal states, whose updates set retired_at,
+  lifetime_interval and the provision results
+- transition: the state changed since the last event of the AnarchySubject
+- routine: the same state again, like the repeated `started` events
+
+The kopf handler is a coroutine which queues the event by class then
+arrival and waits for one of the SCHEDULER_SLOTS worker threads to handle
+it, so a storm of events waits in the queue rather than in the thread pool
+of kopf, and a billing event queued last is handled next. The calls to
+Tower, LDAP and Salesforce take a token from the bucket of their dependency
+(<NAME>_RATE_LIMIT calls per second). Transition and routine events leave
+part of the bucket to the billing events, so these do not wait behind an
+event storm.
+
+Bulk jobs and background workers calling the dependencies outside of an
+event are scheduled as routine.
+"""
+import asyncio
+import concurrent.futures
+import functools
+import heapq
+import itertools
+import os
+import threading
+import time
+
+import metrics
+
+scheduler_enabled = os.environ.get('SCHEDULER_ENABLED', 'true').lower() == 'true'
+# Worker threads handling the events, the other events wait in the queue
+scheduler_slots = int(os.environ.get('SCHEDULER_SLOTS', 8))
+
+BILLING, TRANSITION, ROUTINE = 0, 1, 2
+priority_names = ('billing', 'transition', 'routine')
+# Fraction of the token buckets a class must leave to the classes before it
+priority_reserves = (0.0, 0.25, 0.5)
+
+# States whose events update the billing columns of the provisions
+billing_states = ('destroying', 'destroy-failed', 'destroy-canceled', 'provision-failed', 'provision-canceled')
+
+_local = threading.local()
+
+
+class PriorityExecutor(object):
+    """Worker threads running the submitted calls by priority then arrival."""
+
+    def __init__(self, workers):
+        # (priority, sequence, submitted, function, future) heap of the waiting calls
+        self.queue = []
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.threads = [threading.Thread(target=self._work, name=f"scheduler-{i}", daemon=True)
+                        for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, priority, function):
+        """Queue a call.
+
+        Returns:
+            future (concurrent.futures.Future): Result of the call, a call cancelled while queued is skipped.
+        """
+        future = concurrent.futures.Future()
+        with self.condition:
+            heapq.heappush(self.queue, (priority, next(self.sequence), time.monotonic(), function, future))
+            metrics.SCHEDULER_WAITING.labels(priority=priority_names[priority]).inc()
+            self.condition.notify()
+        return future
+
+    def _work(self):
+        while True:
+            with self.condition:
+                while not self.queue:
+                    self.condition.wait()
+                priority, _, submitted, function, future = heapq.heappop(self.queue)
+                metrics.SCHEDULER_WAITING.labels(priority=priority_names[priority]).dec()
+            metrics.SCHEDULER_WAIT_SECONDS.labels(priority=priority_names[priority]) \
+                .observe(time.monotonic() - submitted)
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(function())
+            except BaseException as e:
+                future.set_exception(e)
+
+
+# Created by configure_scheduler(), the CLI scripts call the handlers directly
+executor = None
+# AnarchySubject UID -> state of its last event handled
+last_states = {}
+
+
+def configure_scheduler():
+    global executor
+
+    if not scheduler_enabled:
+        return
+    executor = PriorityExecutor(scheduler_slots)
+
+
+def classify(event):
+    """Get the priority class of an AnarchySubject event."""
+    anarchy_subject = event.get('object') or {}
+    state = ((anarchy_subject.get('spec') or {}).get('vars') or {}).get('current_state')
+    if event.get('type') == 'DELETED' or state in billing_states:
+        return BILLING
+    last_state = last_states.get((anarchy_subject.get('metadata') or {}).get('uid'))
+    if last_state is None:
+        # The initial listing after a restart, most objects did not change
+        return ROUTINE if event.get('type') is None else TRANSITION
+    return ROUTINE if last_state == state else TRANSITION
+
+
+def current_priority():
+    """Priority class of the event handled by this thread, routine outside of an event."""
+    priority = getattr(_local, 'priority', None)
+    return ROUTINE if priority is None else priority
+
+
+def throttle(dependency):
+    """Take a token from the rate limiter of a resilience Dependency before calling it."""
+    limiter = dependency.limiter
+    if limiter.rate <= 0:
+        return
+    priority = current_priority()
+    reserve = min(limiter.burst * priority_reserves[priority], limiter.burst - 1)
+    waited = limiter.acquire(reserve=reserve)
+    if waited:
+        metrics.RATE_LIMIT_WAIT_SECONDS.labels(dependency=dependency.name, priority=priority_names[priority]) \
+            .observe(waited)
+
+
+async def submit(handler, event, **kwargs):
+    """Queue an event for a synchronous handler by priority class and wait for its result.
+
+    Called from the kopf handler coroutine, so the queued events do not hold
+    a thread. Without scheduler the handler runs in the default executor.
+    """
+    call = functools.partial(handler, event=event, **kwargs)
+    if executor is None:
+        return await asyncio.get_running_loop().run_in_executor(None, call)
+    return await asyncio.wrap_future(executor.submit(classify(event), call))
+
+
+def prioritized(handler):
+    """Decorate an event handler to set the priority class of its event for the rate limits of its calls."""
+    @functools.wraps(handler)
+    def wrapper(*args, **kwargs):
+        event = kwargs.get('event') or {}
+        priority = classify(event)
+        previous_priority = getattr(_local, 'priority', None)
+        _local.priority = priority
+        try:
+            result = handler(*args, **kwargs)
+        finally:
+            _local.priority = previous_priority
+
+        anarchy_subject = event.get('object') or {}
+        uid = (anarchy_subject.get('metadata') or {}).get('uid')
+        if uid is not None:
+            if event.get('type') == 'DELETED':
+                last_states.pop(uid, None)
+            else:
+                last_states[uid] = ((anarchy_subject.get('spec') or {}).get('vars') or {}).get('current_state')
+        return result
+    return wrapper
@@ -0,0 +1,290 @@
+import asyncio
+import bisect
+import hashlib
+import os
+import socket
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+import kubernetes
+
+import kube_client
+import logs
+import metrics
+import scheduler
+
+# When enabled, every replica is active and handles the AnarchySubjects of its slice of
+# a consistent hash ring of provision UUIDs. Membership is tracked with one Lease per replica.
+sharding_enabled = os.environ.get('SHARDING_ENABLED', 'false').lower() == 'true'
+shard_group = os.environ.get('SHARDING_GROUP', 'babylon-reporting')
+shard_namespace = os.environ.get('SHARDING_NAMESPACE', 'babylon-reporting')
+shard_identity = os.environ.get('POD_ID', socket.gethostname())
+# A replica whose Lease was not renewed for this many seconds leaves the ring
+lease_duration = int(os.environ.get('SHARDING_LEASE_DURATION', 15))
+lease_renew_interval = float(os.environ.get('SHARDING_LEASE_RENEW_INTERVAL', 5))
+# Points per replica on the ring, more points spread the keys more evenly
+virtual_nodes = int(os.environ.get('SHARDING_VIRTUAL_NODES', 128))
+# Seconds without membership change before catching up with the AnarchySubjects gained,
+# a rolling update changes the members several times in a row
+settle_seconds = float(os.environ.get('SHARDING_SETTLE_SECONDS', lease_duration))
+# DELETED and billing events of the other shards kept to be replayed if their keys move here
+skipped_events_size = int(os.environ.get('SHARDING_SKIPPED_EVENTS', 10000))
+
+shard_group_label = 'babylon-reporting/shard-group'
+
+logger = logs.get_logger('sharding')
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing(object):
+    """Consistent hash ring, adding or removing a member only moves the keys of that member."""
+    __slots__ = ('members', 'points', 'owners')
+
+    def __init__(self, members, replicas=None):
+        self.members = tuple(sorted(members))
+        ring = sorted((_hash(f"{member}#{i}"), member)
+                      for member in self.members for i in range(replicas or virtual_nodes))
+        self.points = [point for (point, _) in ring]
+        self.owners = [member for (_, member) in ring]
+
+    def owner(self, key):
+        if not self.points:
+            return None
+        index = bisect.bisect(self.points, _hash(key)) % len(self.points)
+        return self.owners[index]
+
+
+ring = HashRing([shard_identity])
+# Rings since the last catch-up, the first one is the ring of the last catch-up and the last one is `ring`
+seen_rings = [ring]
+
+
+def shard_key(anarchy_subject):
+    """Provision UUID of an AnarchySubject, as found by get_resource_vars(), or its name."""
+    job_vars = anarchy_subject.get('spec', {}).get('vars', {}).get('job_vars', {})
+    if job_vars.get('uuid'):
+        return job_vars['uuid']
+    metadata = anarchy_subject.get('metadata', {})
+    for annotation, value in metadata.get('annotations', {}).items():
+        if annotation.endswith('/resource-handle-uid'):
+            return value
+    return metadata.get('name', '')
+
+
+def owns(key):
+    return not sharding_enabled or ring.owner(key) == shard_identity
+
+
+# AnarchySubject UID -> monotonic time of its last event delivered by kopf
+_event_times = {}
+_event_times_lock = threading.Lock()
+
+
+def record_event(event):
+    """Remember when kopf delivered an event, a catch-up must not overwrite it with an older listing."""
+    if not sharding_enabled:
+        return
+    uid = (event.get('object') or {}).get('metadata', {}).get('uid')
+    if uid is None:
+        return
+    with _event_times_lock:
+        if event.get('type') == 'DELETED':
+            _event_times.pop(uid, None)
+        else:
+            _event_times[uid] = time.monotonic()
+
+
+def event_since(uid, started):
+    """Whether kopf delivered an event of this AnarchySubject after `started` (monotonic time)."""
+    with _event_times_lock:
+        return _event_times.get(uid, 0) >= started
+
+
+# AnarchySubject UID -> (monotonic time, event) of the DELETED and billing events of the other shards
+_skipped_events = OrderedDict()
+_skipped_events_lock = threading.Lock()
+# Monotonic time of the last take_skipped_events() call
+_skipped_taken_at = None
+
+
+def owns_anarchy_subject(body, event=None, **_):
+    """kopf `when=` filter, only handle the AnarchySubjects of this replica's shard.
+
+    While the members change, the replicas may not agree on the owner of a key.
+    DELETED and billing events cannot be caught up by listing the objects, so
+    they are handled when this replica owns the key in any ring since the last
+    catch-up, and the others are kept for take_skipped_events(). The handlers
+    are idempotent, an event handled by two replicas is only logged once.
+    """
+    key = shard_key(body)
+    if owns(key):
+        return True
+    event = event or {'object': body}
+    if scheduler.classify(event) != scheduler.BILLING:
+        return False
+    if any(seen_ring.owner(key) == shard_identity for seen_ring in seen_rings):
+        return True
+
+    uid = body.get('metadata', {}).get('uid')
+    if uid is not None:
+        with _skipped_events_lock:
+            _skipped_events.pop(uid, None)
+            _skipped_events[uid] = (time.monotonic(), event)
+            while len(_skipped_events) > skipped_events_size:
+                _skipped_events.popitem(last=False)
+    return False
+
+
+def take_skipped_events():
+    """Remove and return the skipped events whose key this replica owns now.
+
+    The owner of a key may have been gone, its Lease still valid, for up to
+    SHARDING_LEASE_DURATION before its replicas saw a change. Events skipped
+    earlier than that before the previous call were handled by their owner
+    and are dropped.
+
+    Returns:
+        list: (skipped_at, event) in the order they were skipped.
+    """
+    global _skipped_taken_at
+
+    now = time.monotonic()
+    taken = []
+    with _skipped_events_lock:
+        expired_before = -1 if _skipped_taken_at is None else _skipped_taken_at - lease_duration
+        for uid, (skipped_at, event) in list(_skipped_events.items()):
+            if skipped_at < expired_before:
+                del _skipped_events[uid]
+            elif owns(shard_key(event['object'])):
+                del _skipped_events[uid]
+                taken.append((skipped_at, event))
+        _skipped_taken_at = now
+    return taken
+
+
+def _lease_name():
+    return f"{shard_group}-{shard_identity}"
+
+
+def renew_lease():
+    coordination_api = kube_client.coordination_v1_api()
+    now = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+    body = {
+        'apiVersion': 'coordination.k8s.io/v1',
+        'kind': 'Lease',
+        'metadata': {
+            'name': _lease_name(),
+            'labels': {shard_group_label: shard_group},
+        },
+        'spec': {
+            'holderIdentity': shard_identity,
+            'leaseDurationSeconds': lease_duration,
+            'renewTime': now,
+        },
+    }
+    try:
+        coordination_api.patch_namespaced_lease(_lease_name(), shard_namespace, body)
+    except kubernetes.client.rest.ApiException as e:
+        if e.status != 404:
+            raise
+        body['spec']['acquireTime'] = now
+        coordination_api.create_namespaced_lease(shard_namespace, body)
+
+
+def release_lease():
+    coordination_api = kube_client.coordination_v1_api()
+    try:
+        coordination_api.delete_namespaced_lease(_lease_name(), shard_namespace)
+    except kubernetes.client.rest.ApiException as e:
+        if e.status != 404:
+            raise
+
+
+def live_members(now=None):
+    """Holders of the shard group Leases renewed within their duration."""
+    coordination_api = kube_client.coordination_v1_api()
+    now = now or datetime.now(timezone.utc)
+    leases = coordination_api.list_namespaced_lease(shard_namespace,
+                                                    label_selector=f"{shard_group_label}={shard_group}")
+    members = set()
+    for lease in leases.items:
+        spec = lease.spec
+        if not spec.holder_identity or not spec.renew_time:
+            continue
+        if spec.renew_time + timedelta(seconds=spec.lease_duration_seconds or lease_duration) > now:
+            members.add(spec.holder_identity)
+    # A slow API call must not remove this replica from its own ring
+    members.add(shard_identity)
+    return members
+
+
+def update_membership():
+    """Renew this replica's Lease and rebuild the ring.
+
+    Returns:
+        previous_ring (HashRing): Ring before the update when the membership changed, None otherwise.
+    """
+    global ring
+
+    renew_lease()
+    members = live_members()
+    if tuple(sorted(members)) == ring.members:
+        return None
+
+    previous_ring = ring
+    ring = HashRing(members)
+    seen_rings.append(ring)
+    metrics.SHARD_MEMBERS.set(len(ring.members))
+    metrics.SHARD_REBALANCES.inc()
+    logger.info("Shard members changed: %s", ', '.join(ring.members))
+    return previous_ring
+
+
+async def _run_on_change(on_change, previous_rings, current_ring):
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, on_change, previous_rings, current_ring)
+    except Exception as e:
+        logger.warning("Unable to catch up with the shard change: %s", e)
+
+
+async def maintain_membership(on_change=None):
+    """Renew the Lease and follow the shard members until the operator exits.
+
+    on_change runs once the members did not change for SHARDING_SETTLE_SECONDS,
+    and never twice at once: the changes made while it runs are passed to the
+    next call.
+
+    Args:
+        on_change (callable): Called in a thread with (previous_rings, ring) when the members change,
+            previous_rings are the ring of the previous call and the rings seen since.
+    """
+    global seen_rings
+
+    loop = asyncio.get_running_loop()
+    # Time of the first change since the last on_change call
+    changed_at = None
+    running = None
+    while True:
+        await asyncio.sleep(lease_renew_interval)
+        try:
+            previous_ring = await loop.run_in_executor(None, update_membership)
+        except Exception as e:
+            logger.warning("Unable to update the shard membership: %s", e)
+            continue
+        if previous_ring is not None:
+            changed_at = loop.time()
+        if not on_change or changed_at is None or loop.time() - changed_at < settle_seconds:
+            continue
+        if running is not None and not running.done():
+            continue
+        changed_at = None
+        # Even when the members went back to the ones of the last call, the keys of
+        # the replicas which came and went were not handled here in the meantime
+        previous_rings = seen_rings[:-1]
+        seen_rings = [ring]
+        running = loop.create_task(_run_on_change(on_change, previous_rings, ring))
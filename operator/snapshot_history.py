@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""Append-only history of the resource_claim_log snapshots.
+
+Each provision and snapshot kind gets a full base snapshot followed by JSON
+patch (RFC 6902) deltas, one per event that changed the object. Each delta
+stores the id of the row it applies to (prev_id) and is only appended while
+that row is still the last one of the provision. When another writer (the
+backfill, another replica) appended in between, a base is written instead.
+A new base is also written every SNAPSHOT_HISTORY_BASE_INTERVAL deltas, when
+the previous snapshot is not in the in-process cache (e.g. after a restart)
+and while the writes are deferred by a bulk job, so reconstructing an object
+never needs more than that many patches.
+
+Print a provision snapshot as it was at a point in time:
+
+    python snapshot_history.py <provision_uuid> anarchy_subject [--at 2022-05-10T15:00:00Z]
+"""
+import os
+import sys
+
+if __name__ == '__main__':
+    # operator.py would shadow the standard library operator module, move this directory last
+    sys.path.append(sys.path.pop(0))
+
+import threading
+from collections import OrderedDict
+
+import snapshots
+import utils
+
+snapshot_history_enabled = os.environ.get('SNAPSHOT_HISTORY_ENABLED', 'true').lower() == 'true'
+snapshot_history_base_interval = int(os.environ.get('SNAPSHOT_HISTORY_BASE_INTERVAL', 20))
+# Number of (provision, kind) last snapshots kept in memory to compute deltas
+snapshot_history_cache_size = int(os.environ.get('SNAPSHOT_HISTORY_CACHE_SIZE', 5000))
+
+_last_snapshots = OrderedDict()
+_last_snapshots_lock = threading.Lock()
+
+create_table_query = """
+CREATE TABLE IF NOT EXISTS resource_claim_log_history (
+    id BIGSERIAL PRIMARY KEY,
+    provision_uuid VARCHAR NOT NULL,
+    snapshot_kind VARCHAR(32) NOT NULL,
+    logged_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+    is_base BOOLEAN NOT NULL,
+    snapshot JSONB NOT NULL,
+    prev_id BIGINT
+);
+CREATE INDEX IF NOT EXISTS resource_claim_log_history_lookup
+    ON resource_claim_log_history (provision_uuid, snapshot_kind, logged_at);
+"""
+
+base_query = "INSERT INTO resource_claim_log_history (provision_uuid, snapshot_kind, is_base, snapshot) \n" \
+             "VALUES (%s, %s, TRUE, %s) RETURNING id;"
+
+# Nothing is inserted when another writer appended after prev_id
+delta_query = "INSERT INTO resource_claim_log_history (provision_uuid, snapshot_kind, is_base, snapshot, prev_id) \n" \
+              "SELECT %s, %s, FALSE, %s, %s \n" \
+              "WHERE %s = (SELECT MAX(id) FROM resource_claim_log_history \n" \
+              "            WHERE provision_uuid = %s AND snapshot_kind = %s) \n" \
+              "RETURNING id;"
+
+# Walk back from the last row of each provision to its base through prev_id, base first
+chain_query = "WITH RECURSIVE chain AS ( \n" \
+              "  SELECT id, prev_id, is_base, provision_uuid, snapshot, 0 AS depth \n" \
+              "  FROM resource_claim_log_history \n" \
+              "  WHERE id IN ( \n" \
+              "    SELECT MAX(id) FROM resource_claim_log_history \n" \
+              "    WHERE provision_uuid IN %s AND snapshot_kind = %s \n" \
+              "      AND (%s::timestamptz IS NULL OR logged_at <= %s::timestamptz) \n" \
+              "    GROUP BY provision_uuid) \n" \
+              "  UNION ALL \n" \
+              "  SELECT h.id, h.prev_id, h.is_base, h.provision_uuid, h.snapshot, chain.depth + 1 \n" \
+              "  FROM resource_claim_log_history h JOIN chain ON h.id = chain.prev_id \n" \
+              "  WHERE NOT chain.is_base) \n" \
+              "SELECT provision_uuid, is_base, snapshot FROM chain \n" \
+              "ORDER BY provision_uuid, depth DESC;"
+
+
+def _escape(key):
+    return str(key).replace('~', '~0').replace('/', '~1')
+
+
+def _unescape(segment):
+    return segment.replace('~1', '/').replace('~0', '~')
+
+
+def json_diff(old, new, path=''):
+    """Compute the JSON patch operations transforming `old` into `new`.
+
+    Dictionaries are compared key by key, any other changed value (lists
+    included) is replaced as a whole.
+    """
+    if isinstance(old, dict) and isinstance(new, dict):
+        operations = []
+        for key in old:
+            if key not in new:
+                operations.append({'op': 'remove', 'path': f"{path}/{_escape(key)}"})
+        for key, value in new.items():
+            key_path = f"{path}/{_escape(key)}"
+            if key not in old:
+                operations.append({'op': 'add', 'path': key_path, 'value': value})
+            elif old[key] != value:
+                operations.extend(json_diff(old[key], value, key_path))
+        return operations
+
+    if old != new:
+        return [{'op': 'replace', 'path': path, 'value': new}]
+    return []
+
+
+def apply_patch(obj, operations):
+    """Apply JSON patch operations generated by json_diff(), modifying obj in place.
+
+    Returns:
+        obj: patched object (a new object when the root is replaced).
+    """
+    for operation in operations:
+        if operation['path'] == '':
+            obj = operation['value']
+            continue
+
+        segments = [_unescape(s) for s in operation['path'].split('/')[1:]]
+        parent = obj
+        for segment in segments[:-1]:
+            parent = parent[int(segment)] if isinstance(parent, list) else parent[segment]
+
+        key = segments[-1]
+        if isinstance(parent, list):
+            key = int(key)
+        if operation['op'] == 'remove':
+            del parent[key]
+        else:
+            parent[key] = operation['value']
+    return obj
+
+
+def _remember(cache_key, snapshot, deltas, row_id):
+    with _last_snapshots_lock:
+        _last_snapshots.pop(cache_key, None)
+        _last_snapshots[cache_key] = (snapshot, deltas, row_id)
+        while len(_last_snapshots) > snapshot_history_cache_size:
+            _last_snapshots.popitem(last=False)
+
+
+def _forget(cache_key):
+    with _last_snapshots_lock:
+        _last_snapshots.pop(cache_key, None)
+
+
+def clear_cache():
+    """Forget the last snapshots, another writer may have appended to their history."""
+    with _last_snapshots_lock:
+        _last_snapshots.clear()
+
+
+def create_history_table():
+    utils.execute_query(create_table_query, autocommit=True)
+
+
+def save_snapshot_history(provision_uuid, kind, obj):
+    """Append the snapshot to resource_claim_log_history as a base or a delta.
+
+    The snapshot is only cached once its row is stored, a failed write is
+    followed by a base.
+
+    Args:
+        provision_uuid (str): Provision UUID.
+        kind (str): Snapshot kind, see snapshots.bulky_keys.
+        obj (dict): Object to store, bulky keys are stripped.
+    """
+    if not snapshot_history_enabled or provision_uuid is None:
+        return
+
+    # Round trip through JSON so the cached copy matches what is stored and is not shared with the caller
+    snapshot = snapshots.loads(snapshots.dumps(snapshots.strip_bulky_keys(obj, kind)))
+    cache_key = (provision_uuid, kind)
+    with _last_snapshots_lock:
+        last = _last_snapshots.get(cache_key)
+
+    if utils.writes_deferred():
+        # The ids of the rows are only known once flushed, bulk jobs write bases
+        _forget(cache_key)
+        utils.execute_snapshot_write(base_query, [provision_uuid, kind, snapshots.dumps(snapshot)])
+        return
+
+    if last is not None and last[1] < snapshot_history_base_interval:
+        last_snapshot, deltas, last_id = last
+        operations = json_diff(last_snapshot, snapshot)
+        if not operations:
+            return
+        result = utils.execute_query(delta_query,
+                                     positional_args=[provision_uuid, kind, snapshots.dumps(operations), last_id,
+                                                      last_id, provision_uuid, kind],
+                                     autocommit=True, prepare=True)
+        if not result:
+            _forget(cache_key)
+            return
+        if result['query_result']:
+            _remember(cache_key, snapshot, deltas + 1, result['query_result'][0]['id'])
+            return
+        # Another writer appended since the cached row, start a new chain
+
+    result = utils.execute_query(base_query, positional_args=[provision_uuid, kind, snapshots.dumps(snapshot)],
+                                 autocommit=True, prepare=True)
+    if result and result['query_result']:
+        _remember(cache_key, snapshot, 0, result['query_result'][0]['id'])
+    else:
+        _forget(cache_key)
+
+
+def get_snapshots(provision_uuids, kind, at=None):
+    """Reconstruct the snapshots of several provisions as they were at a point in time.
+
+    Args:
+        provision_uuids (list): Provision UUIDs.
+        kind (str): Snapshot kind.
+        at (datetime or str): Point in time, defaults to now.
+
+    Returns:
+        dict: provision_uuid -> snapshot, provisions without a snapshot before `at` are missing.
+    """
+    if not provision_uuids:
+        return {}
+    at = utils.normalize_timestamp(at) if at else None
+    result = utils.execute_query(chain_query, positional_args=[tuple(provision_uuids), kind, at, at])
+    if not result:
+        return {}
+
+    rebuilt = {}
+    for row in result['query_result']:
+        document = snapshots.load_snapshot(row['snapshot'])
+        if row['is_base']:
+            rebuilt[row['provision_uuid']] = document
+        elif row['provision_uuid'] in rebuilt:
+            rebuilt[row['provision_uuid']] = apply_patch(rebuilt[row['provision_uuid']], document)
+    return rebuilt
+
+
+def get_snapshot_at(provision_uuid, kind, at=None):
+    """Reconstruct a snapshot as it was at a point in time.
+
+    Args:
+        provision_uuid (str): Provision UUID.
+        kind (str): Snapshot kind.
+        at (datetime or str): Point in time, defaults to now.
+
+    Returns:
+        snapshot (dict): Reconstructed object, or None if there is no snapshot before `at`.
+    """
+    return get_snapshots([provision_uuid], kind, at).get(provision_uuid)
+
+
+def main():
+    import argparse
+    import json
+    import kube_client
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('provision_uuid')
+    parser.add_argument('kind', choices=sorted(snapshots.bulky_keys))
+    parser.add_argument('--at', help='ISO 8601 timestamp, defaults to now')
+    args = parser.parse_args()
+
+    kube_client.load_config()
+
+    print(json.dumps(get_snapshot_at(args.provision_uuid, args.kind, args.at), indent=2))
+
+
+if __name__ == '__main__':
+    main()
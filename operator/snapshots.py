@@ -0,0 +1,141 @@
+import base64
+import json
+import os
+import zlib
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Serializer used for the resource_claim_log snapshots: auto (orjson when installed), orjson or json
+snapshot_serializer = os.environ.get('SNAPSHOT_SERIALIZER', 'auto')
+# Snapshots larger than this many bytes are stored zlib compressed, 0 disables compression
+snapshot_compress_min_bytes = int(os.environ.get('SNAPSHOT_COMPRESS_MIN_BYTES', 0))
+# Set to false to stop overwriting the latest snapshots in resource_claim_log and only keep
+# the append-only history (see snapshot_history.py). recompute.py and the enrichment worker
+# then rebuild the snapshots from the history.
+snapshot_latest_enabled = os.environ.get('SNAPSHOT_LATEST_ENABLED', 'true').lower() == 'true'
+# Additional comma separated key paths stripped from every snapshot, e.g. "status.runs,spec.vars.provision_data"
+snapshot_strip_keys = os.environ.get('SNAPSHOT_STRIP_KEYS', '')
+
+# Key paths removed before storing each kind of snapshot. `*` matches every key of a dict or item of a list.
+last_handled_configuration = 'kopf.zalando.org/last-handled-configuration'
+bulky_keys = {
+    'anarchy_subject': [
+        ('metadata', 'managedFields'),
+        ('metadata', 'annotations', last_handled_configuration),
+        ('status', 'diffBase'),
+        ('status', 'towerJobs', '*', 'log'),
+        ('spec', 'vars', 'provision_messages'),
+    ],
+    'resource_claim': [
+        ('metadata', 'managedFields'),
+        ('metadata', 'annotations', last_handled_configuration),
+        ('spec', 'provision_messages'),
+        ('status', 'diffBase'),
+        ('status', 'resources', '*', 'state', 'metadata', 'managedFields'),
+        ('status', 'resources', '*', 'state', 'status', 'diffBase'),
+        ('status', 'resources', '*', 'state', 'status', 'towerJobs', '*', 'log'),
+        ('status', 'resources', '*', 'state', 'spec', 'vars', 'provision_messages'),
+    ],
+    'tower_extra_vars': [],
+    'provision_vars': [
+        # Already stored in tower_extra_vars_json
+        ('provision_vars',),
+    ],
+}
+
+compressed_marker = '__compressed__'
+
+
+def _strip_path(obj, segments):
+    """Return obj without the key at `segments`, copying only the containers along the path."""
+    if not segments:
+        return obj
+    key, rest = segments[0], segments[1:]
+
+    if isinstance(obj, dict):
+        keys = list(obj) if key == '*' else [key]
+        copied = None
+        for k in keys:
+            if k not in obj:
+                continue
+            if rest:
+                value = _strip_path(obj[k], rest)
+                if value is obj[k]:
+                    continue
+                copied = copied or dict(obj)
+                copied[k] = value
+            else:
+                copied = copied or dict(obj)
+                del copied[k]
+        return obj if copied is None else copied
+
+    if isinstance(obj, list) and key == '*' and rest:
+        items = [_strip_path(item, rest) for item in obj]
+        if all(a is b for (a, b) in zip(items, obj)):
+            return obj
+        return items
+
+    return obj
+
+
+def strip_bulky_keys(obj, kind):
+    """Remove the bulky keys configured for this kind of snapshot.
+
+    The passed object is not modified.
+    """
+    paths = bulky_keys.get(kind, []) + [p.strip().split('.') for p in snapshot_strip_keys.split(',') if p.strip()]
+    for path in paths:
+        obj = _strip_path(obj, path)
+    return obj
+
+
+def dumps(obj):
+    """Serialize obj to a JSON string, non JSON types are converted with str()."""
+    if orjson is not None and snapshot_serializer in ('auto', 'orjson'):
+        # Pass the datetimes to str() like json.dumps(), orjson would write them in ISO format with a T
+        return orjson.dumps(obj, default=str,
+                            option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME).decode('utf-8')
+    return json.dumps(obj, default=str)
+
+
+def loads(text):
+    return orjson.loads(text) if orjson is not None else json.loads(text)
+
+
+def dump_snapshot(obj, kind):
+    """Serialize a snapshot to store in resource_claim_log.
+
+    Args:
+        obj (dict): AnarchySubject, ResourceClaim, Tower extra vars or provision vars.
+        kind (str): Snapshot kind, one of the `bulky_keys` keys.
+
+    Returns:
+        snapshot (str): JSON document, wrapped in {"__compressed__": "zlib", "data": ...}
+        when larger than SNAPSHOT_COMPRESS_MIN_BYTES.
+    """
+    text = dumps(strip_bulky_keys(obj, kind))
+    if snapshot_compress_min_bytes and len(text) >= snapshot_compress_min_bytes:
+        data = base64.b64encode(zlib.compress(text.encode('utf-8'))).decode('ascii')
+        text = dumps({compressed_marker: 'zlib', 'data': data})
+    return text
+
+
+def load_snapshot(value):
+    """Load a snapshot stored by dump_snapshot().
+
+    Args:
+        value (str or dict): Column value, psycopg2 already decodes json and jsonb columns.
+
+    Returns:
+        snapshot (dict): Decompressed object, or None.
+    """
+    if value is None:
+        return None
+    if isinstance(value, (str, bytes)):
+        value = loads(value)
+    if isinstance(value, dict) and value.get(compressed_marker) == 'zlib':
+        value = loads(zlib.decompress(base64.b64decode(value['data'])))
+    return value
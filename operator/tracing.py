@@ -0,0 +1,79 @@
+import os
+import time
+from functools import wraps
+from opentelemetry import trace
+
+service_name = os.environ.get('OTEL_SERVICE_NAME', 'babylon-reporting-operator')
+# Traces are exported over OTLP when an endpoint is configured. TRACING_EXPORTER=console
+# prints spans to stdout instead, which is handy for local development.
+otlp_endpoint = os.environ.get('OTEL_EXPORTER_OTLP_ENDPOINT')
+otlp_insecure = os.environ.get('OTEL_EXPORTER_OTLP_INSECURE', 'true').lower() == 'true'
+tracing_exporter = os.environ.get('TRACING_EXPORTER', 'otlp')
+
+# Proxy tracer, spans are no-op until configure_tracing() installs an SDK provider
+tracer = trace.get_tracer('babylon-reporting-operator')
+
+
+def configure_tracing():
+    """Install the tracer provider and span exporter.
+
+    Returns:
+        bool: True if tracing was enabled.
+    """
+    if not otlp_endpoint and tracing_exporter != 'console':
+        return False
+
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter, SimpleSpanProcessor
+
+    provider = TracerProvider(resource=Resource.create({'service.name': service_name}))
+
+    if tracing_exporter == 'console':
+        provider.add_span_processor(SimpleSpanProcessor(ConsoleSpanExporter()))
+    else:
+        from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+        provider.add_span_processor(
+            BatchSpanProcessor(OTLPSpanExporter(endpoint=otlp_endpoint, insecure=otlp_insecure))
+        )
+
+    trace.set_tracer_provider(provider)
+    return True
+
+
+def _attributes(attributes):
+    # OpenTelemetry rejects None attribute values
+    return {k: v for (k, v) in attributes.items() if v is not None}
+
+
+def span(name, **attributes):
+    """Return a context manager starting a child span of the current span."""
+    return tracer.start_as_current_span(name, attributes=_attributes(attributes))
+
+
+def traced(name):
+    """Decorator wrapping each call of the function in a span."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def set_attributes(**attributes):
+    """Set attributes on the current span."""
+    current_span = trace.get_current_span()
+    for (k, v) in _attributes(attributes).items():
+        current_span.set_attribute(k, v)
+
+
+def record_span(name, elapsed, **attributes):
+    """Record an already finished operation, which ended now and lasted `elapsed` seconds,
+    as a child span of the current span.
+    """
+    end_time = time.time_ns()
+    start_time = end_time - int(elapsed * 1e9)
+    finished_span = tracer.start_span(name, attributes=_attributes(attributes), start_time=start_time)
+    finished_span.end(end_time=end_time)
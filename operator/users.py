@@ -1,7 +1,9 @@
 import json
 import utils
+import metrics
 from corp_ldap import GPTELdap
 from manager_chargeback import ManagerChargeback
+from org_chart import org_chart, org_chart_enabled
 from datetime import datetime, timezone
 
 
@@ -35,7 +37,7 @@ class Users(GPTELdap):
         query = f"SELECT id FROM manager " \
                 f"WHERE email = %s"
 
-        result = utils.execute_query(query, positional_args=positional_args, autocommit=True)
+        result = utils.execute_query(query, positional_args=positional_args, autocommit=True, prepare=True)
 
         if result['rowcount'] >= 1:
             query_result = result['query_result'][0]
@@ -67,7 +69,7 @@ class Users(GPTELdap):
         query, positional_args = utils.create_sql_statement(insert_fields, update_fields, 'manager',
                                                             'manager_unique_email', 'id' )
 
-        result = utils.execute_query(query, positional_args=positional_args, autocommit=True)
+        result = utils.execute_query(query, positional_args=positional_args, autocommit=True, prepare=True)
 
         if result['rowcount'] >= 1:
             return result['query_result'][0]
@@ -97,8 +99,17 @@ class Users(GPTELdap):
         # Get a list of manager to be charged
         manager_list = self.get_manager_chargeback()
 
+        # Resolve the user from the local org chart, LDAP is searched when the user is not in it
+        use_org_chart = org_chart_enabled and org_chart.available()
+        chargeback_manager_mail = None
+        if use_org_chart:
+            with metrics.stage('org_chart_headcount'):
+                chargeback_manager_mail = org_chart.chargeback_manager(generic_email, manager_list)
+
         # Serach in LDAP if user's manager is in the list of manager_list to be charged
-        chargeback_manager_mail = self.ldap_user_headcount(generic_email, manager_list)
+        if chargeback_manager_mail is None:
+            with metrics.stage('ldap_user_headcount'):
+                chargeback_manager_mail = self.ldap_user_headcount(generic_email, manager_list)
 
         if isinstance(chargeback_manager_mail, dict) or \
                 chargeback_manager_mail == 'gpte@redhat.com':
@@ -112,7 +123,10 @@ class Users(GPTELdap):
                   f" manager_chargeback_id: {manager_chargeback_id} \n"
                   f"")
 
-        user_data = self.ldap_search_user(generic_email)
+        user_data = org_chart.search_user(generic_email) if use_org_chart else None
+        if user_data is None:
+            with metrics.stage('ldap_search_user'):
+                user_data = self.ldap_search_user(generic_email)
 
         if self.debug:
             print("search_internal_user: \n"
@@ -283,7 +297,7 @@ class Users(GPTELdap):
         if self.debug:
             print(f"Query Insert: \n{query}", positional_args)
 
-        cur = utils.execute_query(query, positional_args=positional_args, autocommit=True)
+        cur = utils.execute_query(query, positional_args=positional_args, autocommit=True, prepare=True)
         if cur['rowcount'] >= 1:
             query_result = cur['query_result'][0]
             self.user_data['user_id'] = query_result.get('id')
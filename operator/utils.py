@@ -4,7 +4,6 @@ import os
 os.environ['TZ'] = 'UTC'
 os.environ['PGTZ'] = 'UTC'
 
-import kubernetes
 import base64
 import json
 import psycopg2
@@ -12,11 +11,67 @@ from psycopg2.extras import DictCursor
 from psycopg2 import ProgrammingError as Psycopg2ProgrammingError
 from psycopg2 import pool
 import decimal
+import logging
+import threading
+import time
 from datetime import datetime, timedelta, timezone
 import re
-import pytz
-import tzlocal
-from retrying import retry
+import urllib3
+import kube_client
+import metrics
+import resilience
+import snapshot_history
+import snapshots
+import tracing
+
+logger = logging.getLogger('babylon-reporting.sql')
+
+# Statements slower than this are logged at WARNING
+slow_query_seconds = float(os.environ.get('SLOW_QUERY_SECONDS', 1.0))
+# Number of statement fingerprints kept in the in-memory stats table, 0 disables it
+query_stats_top_n = int(os.environ.get('QUERY_STATS_TOP_N', 50))
+
+# Rows fetched per round trip by stream_query()
+stream_query_itersize = int(os.environ.get('STREAM_QUERY_ITERSIZE', 2000))
+
+# Connections of the pool shared by the process
+db_pool_min_connections = int(os.environ.get('DB_POOL_MIN_CONNECTIONS', 1))
+db_pool_max_connections = int(os.environ.get('DB_POOL_MAX_CONNECTIONS', 8))
+
+db_pool = None
+db_pool_lock = threading.Lock()
+db_pool_semaphore = None
+
+# Query text -> prepared statement name, see prepared_statement()
+prepared_statement_names = {}
+prepared_statement_names_lock = threading.Lock()
+_placeholder_re = re.compile(r'%s')
+
+query_stats = {}
+query_stats_lock = threading.Lock()
+
+# Serialize provision_lifecycle() per provision, the event handler and a shard catch-up may log the same one
+lifecycle_write_locks = [threading.Lock() for _ in range(64)]
+
+# The state is only logged when it differs from the last one in lifecycle_log, the backfill
+# and the other replicas log states too so this process can not decide it
+lifecycle_insert_query = "INSERT INTO lifecycle_log (provision_uuid, state, executor) \n" \
+                         "SELECT %s, %s, %s \n" \
+                         "WHERE %s IS DISTINCT FROM ( \n" \
+                         "  SELECT state FROM lifecycle_log WHERE provision_uuid = %s \n" \
+                         "  ORDER BY logged_at DESC LIMIT 1) \n" \
+                         "RETURNING id;"
+
+# resource_claim_log snapshot writes are queued here instead of executed while not None, see defer_writes()
+deferred_writes = None
+deferred_writes_lock = threading.Lock()
+
+_fingerprint_literal_re = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b|%s")
+_fingerprint_in_list_re = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_fingerprint_space_re = re.compile(r'\s+')
+
+utc_tzinfo = timezone.utc
+_timestamp_re = re.compile(r'^(\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2})(?:\.(\d+))?([+-]\d{2}:?\d{2})?$')
 
 
 def list_to_pg_array(elem):
@@ -78,57 +133,135 @@ def get_conn_params(secret_name='gpte-db-secrets'):
     return kw
 
 
-# Wait 2^x * 500 milliseconds between each retry, up to 5 seconds, then 5 seconds afterwards and 3 attempts
-@retry(stop_max_attempt_number=3, wait_exponential_multiplier=500, wait_exponential_max=5000)
+class PreparedStatementConnection(psycopg2.extensions.connection):
+    """Connection keeping track of the statements prepared in its session."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared_statements = set()
+
+
+@resilience.retrying('database', retry_on=(psycopg2.OperationalError,))
 def connect_to_db(fail_on_conn=True):
-    db_connection = None
-    conn_params = get_conn_params()
-    try:
-        # TODO: Create parameter to max_connection and min_connection
-        db_connection = pool.ThreadedConnectionPool(2, 4, **conn_params)
-        if db_connection:
-            print("Connection pool created successfully using ThreadedConnectionPool")
-
-    except TypeError as e:
-        if 'sslrootcert' in e.args[0]:
-            print('Postgresql server must be at least '
-                  'version 8.4 to support sslrootcert')
-        if fail_on_conn:
-            print("unable to connect to database: %s" % e)
-        else:
-            print("PostgreSQL server is unavailable: %s" % e)
-            db_connection = None
-    except Exception as e:
-        if fail_on_conn:
-            print("unable to connect to database: %s" % e)
-        else:
+    """Get the connection pool shared by the whole process, creating it on first use."""
+    global db_pool, db_pool_semaphore
+
+    with db_pool_lock:
+        if db_pool is not None:
+            return db_pool
+
+        conn_params = get_conn_params()
+        try:
+            # The session time zone is set once per connection instead of in each statement
+            db_pool = pool.ThreadedConnectionPool(db_pool_min_connections, db_pool_max_connections,
+                                                  connection_factory=PreparedStatementConnection,
+                                                  options='-c timezone=UTC',
+                                                  connect_timeout=int(resilience.get('database').timeout),
+                                                  **conn_params)
+            db_pool_semaphore = threading.BoundedSemaphore(db_pool_max_connections)
+            if db_pool:
+                print("Connection pool created successfully using ThreadedConnectionPool")
+
+        except TypeError as e:
+            if 'sslrootcert' in e.args[0]:
+                print('Postgresql server must be at least '
+                      'version 8.4 to support sslrootcert')
+            if fail_on_conn:
+                print("unable to connect to database: %s" % e)
+            else:
+                print("PostgreSQL server is unavailable: %s" % e)
+                db_pool = None
+        except psycopg2.OperationalError as e:
+            # Unreachable server, retried by the resilience layer
             print("PostgreSQL server is unavailable: %s" % e)
-            db_connection = None
+            db_pool = None
+            raise
+        except Exception as e:
+            if fail_on_conn:
+                print("unable to connect to database: %s" % e)
+            else:
+                print("PostgreSQL server is unavailable: %s" % e)
+                db_pool = None
 
-    return db_connection
+        return db_pool
 
 
-def execute_query(query, positional_args=None, autocommit=False):
+def get_db_connection():
+    """Take a connection from the shared pool, waiting while all of them are in use."""
     db_connection = connect_to_db()
+    db_pool_semaphore.acquire()
+    try:
+        db_pool_conn = db_connection.getconn()
+        # Replace connections closed by the server
+        if db_pool_conn.closed:
+            db_connection.putconn(db_pool_conn, close=True)
+            db_pool_conn = db_connection.getconn()
+    except Exception:
+        db_pool_semaphore.release()
+        raise
+
+    metrics.DB_POOL_CONNECTIONS.inc()
+    return db_pool_conn
+
+
+def put_db_connection(db_pool_conn, close=False):
+    """Return a connection to the shared pool, close it when it may be broken."""
+    try:
+        db_pool.putconn(db_pool_conn, close=close or bool(db_pool_conn.closed))
+    finally:
+        db_pool_semaphore.release()
+        metrics.DB_POOL_CONNECTIONS.dec()
+
+
+def close_db_pool():
+    global db_pool
+
+    with db_pool_lock:
+        if db_pool is not None:
+            db_pool.closeall()
+            db_pool = None
+
+
+def prepared_statement(db_pool_conn, query, arguments):
+    """Prepare the query in the connection session if needed.
+
+    Statements are registered by text, identical queries share the same name
+    on every connection.
+
+    Returns:
+        (query, arguments): EXECUTE statement and its arguments.
+    """
+    name = prepared_statement_names.get(query)
+    if name is None:
+        with prepared_statement_names_lock:
+            name = prepared_statement_names.setdefault(query, f"reporting_{len(prepared_statement_names)}")
+
+    if name not in db_pool_conn.prepared_statements:
+        parameter_index = iter(range(1, query.count('%s') + 1))
+        statement = _placeholder_re.sub(lambda m: f"${next(parameter_index)}", query.strip().rstrip(';'))
+        with db_pool_conn.cursor() as cursor:
+            cursor.execute(f"PREPARE {name} AS {statement}")
+        db_pool_conn.prepared_statements.add(name)
+
+    if not arguments:
+        return f"EXECUTE {name}", None
+    return f"EXECUTE {name} ({', '.join(['%s'] * len(arguments))})", arguments
 
+
+def execute_query(query, positional_args=None, autocommit=False, prepare=False):
+    """Execute a statement on a connection of the shared pool.
+
+    Args:
+        prepare (bool): Use a prepared statement, for statements executed often.
+            The query must only use %s placeholders.
+    """
     query_list = []
     if positional_args:
         positional_args = convert_elements_to_pg_arrays(positional_args)
 
     query_list.append(query)
 
-    if db_connection is None:
-        db_connection = connect_to_db()
-
-    # This is a workaround to reconnect to database
-    db_pool_conn = db_connection.getconn()
-    try:
-        db_pool_conn.close()
-        db_connection.putconn(db_pool_conn)
-    except psycopg2.InterfaceError:
-        pass
-
-    db_pool_conn = db_connection.getconn()
+    db_pool_conn = get_db_connection()
 
     encoding = 'utf-8'
     if encoding is not None:
@@ -147,6 +280,7 @@ def execute_query(query, positional_args=None, autocommit=False):
 
     query_all_results = []
     rowcount = 0
+    elapsed = 0.0
     statusmessage = ''
 
     query_result = []
@@ -154,7 +288,11 @@ def execute_query(query, positional_args=None, autocommit=False):
     # Execute query:
     for query in query_list:
         try:
-            cursor.execute(query, arguments)
+            query_start = time.monotonic()
+            if prepare:
+                cursor.execute(*prepared_statement(db_pool_conn, query, arguments))
+            else:
+                cursor.execute(query, arguments)
             statusmessage = cursor.statusmessage
             if cursor.rowcount > 0:
                 rowcount += cursor.rowcount
@@ -176,13 +314,17 @@ def execute_query(query, positional_args=None, autocommit=False):
                     query_result.append(row)
 
             except Psycopg2ProgrammingError as e:
-                if 'no results to fetch' in e:
+                if 'no results to fetch' in str(e):
                     print(f"ERROR: {e}")
                     query_result = []
 
             except Exception as e:
                 print("Cannot fetch rows from cursor: %s" % e)
 
+            query_elapsed = time.monotonic() - query_start
+            elapsed += query_elapsed
+            record_query_stats(query, query_elapsed, cursor.rowcount)
+
             query_all_results.append(query_result)
 
             if 'SELECT' not in statusmessage:
@@ -204,16 +346,20 @@ def execute_query(query, positional_args=None, autocommit=False):
 
 
         except Exception as e:
-            db_pool_conn.rollback()
-            cursor.close()
-            db_connection.putconn(db_pool_conn)
+            try:
+                db_pool_conn.rollback()
+                cursor.close()
+            except psycopg2.Error:
+                pass
+            # The connection may be broken, and its prepared statements unknown, do not reuse it
+            put_db_connection(db_pool_conn, close=True)
             print("Cannot execute SQL \n"
                   "Query: '%s' \n"
                   "Arguments: %s: \n"
                   "Error: %s, \n"
                   "query list: %s\n"
                   "" % (query, arguments, e, query_list))
-            db_connection.closeall()
+            return None
 
     try:
         if autocommit:
@@ -229,21 +375,226 @@ def execute_query(query, positional_args=None, autocommit=False):
             query_result=query_result,
             query_all_results=query_all_results,
             rowcount=rowcount,
+            elapsed=elapsed,
         )
 
         cursor.close()
-        db_connection.putconn(db_pool_conn)
-
-        # closing database connection.
-        # use closeall() method to close all the active connection if you want to turn of the application
-        db_connection.closeall()
-        del db_connection
+        put_db_connection(db_pool_conn)
         return kw
     except Exception as e:
         print(f"ERROR closing connection {e}")
+        put_db_connection(db_pool_conn, close=True)
         pass
 
 
+def stream_query(query, positional_args=None, itersize=None, raw=False, name=None):
+    """Iterate over the rows of a query with a server-side (named) cursor.
+
+    Unlike execute_query() the rows are neither loaded at once nor converted:
+    Decimals, timedeltas and datetimes are returned as psycopg2 returns them.
+    The transaction is rolled back and the connection released when the
+    generator is exhausted or closed.
+
+    Args:
+        query (str): SELECT statement.
+        positional_args (list): Query arguments.
+        itersize (int): Rows fetched per round trip, defaults to STREAM_QUERY_ITERSIZE.
+        raw (bool): Yield plain tuples instead of DictRow objects.
+        name (str): Cursor name, must be unique among the open cursors of the connection.
+
+    Yields:
+        row (tuple or DictRow): Query rows.
+    """
+    if positional_args:
+        positional_args = convert_elements_to_pg_arrays(positional_args)
+
+    db_pool_conn = get_db_connection()
+    try:
+        db_pool_conn.set_client_encoding('utf-8')
+        cursor = db_pool_conn.cursor(name=name or f"stream_{threading.get_ident()}_{time.monotonic_ns()}",
+                                     cursor_factory=None if raw else DictCursor)
+        cursor.itersize = itersize or stream_query_itersize
+
+        query_start = time.monotonic()
+        cursor.execute(query, positional_args or None)
+        record_query_stats(query, time.monotonic() - query_start, -1)
+
+        try:
+            yield from cursor
+        finally:
+            cursor.close()
+    finally:
+        db_pool_conn.rollback()
+        put_db_connection(db_pool_conn)
+
+
+def execute_many(statements):
+    """Execute a list of statements on a single connection and transaction.
+
+    Args:
+        statements (list): List of (query, positional_args) tuples.
+
+    Returns:
+        rowcount (int): Number of rows affected by all statements.
+    """
+    if not statements:
+        return 0
+
+    db_pool_conn = get_db_connection()
+    db_pool_conn.set_client_encoding('utf-8')
+    cursor = db_pool_conn.cursor()
+
+    rowcount = 0
+    try:
+        for query, positional_args in statements:
+            if positional_args:
+                positional_args = convert_elements_to_pg_arrays(positional_args)
+            query_start = time.monotonic()
+            cursor.execute(query, positional_args or None)
+            record_query_stats(query, time.monotonic() - query_start, cursor.rowcount)
+            if cursor.rowcount > 0:
+                rowcount += cursor.rowcount
+        db_pool_conn.commit()
+    except Exception:
+        db_pool_conn.rollback()
+        cursor.close()
+        put_db_connection(db_pool_conn, close=True)
+        raise
+
+    cursor.close()
+    put_db_connection(db_pool_conn)
+
+    return rowcount
+
+
+def defer_writes():
+    """Queue the resource_claim_log snapshot writes until flush_deferred_writes() is called.
+
+    Nothing reads resource_claim_log while an event is handled, so bulk jobs can
+    write the snapshots in batches instead of one connection per statement.
+    """
+    global deferred_writes
+    with deferred_writes_lock:
+        if deferred_writes is None:
+            deferred_writes = []
+
+
+def flush_deferred_writes(stop=False):
+    """Execute the queued snapshot writes in one transaction.
+
+    A failing batch is retried statement by statement so a single bad snapshot
+    does not drop the whole batch.
+
+    Args:
+        stop (bool): Stop deferring writes after this flush.
+
+    Returns:
+        count (int): Number of statements flushed.
+    """
+    global deferred_writes
+    with deferred_writes_lock:
+        statements = deferred_writes or []
+        deferred_writes = None if stop else []
+
+    try:
+        execute_many(statements)
+    except Exception as e:
+        logger.warning("Batch of %d statements failed, executing them one by one: %s", len(statements), e)
+        for query, positional_args in statements:
+            execute_query(query, positional_args=positional_args, autocommit=True)
+    return len(statements)
+
+
+def pending_deferred_writes():
+    with deferred_writes_lock:
+        return len(deferred_writes or [])
+
+
+def writes_deferred():
+    with deferred_writes_lock:
+        return deferred_writes is not None
+
+
+def execute_snapshot_write(query, positional_args):
+    with deferred_writes_lock:
+        if deferred_writes is not None:
+            deferred_writes.append((query, positional_args))
+            return None
+    return execute_query(query, positional_args=positional_args, autocommit=True, prepare=True)
+
+
+def fingerprint_query(query):
+    """Normalize a SQL statement so statements differing only in literal
+    values share the same fingerprint.
+
+    Args:
+        query (str): SQL statement.
+
+    Returns:
+        fingerprint (str): Statement with literals and placeholders replaced by `?`.
+    """
+    fingerprint = _fingerprint_literal_re.sub('?', query)
+    fingerprint = _fingerprint_in_list_re.sub('(?+)', fingerprint)
+    return _fingerprint_space_re.sub(' ', fingerprint).strip()
+
+
+def record_query_stats(query, elapsed, rowcount):
+    """Record timing of an executed statement: observe it in the query histogram,
+    log it when it exceeds the slow query threshold and accumulate it into the
+    in-memory top-N table.
+    """
+    metrics.observe_query(query, elapsed)
+    fingerprint = fingerprint_query(query)
+    tracing.record_span('db.query', elapsed, db_statement=fingerprint, rowcount=rowcount)
+
+    if elapsed >= slow_query_seconds:
+        logger.warning("Slow query %.3fs rows=%s: %s", elapsed, rowcount, fingerprint)
+
+    if query_stats_top_n <= 0:
+        return
+
+    with query_stats_lock:
+        stats = query_stats.get(fingerprint)
+        if stats is None:
+            # Keep the table bounded, evict the cheapest fingerprint
+            if len(query_stats) >= query_stats_top_n * 2:
+                cheapest = min(query_stats, key=lambda k: query_stats[k]['total_seconds'])
+                del query_stats[cheapest]
+            stats = query_stats[fingerprint] = {
+                'calls': 0, 'total_seconds': 0.0, 'max_seconds': 0.0, 'rows': 0
+            }
+        stats['calls'] += 1
+        stats['total_seconds'] += elapsed
+        stats['max_seconds'] = max(stats['max_seconds'], elapsed)
+        if rowcount > 0:
+            stats['rows'] += rowcount
+
+
+def dump_query_stats(limit=None, reset=False):
+    """Log and return the most expensive statement fingerprints by total time.
+
+    Args:
+        limit (int): Number of fingerprints to return, defaults to QUERY_STATS_TOP_N.
+        reset (bool): Clear the table after dumping it.
+
+    Returns:
+        stats (list): List of dicts sorted by total_seconds descending.
+    """
+    with query_stats_lock:
+        stats = [dict(fingerprint=k, **v) for (k, v) in query_stats.items()]
+        if reset:
+            query_stats.clear()
+
+    stats.sort(key=lambda s: s['total_seconds'], reverse=True)
+    stats = stats[:limit or query_stats_top_n]
+
+    for s in stats:
+        logger.info("Query stats calls=%d total=%.3fs avg=%.4fs max=%.3fs rows=%d: %s",
+                    s['calls'], s['total_seconds'], s['total_seconds'] / s['calls'],
+                    s['max_seconds'], s['rows'], s['fingerprint'])
+    return stats
+
+
 def parse_null_value(value):
     if value == 'NULL':
         return 'default'
@@ -267,14 +618,11 @@ def parse_dict_null_value(dictionary):
     return new_dict
 
 
-@retry(stop_max_attempt_number=3, wait_exponential_multiplier=500, wait_exponential_max=5000)
+@resilience.retrying('kubernetes', retry_on=(urllib3.exceptions.HTTPError,))
 def get_secret_data(secret_name, secret_namespace=None):
-    core_v1_api = kubernetes.client.CoreV1Api()
     if not secret_namespace:
         secret_namespace = "babylon-reporting"
-    secret = core_v1_api.read_namespaced_secret(
-        secret_name, secret_namespace
-    )
+    secret = kube_client.core_v1_api().read_namespaced_secret(secret_name, secret_namespace)
     data = {k: base64.b64decode(v).decode('utf-8') for (k, v) in secret.data.items()}
 
     # Attempt to evaluate secret data valuse as YAML
@@ -329,7 +677,7 @@ def last_lifecycle(provision_uuid):
             f"ORDER BY 1 DESC \n" \
             f"LIMIT 1;"
 
-    result = execute_query(query, positional_args=positional_args, autocommit=True)
+    result = execute_query(query, positional_args=positional_args, autocommit=True, prepare=True)
 
     if result['rowcount'] >= 1:
         query_result = result['query_result'][0]
@@ -339,46 +687,42 @@ def last_lifecycle(provision_uuid):
 
 
 def provision_lifecycle(provision_uuid, current_state, username):
-    last_state = last_lifecycle(provision_uuid)
-
-    if last_state == current_state:
-        return
-
-    print(f"Updating provision {provision_uuid} - last_state = {current_state}")
-    current_date = datetime.now(timezone.utc)
-    positional_args = [current_state, current_date, provision_uuid]
-    query = f"SET TIMEZONE='GMT'; \n" \
-            f"UPDATE provisions SET \n" \
-            f"  last_state = %s, \n" \
-            f"  modified_at = %s " \
-            f"WHERE uuid = %s RETURNING uuid;"
-
-    cur = execute_query(query, positional_args=positional_args, autocommit=True)
-
     if username is None:
         username = 'gpte-user'
 
     positional_args = [
         provision_uuid,
         current_state,
-        username
+        username,
+        current_state,
+        provision_uuid,
     ]
 
-    print(f"Inserting Lifecycle log for {provision_uuid} - {current_state} - {username}")
-    query = f"SET TIMEZONE='GMT'; " \
-            f"INSERT INTO lifecycle_log (provision_uuid, state, executor) \n" \
-            f"VALUES (%s, %s, %s) RETURNING id;"
+    with lifecycle_write_locks[hash(provision_uuid) % len(lifecycle_write_locks)]:
+        cur = execute_query(lifecycle_insert_query, positional_args=positional_args, autocommit=True, prepare=True)
+        if not cur or cur['rowcount'] < 1:
+            return
 
-    cur = execute_query(query, positional_args=positional_args, autocommit=True)
+    print(f"Inserted Lifecycle log for {provision_uuid} - {current_state} - {username}")
+    print(f"Updating provision {provision_uuid} - last_state = {current_state}")
+    current_date = datetime.now(timezone.utc)
+    positional_args = [current_state, current_date, provision_uuid]
+    query = f"UPDATE provisions SET \n" \
+            f"  last_state = %s, \n" \
+            f"  modified_at = %s " \
+            f"WHERE uuid = %s RETURNING uuid;"
+
+    cur = execute_query(query, positional_args=positional_args, autocommit=True, prepare=True)
 
 
 def update_provision_result(provision_uuid, result='success'):
     positional_args = [result, provision_uuid]
-    query = f"SET TIMEZONE='GMT'; UPDATE provisions SET provision_result = %s WHERE uuid = %s RETURNING uuid;"
+    query = f"UPDATE provisions SET provision_result = %s WHERE uuid = %s RETURNING uuid;"
 
-    cur = execute_query(query, positional_args=positional_args, autocommit=True)
+    cur = execute_query(query, positional_args=positional_args, autocommit=True, prepare=True)
 
 
+@metrics.stage('save_resource_claim_data')
 def save_resource_claim_data(resource_claim_uuid, resource_claim_name, resource_claim_namespace, resource_claim):
     if len(resource_claim) == 0:
         print('Resource Claim log size 0, do not insert into db')
@@ -387,30 +731,29 @@ def save_resource_claim_data(resource_claim_uuid, resource_claim_name, resource_
     if resource_claim_uuid is None:
         return
 
-    resource_claim_metadata = resource_claim.get('metadata', {})
-    resource_claim_metadata.pop('managedFields')
-
-    resource_claim_spec = resource_claim.get('spec', {})
-    if 'provision_messages' in resource_claim_spec:
-        resource_claim_spec.pop('provision_messages')
-
-    resource_claim_json = {
-        'metadata': resource_claim_metadata,
-        'spec': resource_claim_spec,
+    resource_claim = {
+        'metadata': resource_claim.get('metadata', {}),
+        'spec': resource_claim.get('spec', {}),
         'status': resource_claim.get('status', {})
     }
+    snapshot_history.save_snapshot_history(resource_claim_uuid, 'resource_claim', resource_claim)
+    if not snapshots.snapshot_latest_enabled:
+        return
+
+    # managedFields, provision_messages and other bulky keys are stripped by dump_snapshot()
+    resource_claim_json = snapshots.dump_snapshot(resource_claim, 'resource_claim')
 
     insert_fields = {
         'provision_uuid': resource_claim_uuid,
         'resource_claim_name': resource_claim_name,
         'resource_claim_namespace': resource_claim_namespace,
-        'resource_claim_json': json.dumps(resource_claim_json),
+        'resource_claim_json': resource_claim_json,
         'created_at': datetime.now(timezone.utc)
     }
     update_fields = {
         'resource_claim_name': resource_claim_name,
         'resource_claim_namespace': resource_claim_namespace,
-        'resource_claim_json': json.dumps(resource_claim_json),
+        'resource_claim_json': resource_claim_json,
     }
 
     query, positional_args = create_sql_statement(insert_fields=insert_fields,
@@ -419,9 +762,10 @@ def save_resource_claim_data(resource_claim_uuid, resource_claim_name, resource_
                                                   constraint='resource_claim_log_pk',
                                                   return_field='provision_uuid')
 
-    cur = execute_query(query, positional_args=positional_args, autocommit=True)
+    cur = execute_snapshot_write(query, positional_args)
 
 
+@metrics.stage('save_anarchy_subject')
 def save_anarchy_subject(resource_claim_uuid, resource_claim_name, resource_claim_namespace, anarchy_subject):
     if len(anarchy_subject) == 0:
         print('Resource Claim log size 0, do not insert into db')
@@ -430,17 +774,23 @@ def save_anarchy_subject(resource_claim_uuid, resource_claim_name, resource_clai
     if resource_claim_uuid is None:
         return
 
+    snapshot_history.save_snapshot_history(resource_claim_uuid, 'anarchy_subject', anarchy_subject)
+    if not snapshots.snapshot_latest_enabled:
+        return
+
+    anarchy_subject_json = snapshots.dump_snapshot(anarchy_subject, 'anarchy_subject')
+
     insert_fields = {
         'provision_uuid': resource_claim_uuid,
         'resource_claim_name': resource_claim_name,
         'resource_claim_namespace': resource_claim_namespace,
-        'anarchy_subject_json': json.dumps(anarchy_subject),
+        'anarchy_subject_json': anarchy_subject_json,
         'created_at': datetime.now(timezone.utc)
     }
     update_fields = {
         'resource_claim_name': resource_claim_name,
         'resource_claim_namespace': resource_claim_namespace,
-        'anarchy_subject_json': json.dumps(anarchy_subject),
+        'anarchy_subject_json': anarchy_subject_json,
     }
 
     query, positional_args = create_sql_statement(insert_fields=insert_fields,
@@ -448,25 +798,32 @@ def save_anarchy_subject(resource_claim_uuid, resource_claim_name, resource_clai
                                                   table_name='resource_claim_log',
                                                   constraint='resource_claim_log_pk',
                                                   return_field='provision_uuid')
-    cur = execute_query(query, positional_args=positional_args, autocommit=True)
+    cur = execute_snapshot_write(query, positional_args)
 
 
+@metrics.stage('save_tower_extra_vars')
 def save_tower_extra_vars(resource_claim_uuid, resource_claim_name, resource_claim_namespace, provision_vars):
     if len(provision_vars) == 0:
         print('Provision vars size 0, do not insert into db')
         return
 
+    snapshot_history.save_snapshot_history(resource_claim_uuid, 'tower_extra_vars', provision_vars)
+    if not snapshots.snapshot_latest_enabled:
+        return
+
+    tower_extra_vars_json = snapshots.dump_snapshot(provision_vars, 'tower_extra_vars')
+
     insert_fields = {
         'provision_uuid': resource_claim_uuid,
         'resource_claim_name': resource_claim_name,
         'resource_claim_namespace': resource_claim_namespace,
-        'tower_extra_vars_json': json.dumps(provision_vars),
+        'tower_extra_vars_json': tower_extra_vars_json,
         'created_at': datetime.now(timezone.utc)
     }
     update_fields = {
         'resource_claim_name': resource_claim_name,
         'resource_claim_namespace': resource_claim_namespace,
-        'tower_extra_vars_json': json.dumps(provision_vars),
+        'tower_extra_vars_json': tower_extra_vars_json,
     }
 
     query, positional_args = create_sql_statement(insert_fields=insert_fields,
@@ -474,25 +831,32 @@ def save_tower_extra_vars(resource_claim_uuid, resource_claim_name, resource_cla
                                                   table_name='resource_claim_log',
                                                   constraint='resource_claim_log_pk',
                                                   return_field='provision_uuid')
-    cur = execute_query(query, positional_args=positional_args, autocommit=True)
+    cur = execute_snapshot_write(query, positional_args)
 
 
+@metrics.stage('save_provision_vars')
 def save_provision_vars(resource_claim_uuid, resource_claim_name, resource_claim_namespace, provision_vars):
     if len(provision_vars) == 0:
         print('Provision vars size 0, do not insert into db')
         return
 
+    snapshot_history.save_snapshot_history(resource_claim_uuid, 'provision_vars', provision_vars)
+    if not snapshots.snapshot_latest_enabled:
+        return
+
+    provision_vars_json = snapshots.dump_snapshot(provision_vars, 'provision_vars')
+
     insert_fields = {
         'provision_uuid': resource_claim_uuid,
         'resource_claim_name': resource_claim_name,
         'resource_claim_namespace': resource_claim_namespace,
-        'provision_vars_json': json.dumps(provision_vars, default=str),
+        'provision_vars_json': provision_vars_json,
         'created_at': datetime.now(timezone.utc)
     }
     update_fields = {
         'resource_claim_name': resource_claim_name,
         'resource_claim_namespace': resource_claim_namespace,
-        'provision_vars_json': json.dumps(provision_vars, default=str),
+        'provision_vars_json': provision_vars_json,
     }
 
     query, positional_args = create_sql_statement(insert_fields=insert_fields,
@@ -500,22 +864,46 @@ def save_provision_vars(resource_claim_uuid, resource_claim_name, resource_claim
                                                   table_name='resource_claim_log',
                                                   constraint='resource_claim_log_pk',
                                                   return_field='provision_uuid')
-    cur = execute_query(query, positional_args=positional_args, autocommit=True)
+    cur = execute_snapshot_write(query, positional_args)
+
 
+def normalize_timestamp(timestamp):
+    """Convert an ISO 8601 timestamp, as emitted by kopf, Kubernetes and Tower,
+    to a timezone aware datetime in UTC.
 
-def timestamp_to_utc(timestamp_received):
-    if timestamp_received:
-        local_timezone = tzlocal.get_localzone()
-        provision_job_start_timestamp = datetime.strptime(timestamp_received, '%Y-%m-%dT%H:%M:%S%z')
-        provision_job_start_timestamp = provision_job_start_timestamp.astimezone(local_timezone)
-        provision_job_start_timestamp = provision_job_start_timestamp.replace(tzinfo=pytz.utc)
-        print(provision_job_start_timestamp.replace(tzinfo=pytz.utc))
+    Accepts a `Z` or numeric offset suffix, fractional seconds and timestamps
+    without offset, which are considered UTC. Offsets are converted, not discarded.
 
-        utc_tzinfo = pytz.timezone("UTC")
+    Args:
+        timestamp (str or datetime): Timestamp to convert.
 
-        timestamp_received = provision_job_start_timestamp.astimezone(utc_tzinfo)
+    Returns:
+        timestamp (datetime): UTC datetime, or the passed value when it is empty.
+    """
+    if not timestamp:
+        return timestamp
 
-    return timestamp_received
+    if isinstance(timestamp, datetime):
+        parsed = timestamp
+    else:
+        if timestamp[-1] in 'Zz':
+            timestamp = timestamp[:-1] + '+00:00'
+        try:
+            parsed = datetime.fromisoformat(timestamp)
+        except ValueError:
+            # Before Python 3.11 fromisoformat only accepts 3 or 6 fractional digits and HH:MM offsets
+            match = _timestamp_re.match(timestamp)
+            if not match:
+                raise ValueError(f"Invalid timestamp '{timestamp}'")
+            date_time, fraction, offset = match.groups()
+            fraction = f".{(fraction or '')[:6].ljust(6, '0')}"
+            if offset and ':' not in offset:
+                offset = f"{offset[:3]}:{offset[3:]}"
+            parsed = datetime.fromisoformat(date_time + fraction + (offset or ''))
+
+    if parsed.tzinfo is None:
+        return parsed.replace(tzinfo=utc_tzinfo)
+    return parsed.astimezone(utc_tzinfo)
 
 
 def create_sql_statement(insert_fields, update_fields, table_name, constraint, return_field):
@@ -523,7 +911,7 @@ def create_sql_statement(insert_fields, update_fields, table_name, constraint, r
     list_fields = list(insert_fields.keys())
     list_str = ", ".join(list_fields)
 
-    query = f"SET TIMEZONE='GMT';\n INSERT INTO {table_name} (%s) \nVALUES( " % list_str
+    query = f"INSERT INTO {table_name} (%s) \nVALUES( " % list_str
     list_size = len(list_fields) - 1
     for index, item in enumerate(list_fields):
         positional_args.append(insert_fields[item])
@@ -0,0 +1,100 @@
+"""Startup phase run from configure(), before kopf starts the watches.
+
+The connection pools are opened and the caches read by every event are
+loaded in bulk, so the initial listing is not handled with cold caches. The
+initial listing delivers every AnarchySubject at once after a restart, its
+events are spread over time by a token bucket.
+"""
+import asyncio
+import functools
+import os
+import time
+
+import logs
+import metrics
+import utils
+from catalog_items import load_catalog_items_cache
+from corp_ldap import corp_ldap_pool
+from manager_chargeback import load_manager_cache
+from ratelimit import TokenBucket
+
+warmup_enabled = os.environ.get('WARMUP_ENABLED', 'true').lower() == 'true'
+# AnarchySubjects of the initial listing handled per second, 0 disables the limit
+initial_list_rate = float(os.environ.get('INITIAL_LIST_RATE', 20))
+initial_list_burst = int(os.environ.get('INITIAL_LIST_BURST', 50))
+
+logger = logs.get_logger('warmup')
+
+# Time-to-ready is measured from the import of this module
+started = time.monotonic()
+
+initial_list_limiter = TokenBucket(initial_list_rate, initial_list_burst)
+
+
+def warm_db_pool():
+    # The pool opens DB_POOL_MIN_CONNECTIONS connections when created
+    utils.connect_to_db()
+    return utils.db_pool_min_connections
+
+
+def warm_ldap_pools():
+    from ipa_ldap import ipa_ldap_pool
+
+    return corp_ldap_pool.fill() + ipa_ldap_pool.fill()
+
+
+def load_manager_chargeback_cache():
+    return len(load_manager_cache())
+
+
+steps = (
+    ('db_pool', warm_db_pool),
+    ('ldap_pools', warm_ldap_pools),
+    ('catalog_items_cache', load_catalog_items_cache),
+    ('manager_chargeback_cache', load_manager_chargeback_cache),
+)
+
+
+def run_step(name, step):
+    step_start = time.monotonic()
+    try:
+        count = step()
+    except Exception as e:
+        # A cold cache only makes the first events slower
+        logger.warning("Warm-up of %s failed: %s", name, e)
+        return
+    elapsed = time.monotonic() - step_start
+    metrics.STARTUP_SECONDS.labels(phase=name).set(elapsed)
+    logger.info("Warm-up of %s: %s loaded in %.2fs", name, count, elapsed)
+
+
+def warm_up():
+    if warmup_enabled:
+        for name, step in steps:
+            run_step(name, step)
+
+    ready = time.monotonic() - started
+    metrics.STARTUP_SECONDS.labels(phase='ready').set(ready)
+    logger.info("Ready to handle events %.2fs after start", ready)
+
+
+def throttle_initial_listing(handler):
+    """Decorate an async event handler to wait for the rate limiter on the events of the initial listing.
+
+    Kopf sends the objects of the initial listing as events without type. The
+    wait happens in the event loop before the handler, so it neither holds a
+    thread nor delays the events of the other objects.
+    """
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        event = kwargs.get('event') or {}
+        if event.get('type') is None:
+            # TokenBucket.acquire() would sleep in the event loop thread
+            wait = initial_list_limiter.try_acquire()
+            while wait:
+                await asyncio.sleep(wait)
+                wait = initial_list_limiter.try_acquire()
+            metrics.INITIAL_LIST_EVENTS.inc()
+            metrics.STARTUP_SECONDS.labels(phase='initial_list').set(time.monotonic() - started)
+        return await handler(*args, **kwargs)
+    return wrapper